@@ -7,15 +7,18 @@ Use this to integrate with Flutter/Mobile apps
 from flask import Flask, request, jsonify
 from flask_cors import CORS
 import os
-from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_community.vectorstores.chroma import Chroma
-from openai import OpenAI
+from embedding_cache import with_cache
+from embedding_backend import embedding_cache_name, load_embedding_model
+from context_builder import assemble_context, join_context
+from mia_rag import load_vector_db
+from llm_router import create_llm_client
+from session_memory import compact_history
 
 app = Flask(__name__)
 CORS(app)  # برای استفاده از Flutter
 
 # Configuration
-DB_PATH = "vector_db"
+EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 MODEL = "gpt-4o-mini"
 
@@ -30,14 +33,30 @@ Safety & Ethics:
 - Always add: "Final decisions must be made by a doctor or pharmacist."
 """
 
+# Built once per language: a byte-identical prefix lets upstream prompt caching hit
+SYSTEM_PROMPTS = {
+    language: f"""{MIA_IDENTITY}
+
+You are answering questions based on pharmaceutical and medical educational materials.
+
+Instructions:
+- Use the provided context to answer questions accurately
+- If the answer is not in the context, say so clearly
+- Always maintain Mia's empathetic and safety-focused tone
+- Include the disclaimer about final decisions being made by doctors/pharmacists
+- Respond in {name}
+"""
+    for language, name in (("en", "English"), ("fa", "Persian/Farsi"))
+}
+
 # Load vector DB once at startup
 print("🔄 Loading vector database...")
-embeddings = HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2")
-db = Chroma(persist_directory=DB_PATH, embedding_function=embeddings)
+embeddings = with_cache(load_embedding_model(EMBEDDING_MODEL), embedding_cache_name(EMBEDDING_MODEL))
+db = load_vector_db(embeddings)
 print("✅ Vector database loaded!")
 
 # OpenAI client
-client = OpenAI(api_key=OPENAI_API_KEY)
+client = create_llm_client(OPENAI_API_KEY)
 
 @app.route('/health', methods=['GET'])
 def health():
@@ -74,8 +93,9 @@ def query():
         # Search for relevant documents
         docs = db.similarity_search(question, k=top_k)
 
-        # Prepare context
-        context = "\n\n---\n\n".join([doc.page_content for doc in docs])
+        # Prepare context (only the chunks that fit are cited below)
+        docs = assemble_context(docs)
+        context = join_context(docs)
 
         # Prepare sources
         sources = [
@@ -86,25 +106,12 @@ def query():
             for doc in docs
         ]
 
-        # Prepare system prompt
-        system_prompt = f"""{MIA_IDENTITY}
-
-You are answering questions based on pharmaceutical and medical educational materials.
-
-Instructions:
-- Use the provided context to answer questions accurately
-- If the answer is not in the context, say so clearly
-- Always maintain Mia's empathetic and safety-focused tone
-- Include the disclaimer about final decisions being made by doctors/pharmacists
-- Respond in {"Persian/Farsi" if language == "fa" else "English"}
-"""
-
         # Prepare messages
-        messages = [{"role": "system", "content": system_prompt}]
+        messages = [{"role": "system", "content": SYSTEM_PROMPTS["fa" if language == "fa" else "en"]}]
 
-        # Add conversation history if provided
-        if conversation_history:
-            messages.extend(conversation_history)
+        # Add conversation history if provided, older turns summarized to HISTORY_MAX_TOKENS
+        history, history_stats = compact_history(conversation_history)
+        messages.extend(history)
 
         # Add current question with context
         user_message = f"""Context from documents:
@@ -134,7 +141,8 @@ Please answer based on the context provided above."""
             "answer": answer,
             "sources": sources,
             "question": question,
-            "language": language
+            "language": language,
+            "history": history_stats
         })
 
     except Exception as e:
@@ -0,0 +1,513 @@
+#!/usr/bin/env python3
+"""
+Async (ASGI) REST API Server for Mia RAG System
+Same /query, /query/stream, /search, /health and /cache/* contracts as
+api_server_production.py, but requests waiting on OpenAI don't hold a thread:
+the LLM call goes through the async LLM gateway / router and the CPU-bound embedding, Chroma search and prompt assembly run
+in a bounded thread pool (RETRIEVAL_WORKERS).
+
+Run with:
+    uvicorn api_server_async:app --host 0.0.0.0 --port $PORT
+"""
+
+from quart import Quart, Response, g, request, jsonify
+from quart_cors import cors
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from limits import parse
+from limits.storage import storage_from_string
+from limits.strategies import FixedWindowRateLimiter
+import asyncio
+import contextvars
+import hmac
+import os
+import threading
+import logging
+import time
+from mia_rag import (
+    ADMIN_TOKEN, DB_PATH, OPENAI_API_KEY, MODEL, build_messages, format_sources, format_search_results,
+    embedding_stats, index_location, load_embeddings, lookup_cache, open_index, query_result, retrieve,
+    sse_event, with_timings
+)
+from metadata_index import open_metadata_index, parse_filters
+from index_snapshots import SnapshotWatcher, current_version
+from response_cache import ResponseCache
+from cache_backends import CACHE_BACKEND_URL, RATELIMIT_ENABLED, RATELIMIT_STORAGE_URI, backend_from_url
+from singleflight import AsyncSingleFlight
+from llm_router import create_llm_client
+from warmup import start_warmup
+import metrics
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+app = cors(Quart(__name__))
+
+# Configuration
+PORT = int(os.getenv("PORT", 5000))
+RETRIEVAL_WORKERS = int(os.getenv("RETRIEVAL_WORKERS", 4))
+
+# Rate limiting: same limit strings and storage URI as the Flask server (100 per hour by default).
+# The counters are this server's own: flask-limiter scopes its keys by view function.
+rate_limiter = FixedWindowRateLimiter(storage_from_string(RATELIMIT_STORAGE_URI))
+# memory:// is a dict lookup; sqlite:// and redis:// do I/O and must stay off the event loop
+RATELIMIT_BLOCKING = not RATELIMIT_STORAGE_URI.startswith("memory://")
+DEFAULT_LIMIT = parse("100 per hour")
+ROUTE_LIMITS = {}
+
+def limit(limit_string):
+    """Per-route limit, replaces the default one (like flask-limiter's @limiter.limit)"""
+    def decorator(func):
+        ROUTE_LIMITS[func.__name__] = parse(limit_string)
+        return func
+    return decorator
+
+# Embedding, vector search and prompt assembly are CPU-bound: run them in a bounded pool
+executor = ThreadPoolExecutor(max_workers=RETRIEVAL_WORKERS, thread_name_prefix="retrieval")
+
+async def run_blocking(func, *args, **kwargs):
+    # the request's context (metrics timer) goes along into the pool thread
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(
+        executor, partial(context.run, func, *args, **kwargs)
+    )
+
+# LRU + TTL response cache (see response_cache.py / cache_backends.py)
+response_cache = ResponseCache(backend=backend_from_url(CACHE_BACKEND_URL))
+
+# Identical questions in flight at the same time share one retrieval + OpenAI call
+query_flight = AsyncSingleFlight()
+
+# Model + vector DB are loaded in the background (MODEL_LOADING, see warmup.py)
+embeddings = None
+db = None
+index_version = None  # snapshot being served (index_snapshots.py), None = plain DB_PATH
+# (db, index_version) swapped as one: a request reads it once and uses that index throughout
+served = (None, None)
+reload_lock = threading.Lock()
+
+def reload_index(version=None, force=False):
+    """Switch to another index snapshot without reloading the model, see api_server_production.py"""
+    global db, index_version, served
+    with reload_lock:
+        previous = index_version
+        if not force and (version or current_version(DB_PATH)) == previous:
+            return previous, previous
+        new_db, new_version = open_index(embeddings, version)
+        db, index_version = new_db, new_version
+        served = (new_db, new_version)
+        # a version pinned by /admin/reload stays until CURRENT itself changes
+        index_watcher.seen = current_version(DB_PATH)
+    logger.info(f"🔁 Index swapped: {previous} -> {new_version}")
+    return previous, new_version
+
+# polls DB_PATH/CURRENT every INDEX_WATCH_INTERVAL seconds (0 = off)
+index_watcher = SnapshotWatcher(DB_PATH, lambda version: reload_index())
+
+def load_models():
+    global embeddings, db, index_version, served
+    try:
+        logger.info("🔄 Loading vector database...")
+        loaded_embeddings = load_embeddings()
+        loaded_db, version = open_index(loaded_embeddings)
+    except Exception as e:
+        logger.error(f"❌ Failed to load vector database: {e}")
+        raise
+    embeddings, db, index_version = loaded_embeddings, loaded_db, version
+    served = (loaded_db, version)
+    index_watcher.seen = version
+    index_watcher.start()
+    logger.info(f"✅ Vector database loaded successfully! (index {version or DB_PATH})")
+
+warmup = start_warmup(load_models)
+
+# LLM client: hosted OpenAI and/or a local OpenAI-compatible server (llm_router.py),
+# pooled, with timeouts / retries / circuit breaker (llm_gateway.py)
+client = create_llm_client(OPENAI_API_KEY, use_async=True)
+if client:
+    logger.info("✅ OpenAI client initialized")
+else:
+    logger.warning("⚠️ OPENAI_API_KEY not set!")
+
+async def answer_question(db, question, language, top_k, cache_key, cache_scope, question_vector, filters=None):
+    """Retrieve, ask OpenAI and cache the result. Returns None if nothing relevant was found"""
+    logger.info(f"🔍 Processing question: {question[:50]}...")
+    docs, question_vector = await run_blocking(
+        retrieve, db, embeddings, question, top_k, question_vector, filters
+    )
+    if not docs:
+        return None
+
+    # token counting + MMR are CPU work too, keep them off the event loop
+    with metrics.span("prompt"):
+        messages, docs = await run_blocking(build_messages, question, docs, language)
+    sources = format_sources(docs)
+    with metrics.llm_errors(), metrics.span("llm"):
+        response = await client.chat.completions.create(
+            model=MODEL,
+            messages=messages,
+            temperature=0.7,
+            max_tokens=1500
+        )
+    metrics.record_llm_usage(messages, usage=getattr(response, "usage", None))
+
+    result = query_result(question, language, response.choices[0].message.content, sources)
+    await run_blocking(response_cache.put, cache_key, result, cache_scope, question_vector)
+
+    logger.info(f"✅ Successfully answered question")
+    return result
+
+async def parse_query_request():
+    """(question, language, top_k, use_cache, filters); ValueError for malformed filters"""
+    data = await request.get_json()
+    return (
+        data.get('question'),
+        data.get('language', 'auto'),
+        data.get('top_k', 5),
+        data.get('use_cache', True),
+        parse_filters(data.get('filters')),
+    )
+
+@app.before_request
+async def check_rate_limit():
+    if not RATELIMIT_ENABLED or request.endpoint in ("prometheus_metrics", "admin_reload"):
+        return None
+    hit = partial(rate_limiter.hit, ROUTE_LIMITS.get(request.endpoint, DEFAULT_LIMIT),
+                  request.remote_addr or "unknown", request.endpoint or "unknown")
+    # own thread, not the retrieval pool: a limit check shouldn't queue behind embeddings
+    allowed = await asyncio.to_thread(hit) if RATELIMIT_BLOCKING else hit()
+    if not allowed:
+        logger.warning(f"⚠️ Rate limit exceeded: {request.remote_addr}")
+        metrics.RATE_LIMITED.inc(endpoint=request.endpoint)
+        return jsonify({
+            "success": False,
+            "error": "Rate limit exceeded. Please try again later."
+        }), 429
+
+@app.before_request
+async def start_timer():
+    g.timer = metrics.start_request(request.endpoint)
+
+@app.after_request
+async def finish_timer(response):
+    timer = g.get("timer")
+    if timer:
+        if metrics.METRICS_TIMING_HEADER:
+            response.headers["Server-Timing"] = timer.server_timing()
+        # a streamed body is still being generated: the generator finishes its timer
+        if not timer.streaming:
+            timer.finish(response.status_code)
+    return response
+
+@app.route('/')
+async def index():
+    """Root endpoint"""
+    return jsonify({
+        "name": "Mia RAG API",
+        "version": "6.3b",
+        "status": "running",
+        "mode": "async",
+        "endpoints": {
+            "health": "/health",
+            "query": "/query (POST)",
+            "query_stream": "/query/stream (POST, text/event-stream)",
+            "search": "/search (POST)",
+            "filters": "/filters",
+            "metrics": "/metrics"
+        }
+    })
+
+@app.route('/health', methods=['GET'])
+async def health():
+    """Health check endpoint for Railway/Render"""
+    status = {
+        "status": "healthy",
+        "message": "Mia RAG API is running",
+        "version": "6.3b",
+        "database": "loaded" if db else "not loaded",
+        "openai": "ready" if client else "not configured",
+        "index_version": index_version,
+        "cache_size": len(response_cache)
+    }
+
+    if warmup.state == "warming":
+        status["status"] = "warming"
+        status["message"] = "Loading embedding model and vector index"
+    status["warmup"] = warmup.status()
+
+    if not db or not client:
+        return jsonify(status), 503, {"Retry-After": "5"}  # Service Unavailable
+
+    return jsonify(status), 200
+
+@app.route('/query', methods=['POST'])
+@limit("30 per minute")
+async def query():
+    """Main query endpoint with caching (same body as the Flask server)"""
+    try:
+        if not db or not client:
+            return jsonify({
+                "success": False,
+                "error": "Service not fully initialized"
+            }), 503
+
+        try:
+            question, language, top_k, use_cache, filters = await parse_query_request()
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        if not question:
+            return jsonify({"error": "Question is required"}), 400
+
+        # one index for the whole request, even if /admin/reload swaps it meanwhile
+        index_db, version = served
+
+        # Check cache
+        cache_key, cache_scope, cached, _, question_vector = await run_blocking(
+            lookup_cache, response_cache, embeddings, version, question, language, top_k, use_cache, filters
+        )
+        if cached:
+            return jsonify(cached)
+
+        # Answer (or wait for an identical question that is already being answered)
+        result, coalesced = await query_flight.do(
+            cache_key,
+            lambda: answer_question(
+                index_db, question, language, top_k, cache_key, cache_scope, question_vector, filters
+            )
+        )
+
+        if result is None:
+            return jsonify({
+                "success": False,
+                "error": "No relevant documents found"
+            }), 404
+
+        if coalesced:
+            logger.info(f"🔗 Coalesced with in-flight question: {question[:50]}...")
+        return jsonify(dict(result, question=question, coalesced=coalesced))
+
+    except Exception as e:
+        logger.error(f"❌ Error processing query: {e}")
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 500
+
+@app.route('/query/stream', methods=['POST'])
+@limit("30 per minute")
+async def query_stream():
+    """Streaming variant of /query (Server-Sent Events), see api_server_production.py"""
+    if not db or not client:
+        return jsonify({
+            "success": False,
+            "error": "Service not fully initialized"
+        }), 503
+
+    try:
+        question, language, top_k, use_cache, filters = await parse_query_request()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if not question:
+        return jsonify({"error": "Question is required"}), 400
+
+    timer = g.timer
+    timer.streaming = True
+    index_db, version = served
+
+    async def generate():
+        timer.activate()
+        try:
+            cache_key, cache_scope, cached, _, question_vector = await run_blocking(
+                lookup_cache, response_cache, embeddings, version, question, language, top_k, use_cache, filters
+            )
+            if cached:
+                yield sse_event("sources", {"sources": cached["sources"]})
+                yield sse_event("delta", {"content": cached["answer"]})
+                yield sse_event("done", with_timings(cached, timer))
+                return
+
+            logger.info(f"🔍 Streaming answer for: {question[:50]}...")
+            docs, question_vector = await run_blocking(
+                retrieve, index_db, embeddings, question, top_k, question_vector, filters
+            )
+            if not docs:
+                yield sse_event("error", {"error": "No relevant documents found"})
+                return
+
+            with metrics.span("prompt"):
+                messages, docs = await run_blocking(build_messages, question, docs, language)
+            sources = format_sources(docs)
+            yield sse_event("sources", {"sources": sources})
+
+            parts = []
+            with metrics.llm_errors():
+                started = time.perf_counter()
+                stream = await client.chat.completions.create(
+                    model=MODEL,
+                    messages=messages,
+                    temperature=0.7,
+                    max_tokens=1500,
+                    stream=True
+                )
+                async for chunk in stream:
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        if not parts:
+                            timer.record("llm_first_token", time.perf_counter() - started)
+                        parts.append(delta)
+                        yield sse_event("delta", {"content": delta})
+                timer.record("llm", time.perf_counter() - started)
+
+            answer = "".join(parts)
+            metrics.record_llm_usage(messages, answer=answer)
+            result = query_result(question, language, answer, sources)
+            await run_blocking(response_cache.put, cache_key, result, cache_scope, question_vector)
+            logger.info("✅ Successfully streamed answer")
+            yield sse_event("done", with_timings(result, timer))
+
+        except Exception as e:
+            logger.error(f"❌ Error streaming query: {e}")
+            yield sse_event("error", {"error": str(e)})
+        finally:
+            timer.finish(200)
+
+    response = Response(generate(), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"
+    response.timeout = None
+    return response
+
+@app.route('/search', methods=['POST'])
+@limit("60 per minute")
+async def search():
+    """Search for relevant documents only (no OpenAI call)"""
+    try:
+        if not db:
+            return jsonify({
+                "success": False,
+                "error": "Database not loaded"
+            }), 503
+
+        data = await request.get_json()
+        query_text = data.get('query')
+        top_k = data.get('top_k', 5)
+
+        if not query_text:
+            return jsonify({"error": "Query is required"}), 400
+        try:
+            filters = parse_filters(data.get('filters'))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        logger.info(f"🔍 Searching for: {query_text[:50]}...")
+        docs, _ = await run_blocking(retrieve, db, embeddings, query_text, top_k, None, filters)
+
+        results = format_search_results(docs)
+        logger.info(f"✅ Found {len(results)} documents")
+        return jsonify({
+            "success": True,
+            "results": results,
+            "query": query_text,
+            "count": len(results)
+        })
+
+    except Exception as e:
+        logger.error(f"❌ Error searching: {e}")
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 500
+
+@app.route('/admin/reload', methods=['POST'])
+async def admin_reload():
+    """Hot-swap to another index snapshot (same body and header as api_server_production.py)"""
+    token = request.headers.get("X-Admin-Token", "")
+    if not ADMIN_TOKEN or not hmac.compare_digest(token, ADMIN_TOKEN):
+        return jsonify({"success": False, "error": "Forbidden"}), 403
+    if not embeddings:
+        return jsonify({"success": False, "error": "Service not fully initialized"}), 503
+
+    data = await request.get_json(silent=True) or {}
+    try:
+        previous, version = await run_blocking(reload_index, data.get("version"), data.get("force", False))
+    except Exception as e:
+        logger.error(f"❌ Index reload failed: {e}")
+        return jsonify({"success": False, "error": str(e), "version": index_version}), 500
+    return jsonify({
+        "success": True,
+        "previous": previous,
+        "version": version,
+        "swapped": previous != version or bool(data.get("force")),
+        "scope": "this worker"
+    })
+
+@app.route('/metrics', methods=['GET'])
+async def prometheus_metrics():
+    """Latency histograms and counters in the Prometheus text format (see metrics.py)"""
+    return Response(metrics.render(), mimetype=metrics.CONTENT_TYPE)
+
+@app.route('/filters', methods=['GET'])
+async def list_filters():
+    """Values the "filters" of /query and /search can take, see api_server_production.py"""
+    if not db:
+        return jsonify({"success": False, "error": "Database not loaded"}), 503
+    metadata = await run_blocking(open_metadata_index, index_location(index_version)[0])
+    if metadata is None:
+        return jsonify({
+            "success": False,
+            "error": "No metadata index, run: python metadata_index.py build"
+        }), 404
+    return jsonify({
+        "success": True,
+        "index_version": index_version,
+        "values": metadata.values(),
+        "page": "[first, last] or a single page number",
+        "shards": metadata.shards["field"] if metadata.shards else None
+    })
+
+@app.route('/cache/clear', methods=['POST'])
+async def clear_cache():
+    """Clear response cache"""
+    await run_blocking(response_cache.clear)
+    logger.info("🗑️ Cache cleared")
+    return jsonify({
+        "success": True,
+        "message": "Cache cleared",
+        "scope": "all workers" if response_cache.backend.shared else "this worker"
+    })
+
+@app.route('/cache/stats', methods=['GET'])
+async def cache_stats():
+    """Get cache statistics"""
+    stats = await run_blocking(response_cache.stats)
+    stats["coalescing"] = query_flight.stats()
+    stats["llm"] = client.stats() if client else None
+    stats["index"] = {"version": index_version, "watch_interval": index_watcher.interval,
+                      "watch_error": index_watcher.error}
+    if db:
+        stats.update(embedding_stats(embeddings))
+    return jsonify(stats)
+
+if __name__ == '__main__':
+    import uvicorn
+
+    if not client:
+        logger.error("❌ Error: OPENAI_API_KEY not set (or LOCAL_LLM_BASE_URL with LLM_ROUTING=local)")
+        exit(1)
+
+    logger.info("\n" + "="*60)
+    logger.info("🏥 Mia RAG API Server (Async)")
+    logger.info("="*60)
+    logger.info(f"📍 Server starting on port: {PORT}")
+    logger.info(f"🤖 Using model: {MODEL}")
+    logger.info(f"💾 Database path: {DB_PATH}")
+    logger.info(f"🧵 Retrieval pool: {RETRIEVAL_WORKERS} threads")
+    logger.info("="*60 + "\n")
+
+    uvicorn.run(app, host='0.0.0.0', port=PORT)
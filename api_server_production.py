@@ -4,17 +4,30 @@ Production-ready REST API Server for Mia RAG System
 Optimized for Railway/Render deployment with caching and rate limiting
 """
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify, stream_with_context
 from flask_cors import CORS
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
-from functools import lru_cache
 import os
-import hashlib
+import hmac
+import json
 import logging
-from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_community.vectorstores.chroma import Chroma
-from openai import OpenAI
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from mia_rag import (
+    ADMIN_TOKEN, DB_PATH, OPENAI_API_KEY, MODEL, RETRIEVAL_BACKEND, build_messages, format_sources,
+    format_search_results, embedding_stats, forget_chroma_clients, index_location, load_embeddings, lookup_cache, open_index, query_result, retrieve,
+    sse_event, with_timings, search_by_vectors
+)
+from metadata_index import filters_key, open_metadata_index, parse_filters
+from index_snapshots import SnapshotWatcher, current_version
+from response_cache import ResponseCache, make_cache_key
+from cache_backends import CACHE_BACKEND_URL, RATELIMIT_ENABLED, RATELIMIT_STORAGE_URI, backend_from_url
+from singleflight import SingleFlight
+from llm_router import create_llm_client
+from warmup import start_warmup
+import metrics
 
 # Configure logging
 logging.basicConfig(
@@ -27,60 +40,148 @@ app = Flask(__name__)
 CORS(app)
 
 # Rate limiting: 100 requests per hour per IP
+# A shared RATELIMIT_STORAGE_URI (sqlite:// or redis://) makes the limits global across workers
 limiter = Limiter(
     app=app,
     key_func=get_remote_address,
     default_limits=["100 per hour"],
-    storage_uri="memory://"
+    storage_uri=RATELIMIT_STORAGE_URI,
+    enabled=RATELIMIT_ENABLED
 )
 
 # Configuration
-DB_PATH = os.getenv("DB_PATH", "vector_db")
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-MODEL = os.getenv("MODEL", "gpt-4o-mini")
 PORT = int(os.getenv("PORT", 5000))
 DEBUG = os.getenv("DEBUG", "False").lower() == "true"
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", 500))
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", 8))
+
+# LRU + TTL response cache (optional semantic tier, see response_cache.py)
+# CACHE_BACKEND_URL decides whether it is per-worker or shared (see cache_backends.py)
+response_cache = ResponseCache(backend=backend_from_url(CACHE_BACKEND_URL))
+
+# Identical questions in flight at the same time share one retrieval + OpenAI call
+query_flight = SingleFlight()
+
+# Model + vector DB are loaded in the background (MODEL_LOADING, see warmup.py)
+embeddings = None
+db = None
+index_version = None  # snapshot being served (index_snapshots.py), None = plain DB_PATH
+# (db, index_version) swapped as one: a request reads it once and uses that index throughout
+served = (None, None)
+reload_lock = threading.Lock()
+
+def reload_index(version=None, force=False):
+    """Switch to another index snapshot (default: CURRENT) without reloading the model.
+    Requests that already picked up the old index finish on it. Returns (previous, current) version"""
+    global db, index_version, served
+    with reload_lock:
+        previous = index_version
+        if not force and (version or current_version(DB_PATH)) == previous:
+            return previous, previous
+        new_db, new_version = open_index(embeddings, version)
+        db, index_version = new_db, new_version
+        served = (new_db, new_version)
+        # a version pinned by /admin/reload stays until CURRENT itself changes
+        index_watcher.seen = current_version(DB_PATH)
+    logger.info(f"🔁 Index swapped: {previous} -> {new_version}")
+    return previous, new_version
+
+# polls DB_PATH/CURRENT every INDEX_WATCH_INTERVAL seconds (0 = off)
+index_watcher = SnapshotWatcher(DB_PATH, lambda version: reload_index())
+
+def load_models():
+    global embeddings, db, index_version, served
+    try:
+        logger.info("🔄 Loading vector database...")
+        loaded_embeddings = load_embeddings()
+        loaded_db, version = open_index(loaded_embeddings)
+    except Exception as e:
+        logger.error(f"❌ Failed to load vector database: {e}")
+        raise
+    embeddings, db, index_version = loaded_embeddings, loaded_db, version
+    served = (loaded_db, version)
+    index_watcher.seen = version
+    index_watcher.start()
+    logger.info(f"✅ Vector database loaded successfully! (index {version or DB_PATH})")
+
+warmup = start_warmup(load_models)
+
+def reopen_after_fork():
+    """gunicorn post_fork (--preload): the master's Chroma client holds SQLite handles a forked
+    worker must not use, so the worker opens the served snapshot again. The caches reconnect
+    per process on their own (cache_backends.ProcessConnection)"""
+    if db is None or RETRIEVAL_BACKEND != "chroma":
+        return
+    forget_chroma_clients()
+    reload_index(index_version, force=True)
+
+@app.before_request
+def resume_warmup():
+    # a worker forked (gunicorn --preload) while the master was still warming starts its own
+    warmup.start()
+    if warmup.ready:
+        # threads don't survive the fork either
+        index_watcher.start()
+
+@app.before_request
+def start_timer():
+    g.timer = metrics.start_request(request.endpoint)
+
+@app.after_request
+def finish_timer(response):
+    timer = g.get("timer")
+    if timer:
+        if metrics.METRICS_TIMING_HEADER:
+            response.headers["Server-Timing"] = timer.server_timing()
+        # streamed responses (SSE, NDJSON) are only done once the body has been sent
+        response.call_on_close(lambda: timer.finish(response.status_code))
+    return response
+
+# LLM client: hosted OpenAI and/or a local OpenAI-compatible server (llm_router.py),
+# pooled, with timeouts / retries / circuit breaker (llm_gateway.py)
+client = create_llm_client(OPENAI_API_KEY)
+if client:
+    logger.info("✅ OpenAI client initialized")
+else:
+    logger.warning("⚠️ OPENAI_API_KEY not set!")
 
-# Mia's Identity
-MIA_IDENTITY = """Mia (Medical Intelligence Assistant) — Version 6.3 b
+def answer_question(db, question, language, top_k, cache_key, cache_scope, question_vector, filters=None):
+    """Retrieve, ask OpenAI and cache the result. Returns None if nothing relevant was found"""
+    logger.info(f"🔍 Processing question: {question[:50]}...")
 
-Description:
-Mia is a multilingual, empathetic, and safety-focused AI agent developed for pharmaceutical, pharmacological, and medical education and clinical support.
+    # Search for relevant documents
+    docs, question_vector = retrieve(db, embeddings, question, top_k, question_vector, filters)
+    if not docs:
+        return None
 
-Safety & Ethics:
-- Never diagnose or prescribe.
-- Always add: "Final decisions must be made by a doctor or pharmacist."
-"""
+    return generate_answer(question, language, docs, cache_key, cache_scope, question_vector)
 
-# Simple in-memory cache for responses
-response_cache = {}
-MAX_CACHE_SIZE = 100
-
-def get_cache_key(question, language):
-    """Generate cache key from question"""
-    content = f"{question}_{language}"
-    return hashlib.md5(content.encode()).hexdigest()
-
-# Load vector DB once at startup
-try:
-    logger.info("🔄 Loading vector database...")
-    embeddings = HuggingFaceEmbeddings(
-        model_name="sentence-transformers/all-MiniLM-L6-v2",
-        model_kwargs={'device': 'cpu'}
-    )
-    db = Chroma(persist_directory=DB_PATH, embedding_function=embeddings)
-    logger.info("✅ Vector database loaded successfully!")
-except Exception as e:
-    logger.error(f"❌ Failed to load vector database: {e}")
-    db = None
-
-# OpenAI client
-if OPENAI_API_KEY:
-    client = OpenAI(api_key=OPENAI_API_KEY)
-    logger.info("✅ OpenAI client initialized")
-else:
-    logger.warning("⚠️ OPENAI_API_KEY not set!")
-    client = None
+def generate_answer(question, language, docs, cache_key, cache_scope, question_vector):
+    """Ask OpenAI with already retrieved documents and cache the result"""
+    with metrics.span("prompt"):
+        messages, docs = build_messages(question, docs, language)
+    sources = format_sources(docs)
+
+    # Query OpenAI
+    with metrics.llm_errors(), metrics.span("llm"):
+        response = client.chat.completions.create(
+            model=MODEL,
+            messages=messages,
+            temperature=0.7,
+            max_tokens=1500
+        )
+
+    answer = response.choices[0].message.content
+    metrics.record_llm_usage(messages, usage=getattr(response, "usage", None))
+
+    # Prepare response
+    result = query_result(question, language, answer, sources)
+
+    # Cache the response
+    response_cache.put(cache_key, result, cache_scope, question_vector)
+
+    logger.info(f"✅ Successfully answered question")
+    return result
 
 @app.route('/')
 def index():
@@ -92,7 +193,11 @@ def index():
         "endpoints": {
             "health": "/health",
             "query": "/query (POST)",
-            "search": "/search (POST)"
+            "query_stream": "/query/stream (POST, text/event-stream)",
+            "query_batch": "/query/batch (POST, application/x-ndjson)",
+            "search": "/search (POST)",
+            "filters": "/filters",
+            "metrics": "/metrics"
         }
     })
 
@@ -105,11 +210,17 @@ def health():
         "version": "6.3b",
         "database": "loaded" if db else "not loaded",
         "openai": "ready" if client else "not configured",
+        "index_version": index_version,
         "cache_size": len(response_cache)
     }
 
+    if warmup.state == "warming":
+        status["status"] = "warming"
+        status["message"] = "Loading embedding model and vector index"
+    status["warmup"] = warmup.status()
+
     if not db or not client:
-        return jsonify(status), 503  # Service Unavailable
+        return jsonify(status), 503, {"Retry-After": "5"}  # Service Unavailable
 
     return jsonify(status), 200
 
@@ -124,7 +235,8 @@ def query():
         "question": "What is aspirin?",
         "language": "en",
         "top_k": 5,
-        "use_cache": true
+        "use_cache": true,
+        "filters": {"source": "Katzung.pdf", "page": [100, 180]}  // optional, see GET /filters
     }
     """
     try:
@@ -142,119 +254,310 @@ def query():
 
         if not question:
             return jsonify({"error": "Question is required"}), 400
+        try:
+            filters = parse_filters(data.get('filters'))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        # one index for the whole request, even if /admin/reload swaps it meanwhile
+        index_db, version = served
 
         # Check cache
-        cache_key = get_cache_key(question, language)
-        if use_cache and cache_key in response_cache:
-            logger.info(f"✅ Cache hit for question: {question[:50]}...")
-            cached = response_cache[cache_key]
-            cached['cached'] = True
+        cache_key, cache_scope, cached, _, question_vector = lookup_cache(
+            response_cache, embeddings, version, question, language, top_k, use_cache, filters
+        )
+        if cached:
             return jsonify(cached)
 
-        logger.info(f"🔍 Processing question: {question[:50]}...")
-
-        # Search for relevant documents
-        docs = db.similarity_search(question, k=top_k)
+        # Answer (or wait for an identical question that is already being answered)
+        result, coalesced = query_flight.do(
+            cache_key,
+            lambda: answer_question(
+                index_db, question, language, top_k, cache_key, cache_scope, question_vector, filters
+            )
+        )
 
-        if not docs:
+        if result is None:
             return jsonify({
                 "success": False,
                 "error": "No relevant documents found"
             }), 404
 
-        # Prepare context
-        context = "\n\n---\n\n".join([doc.page_content for doc in docs])
-
-        # Prepare sources
-        sources = [
-            {
-                "file": os.path.basename(doc.metadata.get('source', 'Unknown')),
-                "page": doc.metadata.get('page', None)
-            }
-            for doc in docs
-        ]
-
-        # Map language codes to full names
-        language_map = {
-            "fa": "Persian/Farsi",
-            "en": "English",
-            "ar": "Arabic",
-            "es": "Spanish",
-            "fr": "French",
-            "de": "German",
-            "tr": "Turkish",
-            "ur": "Urdu",
-            "ru": "Russian",
-            "zh": "Chinese",
-            "ja": "Japanese",
-            "ko": "Korean",
-            "auto": "the same language as the question",
-        }
-
-        # Get language instruction - auto-detect if not specified
-        language_instruction = language_map.get(language, "the same language as the question")
-
-        # Prepare system prompt
-        system_prompt = f"""{MIA_IDENTITY}
-
-You are answering questions based on pharmaceutical and medical educational materials.
-
-Instructions:
-- Use the provided context to answer questions accurately
-- If the answer is not in the context, say so clearly
-- Always maintain Mia's empathetic and safety-focused tone
-- Include the disclaimer about final decisions being made by doctors/pharmacists
-- Respond in {language_instruction}
-"""
-
-        # Prepare messages
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": f"""Context from documents:
-{context}
-
----
+        if coalesced:
+            logger.info(f"🔗 Coalesced with in-flight question: {question[:50]}...")
+        return jsonify(dict(result, question=question, coalesced=coalesced))
 
-Question: {question}
-
-Please answer based on the context provided above."""}
-        ]
+    except Exception as e:
+        logger.error(f"❌ Error processing query: {e}")
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 500
 
-        # Query OpenAI
-        response = client.chat.completions.create(
-            model=MODEL,
-            messages=messages,
-            temperature=0.7,
-            max_tokens=1500
-        )
+@app.route('/query/stream', methods=['POST'])
+@limiter.limit("30 per minute")
+def query_stream():
+    """
+    Streaming variant of /query (Server-Sent Events)
+
+    Same request body as /query. Events:
+        sources  {"sources": [...]}          sent before the LLM call
+        delta    {"content": "..."}          answer tokens as they arrive
+        done     {full /query result}        final result, also cached
+        error    {"error": "..."}
+    A cache hit replays the cached answer as a single delta.
+    """
+    if not db or not client:
+        return jsonify({
+            "success": False,
+            "error": "Service not fully initialized"
+        }), 503
 
-        answer = response.choices[0].message.content
+    data = request.json
+    question = data.get('question')
+    language = data.get('language', 'auto')
+    top_k = data.get('top_k', 5)
+    use_cache = data.get('use_cache', True)
 
-        # Prepare response
-        result = {
-            "success": True,
-            "answer": answer,
-            "sources": sources,
-            "question": question,
-            "language": language,
-            "cached": False
-        }
+    if not question:
+        return jsonify({"error": "Question is required"}), 400
+    try:
+        filters = parse_filters(data.get('filters'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    timer = g.timer
+    index_db, version = served
+
+    def generate():
+        timer.activate()
+        try:
+            cache_key, cache_scope, cached, _, question_vector = lookup_cache(
+                response_cache, embeddings, version, question, language, top_k, use_cache, filters
+            )
+            if cached:
+                yield sse_event("sources", {"sources": cached["sources"]})
+                yield sse_event("delta", {"content": cached["answer"]})
+                yield sse_event("done", with_timings(cached, timer))
+                return
+
+            logger.info(f"🔍 Streaming answer for: {question[:50]}...")
+            docs, question_vector = retrieve(index_db, embeddings, question, top_k, question_vector, filters)
+            if not docs:
+                yield sse_event("error", {"error": "No relevant documents found"})
+                return
+
+            with metrics.span("prompt"):
+                messages, docs = build_messages(question, docs, language)
+            sources = format_sources(docs)
+            yield sse_event("sources", {"sources": sources})
+
+            parts = []
+            with metrics.llm_errors():
+                started = time.perf_counter()
+                stream = client.chat.completions.create(
+                    model=MODEL,
+                    messages=messages,
+                    temperature=0.7,
+                    max_tokens=1500,
+                    stream=True
+                )
+                for chunk in stream:
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        if not parts:
+                            timer.record("llm_first_token", time.perf_counter() - started)
+                        parts.append(delta)
+                        yield sse_event("delta", {"content": delta})
+                timer.record("llm", time.perf_counter() - started)
+
+            answer = "".join(parts)
+            metrics.record_llm_usage(messages, answer=answer)
+            result = query_result(question, language, answer, sources)
+            # جواب کامل رو cache کن تا دفعه بعد فوری replay بشه
+            response_cache.put(cache_key, result, cache_scope, question_vector)
+            logger.info("✅ Successfully streamed answer")
+            yield sse_event("done", with_timings(result, timer))
+
+        except Exception as e:
+            logger.error(f"❌ Error streaming query: {e}")
+            yield sse_event("error", {"error": str(e)})
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
-        # Cache the response
-        if len(response_cache) >= MAX_CACHE_SIZE:
-            # Remove oldest entry
-            response_cache.pop(next(iter(response_cache)))
-        response_cache[cache_key] = result
+@app.route('/query/batch', methods=['POST'])
+@limiter.limit("10 per minute")
+def query_batch():
+    """
+    Answer many questions in one request (QA runs, nightly evaluations)
 
-        logger.info(f"✅ Successfully answered question")
-        return jsonify(result)
+    Request body:
+    {
+        "questions": ["What is aspirin?", {"id": "q2", "question": "...", "language": "fa", "top_k": 3}],
+        "language": "auto",     // default for items without one
+        "top_k": 5,             // default for items without one
+        "filters": {...},       // default for items without one, see /query
+        "use_cache": true,
+        "concurrency": 8        // parallel OpenAI calls (capped by BATCH_MAX_CONCURRENCY)
+    }
 
-    except Exception as e:
-        logger.error(f"❌ Error processing query: {e}")
+    Response: NDJSON, one /query-style result per line in completion order,
+    each with "index" (position in "questions") and "id" if one was given.
+    """
+    if not db or not client:
         return jsonify({
             "success": False,
-            "error": str(e)
-        }), 500
+            "error": "Service not fully initialized"
+        }), 503
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({"error": "A JSON object body is required"}), 400
+    items = data.get('questions')
+    if not items or not isinstance(items, list):
+        return jsonify({"error": "questions (a non-empty list) is required"}), 400
+    if len(items) > BATCH_MAX_ITEMS:
+        return jsonify({"error": f"At most {BATCH_MAX_ITEMS} questions per batch"}), 400
+
+    default_language = data.get('language', 'auto')
+    default_top_k = data.get('top_k', 5)
+    default_filters = data.get('filters')
+    use_cache = data.get('use_cache', True)
+    try:
+        concurrency = int(data.get('concurrency', BATCH_MAX_CONCURRENCY))
+    except (TypeError, ValueError):
+        return jsonify({"error": "concurrency must be an integer"}), 400
+    concurrency = max(1, min(concurrency, BATCH_MAX_CONCURRENCY))
+
+    jobs = []
+    for index, item in enumerate(items):
+        if isinstance(item, str):
+            item = {"question": item}
+        elif not isinstance(item, dict):
+            # the rest of the batch still runs, this item gets an error line
+            jobs.append({"index": index, "id": None, "error": "Each question must be a string or an object"})
+            continue
+        jobs.append({
+            "index": index,
+            "id": item.get("id"),
+            "question": item.get("question"),
+            "language": item.get("language", default_language),
+            "top_k": item.get("top_k", default_top_k),
+            "filters": item.get("filters", default_filters),
+        })
+
+    def line(job, payload):
+        payload = dict(payload, index=job["index"])
+        if job["id"] is not None:
+            payload["id"] = job["id"]
+        return json.dumps(payload, ensure_ascii=False) + "\n"
+
+    def failed(job, error):
+        return line(job, {"success": False, "error": str(error), "question": job.get("question")})
+
+    def validate(job):
+        """Error message for a malformed item, None if it can be answered"""
+        if "error" in job:
+            return job["error"]
+        if not job["question"] or not isinstance(job["question"], str):
+            return "Question is required"
+        top_k = job["top_k"]
+        if not isinstance(top_k, int) or isinstance(top_k, bool) or top_k < 1:
+            return "top_k must be a positive integer"
+        try:
+            job["filters"] = parse_filters(job["filters"])
+        except ValueError as e:
+            return str(e)
+        return None
+
+    def answer_job(job):
+        if not job["docs"]:
+            return {"success": False, "error": "No relevant documents found", "question": job["question"]}
+        result, coalesced = query_flight.do(job["cache_key"], lambda: generate_answer(
+            job["question"], job["language"], job["docs"], job["cache_key"], job["cache_scope"], job["vector"]
+        ))
+        return dict(result, question=job["question"], coalesced=coalesced)
+
+    index_db, version = served
+
+    def generate():
+        valid = []
+        for job in jobs:
+            error = validate(job)
+            if error:
+                yield failed(job, error)
+            else:
+                valid.append(job)
+
+        sent = set()  # indexes already answered from the cache
+        pending = []
+        try:
+            # 1. همه سوال‌ها با هم embed میشن
+            with metrics.span("embed"):
+                vectors = embeddings.embed_documents([job["question"] for job in valid])
+
+            # 2. Cache check for every item
+            for job, vector in zip(valid, vectors):
+                job["vector"] = vector
+                job["cache_key"] = make_cache_key(job["question"], job["language"], job["top_k"], version,
+                                                  filters_key(job["filters"]))
+                job["cache_scope"] = (job["language"], job["top_k"], version, filters_key(job["filters"]))
+                if use_cache:
+                    with metrics.span("cache"):
+                        cached, hit, _ = response_cache.lookup(job["cache_key"], job["cache_scope"], lambda v=vector: v)
+                    metrics.record_cache(hit)
+                    if cached:
+                        sent.add(job["index"])
+                        yield line(job, dict(cached, question=job["question"], cached=True, cache_hit=hit))
+                        continue
+                pending.append(job)
+        except Exception as e:
+            logger.error(f"❌ Error preparing batch: {e}")
+            for job in valid:
+                if job["index"] not in sent:
+                    yield failed(job, e)
+            return
+
+        # 3. Bulk retrieval, one vector-store call per top_k and filters; a failing group only fails its items
+        groups = {}
+        for job in pending:
+            groups.setdefault((job["top_k"], filters_key(job["filters"])), []).append(job)
+        answerable = []
+        for (top_k, _), group in groups.items():
+            try:
+                with metrics.span("retrieve"):
+                    results = search_by_vectors(
+                        index_db, [job["vector"] for job in group], top_k, [job["question"] for job in group],
+                        group[0]["filters"]
+                    )
+            except Exception as e:
+                logger.error(f"❌ Error retrieving batch items: {e}")
+                for job in group:
+                    yield failed(job, e)
+                continue
+            for job, docs in zip(group, results):
+                job["docs"] = docs
+                answerable.append(job)
+
+        # 4. OpenAI calls with bounded concurrency, streamed back as they finish
+        logger.info(f"📦 Batch: {len(valid)} questions, {len(pending)} cache misses, concurrency {concurrency}")
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            futures = {pool.submit(answer_job, job): job for job in answerable}
+            for future in as_completed(futures):
+                job = futures[future]
+                try:
+                    yield line(job, future.result())
+                except Exception as e:
+                    logger.error(f"❌ Error answering batch item {job['index']}: {e}")
+                    yield failed(job, e)
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
 
 @app.route('/search', methods=['POST'])
 @limiter.limit("60 per minute")
@@ -265,7 +568,8 @@ def search():
     Request body:
     {
         "query": "aspirin",
-        "top_k": 5
+        "top_k": 5,
+        "filters": {"subject": "pharmacology", "language": "en"}  // optional, see GET /filters
     }
     """
     try:
@@ -281,21 +585,18 @@ def search():
 
         if not query_text:
             return jsonify({"error": "Query is required"}), 400
+        try:
+            filters = parse_filters(data.get('filters'))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
 
         logger.info(f"🔍 Searching for: {query_text[:50]}...")
 
         # Search for relevant documents
-        docs = db.similarity_search(query_text, k=top_k)
+        docs, _ = retrieve(db, embeddings, query_text, top_k, filters=filters)
 
         # Prepare results
-        results = [
-            {
-                "content": doc.page_content[:500] + "...",
-                "source": os.path.basename(doc.metadata.get('source', 'Unknown')),
-                "page": doc.metadata.get('page', None)
-            }
-            for doc in docs
-        ]
+        results = format_search_results(docs)
 
         logger.info(f"✅ Found {len(results)} documents")
         return jsonify({
@@ -312,6 +613,25 @@ def search():
             "error": str(e)
         }), 500
 
+@app.route('/filters', methods=['GET'])
+def list_filters():
+    """Values the "filters" of /query and /search can take, with the number of chunks of each"""
+    if not db:
+        return jsonify({"success": False, "error": "Database not loaded"}), 503
+    metadata = open_metadata_index(index_location(index_version)[0])
+    if metadata is None:
+        return jsonify({
+            "success": False,
+            "error": "No metadata index, run: python metadata_index.py build"
+        }), 404
+    return jsonify({
+        "success": True,
+        "index_version": index_version,
+        "values": metadata.values(),
+        "page": "[first, last] or a single page number",
+        "shards": metadata.shards["field"] if metadata.shards else None
+    })
+
 @app.route('/cache/clear', methods=['POST'])
 def clear_cache():
     """Clear response cache"""
@@ -319,29 +639,74 @@ def clear_cache():
     logger.info("🗑️ Cache cleared")
     return jsonify({
         "success": True,
-        "message": "Cache cleared"
+        "message": "Cache cleared",
+        "scope": "all workers" if response_cache.backend.shared else "this worker"
     })
 
 @app.route('/cache/stats', methods=['GET'])
 def cache_stats():
     """Get cache statistics"""
+    stats = response_cache.stats()
+    stats["coalescing"] = query_flight.stats()
+    stats["llm"] = client.stats() if client else None
+    stats["index"] = {"version": index_version, "watch_interval": index_watcher.interval,
+                      "watch_error": index_watcher.error}
+    if db:
+        stats.update(embedding_stats(embeddings))
+    return jsonify(stats)
+
+@app.route('/admin/reload', methods=['POST'])
+@limiter.exempt
+def admin_reload():
+    """
+    Hot-swap this worker to another index snapshot
+
+    Header: X-Admin-Token: $ADMIN_TOKEN
+    Request body (optional):
+    {
+        "version": "20261017T120000-ab12cd34",  // default: the one in DB_PATH/CURRENT
+        "force": false                          // reload even if it is already served
+    }
+    """
+    token = request.headers.get("X-Admin-Token", "")
+    if not ADMIN_TOKEN or not hmac.compare_digest(token, ADMIN_TOKEN):
+        return jsonify({"success": False, "error": "Forbidden"}), 403
+    if not embeddings:
+        return jsonify({"success": False, "error": "Service not fully initialized"}), 503
+
+    data = request.get_json(silent=True) or {}
+    try:
+        previous, version = reload_index(data.get("version"), data.get("force", False))
+    except Exception as e:
+        logger.error(f"❌ Index reload failed: {e}")
+        return jsonify({"success": False, "error": str(e), "version": index_version}), 500
     return jsonify({
-        "cache_size": len(response_cache),
-        "max_cache_size": MAX_CACHE_SIZE
+        "success": True,
+        "previous": previous,
+        "version": version,
+        "swapped": previous != version or bool(data.get("force")),
+        "scope": "this worker"
     })
 
+@app.route('/metrics', methods=['GET'])
+@limiter.exempt
+def prometheus_metrics():
+    """Latency histograms and counters in the Prometheus text format (see metrics.py)"""
+    return Response(metrics.render(), mimetype=metrics.CONTENT_TYPE)
+
 @app.errorhandler(429)
 def ratelimit_handler(e):
     """Rate limit error handler"""
     logger.warning(f"⚠️ Rate limit exceeded: {request.remote_addr}")
+    metrics.RATE_LIMITED.inc(endpoint=request.endpoint)
     return jsonify({
         "success": False,
         "error": "Rate limit exceeded. Please try again later."
     }), 429
 
 if __name__ == '__main__':
-    if not OPENAI_API_KEY:
-        logger.error("❌ Error: OPENAI_API_KEY not set")
+    if not client:
+        logger.error("❌ Error: OPENAI_API_KEY not set (or LOCAL_LLM_BASE_URL with LLM_ROUTING=local)")
         exit(1)
 
     logger.info("\n" + "="*60)
@@ -350,8 +715,8 @@ if __name__ == '__main__':
     logger.info(f"📍 Server starting on port: {PORT}")
     logger.info(f"🤖 Using model: {MODEL}")
     logger.info(f"💾 Database path: {DB_PATH}")
-    logger.info(f"🔒 Rate limiting: Enabled")
-    logger.info(f"📦 Caching: Enabled (max {MAX_CACHE_SIZE} items)")
+    logger.info(f"🔒 Rate limiting: {'Enabled' if RATELIMIT_ENABLED else 'Disabled (RATELIMIT_ENABLED=false)'}")
+    logger.info(f"📦 Caching: Enabled (max {response_cache.max_bytes // 1024} KB, TTL {response_cache.ttl}s)")
     logger.info("="*60 + "\n")
 
     app.run(host='0.0.0.0', port=PORT, debug=DEBUG)
@@ -0,0 +1,426 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the ingestion, embedding and retrieval hot paths
+
+Runs offline on CPU (the embedding model has to be in the local Hugging Face
+cache) against two corpora:
+
+    synthetic   generated .txt / .docx / .pdf files with pharmacy-like text (fixed seed)
+    sample      the supported files in data/
+
+and measures
+
+    loader      files/s and MB/s per file type (dataset.load_file)
+    splitter    chunks/s (same splitter settings as dataset.py)
+    embedding   vectors/s at several batch sizes (EMBEDDING_BACKEND)
+    search      similarity_search p50 / p99 per backend, corpus size and top_k
+                (synthetic 384-d vectors, so the embedding model isn't in the timing)
+
+Results are written as JSON and can be compared with a saved baseline;
+regressions beyond --tolerance make the command exit with status 1:
+
+    python benchmark.py run --out benchmark_results.json --save-baseline   # once, on the reference setup
+    python benchmark.py run --baseline benchmark_baseline.json              # after changing requirements
+    python benchmark.py compare benchmark_results.json benchmark_baseline.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import zipfile
+from importlib import metadata
+
+import numpy as np
+
+# بنچمارک باید بدون اینترنت اجرا بشه: مدل فقط از cache محلی
+os.environ.setdefault("HF_HUB_OFFLINE", "1")
+
+from dataset import CHUNK_OVERLAP, CHUNK_SIZE, MODEL_NAME, SUPPORTED_EXTENSIONS, data_path, load_file
+
+DEFAULT_SIZES = (1000, 10000, 50000)
+DEFAULT_TOP_K = (1, 5, 20)
+DEFAULT_BATCH_SIZES = (1, 8, 32, 64)
+DEFAULT_BACKENDS = ("chroma", "mmap", "quantized")
+DIM = 384
+SEED = 1234
+
+WORDS = (
+    "aspirin ibuprofen paracetamol metformin amoxicillin warfarin insulin atorvastatin omeprazole "
+    "tablet capsule suspension emulsion ointment injection dose mg daily twice hepatic renal "
+    "clearance half-life absorption distribution metabolism excretion bioavailability receptor "
+    "agonist antagonist inhibitor contraindication interaction pregnancy pediatric elderly "
+    "pharmacokinetics pharmacodynamics formulation excipient stability dissolution patient"
+).split()
+
+
+def synthetic_text(rng, words):
+    sentences = []
+    while sum(len(s) for s in sentences) < words * 7:
+        sentence = " ".join(rng.choice(WORDS) for _ in range(rng.randint(8, 20)))
+        sentences.append(sentence.capitalize() + ".")
+    return " ".join(sentences)
+
+
+def write_docx(path, paragraphs):
+    """Minimal .docx (what docx2txt reads: word/document.xml)"""
+    body = "".join(f"<w:p><w:r><w:t>{p}</w:t></w:r></w:p>" for p in paragraphs)
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as docx:
+        docx.writestr("[Content_Types].xml", (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/word/document.xml" ContentType="application/vnd.openxmlformats-'
+            'officedocument.wordprocessingml.document.main+xml"/></Types>'))
+        docx.writestr("_rels/.rels", (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/'
+            'relationships/officeDocument" Target="word/document.xml"/></Relationships>'))
+        docx.writestr("word/_rels/document.xml.rels", (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships"/>'))
+        docx.writestr("word/document.xml", (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">'
+            f'<w:body>{body}</w:body></w:document>'))
+
+
+def write_pdf(path, lines, lines_per_page=45):
+    """Minimal text PDF (Helvetica, ASCII text), one content stream per page"""
+    pages = [lines[i:i + lines_per_page] for i in range(0, len(lines), lines_per_page)] or [[]]
+    objects = {1: b"<< /Type /Catalog /Pages 2 0 R >>", 3: b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"}
+    kids = []
+    for i, page_lines in enumerate(pages):
+        page_id, content_id = 4 + 2 * i, 5 + 2 * i
+        kids.append(f"{page_id} 0 R")
+        text = "".join(
+            "(" + line.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)") + ") Tj T* "
+            for line in page_lines
+        )
+        stream = f"BT /F1 10 Tf 12 TL 40 800 Td {text}ET".encode("latin-1", "replace")
+        objects[page_id] = (f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+                            f"/Resources << /Font << /F1 3 0 R >> >> /Contents {content_id} 0 R >>").encode()
+        objects[content_id] = b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream"
+    objects[2] = f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {len(pages)} >>".encode()
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = {}
+    for number in sorted(objects):
+        offsets[number] = len(out)
+        out += b"%d 0 obj\n" % number + objects[number] + b"\nendobj\n"
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    for number in sorted(objects):
+        out += b"%010d 00000 n \n" % offsets[number]
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    with open(path, "wb") as fh:
+        fh.write(out)
+
+
+def make_synthetic_corpus(out_dir, files_per_type, words_per_file=3000, seed=SEED):
+    rng = random.Random(seed)
+    os.makedirs(out_dir, exist_ok=True)
+    for i in range(files_per_type):
+        text = synthetic_text(rng, words_per_file)
+        paragraphs = [text[j:j + 600] for j in range(0, len(text), 600)]
+        with open(os.path.join(out_dir, f"synthetic_{i:03d}.txt"), "w", encoding="utf-8") as fh:
+            fh.write("\n\n".join(paragraphs))
+        write_docx(os.path.join(out_dir, f"synthetic_{i:03d}.docx"), paragraphs)
+        write_pdf(os.path.join(out_dir, f"synthetic_{i:03d}.pdf"), [text[j:j + 95] for j in range(0, len(text), 95)])
+    return out_dir
+
+
+def corpus_files(directory):
+    return [os.path.join(directory, f) for f in sorted(os.listdir(directory)) if f.endswith(SUPPORTED_EXTENSIONS)]
+
+
+def metric(value, unit, higher_is_better=True):
+    return {"value": round(value, 4), "unit": unit, "higher_is_better": higher_is_better}
+
+
+def best_time(func, repeats):
+    """Fastest of `repeats` runs (least disturbed by other processes) and the last result"""
+    best, result = None, None
+    for _ in range(repeats):
+        started = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def bench_loaders(name, files, repeats, results):
+    """Loader throughput per file type; returns the loaded documents for the splitter"""
+    documents = []
+    for extension in SUPPORTED_EXTENSIONS:
+        group = [path for path in files if path.endswith(extension)]
+        if not group:
+            continue
+        size_mb = sum(os.path.getsize(path) for path in group) / 2 ** 20
+        elapsed, loaded = best_time(lambda: [doc for path in group for doc in load_file(path, path)], repeats)
+        documents.extend(loaded)
+        key = f"loader.{name}.{extension.lstrip('.')}"
+        results[f"{key}.files_per_s"] = metric(len(group) / elapsed, "files/s")
+        results[f"{key}.mb_per_s"] = metric(size_mb / elapsed, "MB/s")
+        print(f"📂 {key}: {len(group)} files, {len(group) / elapsed:.1f} files/s, {size_mb / elapsed:.2f} MB/s")
+    return documents
+
+
+def bench_splitter(name, documents, repeats, results):
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+    splitter = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
+    elapsed, chunks = best_time(lambda: splitter.split_documents(documents), repeats)
+    size_mb = sum(len(doc.page_content.encode("utf-8")) for doc in documents) / 2 ** 20
+    results[f"splitter.{name}.chunks_per_s"] = metric(len(chunks) / elapsed, "chunks/s")
+    results[f"splitter.{name}.mb_per_s"] = metric(size_mb / elapsed, "MB/s")
+    print(f"✂️ splitter.{name}: {len(chunks)} chunks, {len(chunks) / elapsed:.0f} chunks/s")
+    return [chunk.page_content for chunk in chunks]
+
+
+def bench_embedding(texts, batch_sizes, repeats, results):
+    from embedding_backend import EMBEDDING_BACKEND, load_embedding_model
+
+    for batch_size in batch_sizes:
+        model = load_embedding_model(MODEL_NAME, batch_size=batch_size)
+        model.embed_documents(texts[:batch_size])  # warm-up
+        elapsed, _ = best_time(lambda: model.embed_documents(texts), repeats)
+        key = f"embedding.{EMBEDDING_BACKEND}.batch{batch_size}.vectors_per_s"
+        results[key] = metric(len(texts) / elapsed, "vectors/s")
+        print(f"🧠 {key}: {len(texts) / elapsed:.1f}")
+
+
+class PrecomputedEmbeddings:
+    """Query embeddings looked up from a table: similarity_search() without the model cost"""
+
+    def __init__(self, vectors):
+        self.vectors = vectors
+
+    def embed_query(self, text):
+        return self.vectors[text]
+
+    def embed_documents(self, texts):
+        return [self.vectors[text] for text in texts]
+
+
+def synthetic_vectors(count, rng, clusters=64):
+    """Clustered unit vectors, closer to real embeddings than uniform noise"""
+    centers = rng.standard_normal((clusters, DIM)).astype(np.float32)
+    vectors = centers[rng.integers(0, clusters, count)] + 0.6 * rng.standard_normal((count, DIM)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def build_chroma(path, vectors, embeddings, page_size=5000):
+    from langchain_community.vectorstores.chroma import Chroma
+
+    db = Chroma(persist_directory=path, embedding_function=embeddings)
+    for start in range(0, len(vectors), page_size):
+        rows = range(start, min(start + page_size, len(vectors)))
+        db._collection.add(
+            ids=[f"bench-{row}" for row in rows],
+            embeddings=vectors[start:rows.stop].tolist(),
+            documents=[f"synthetic chunk {row}" for row in rows],
+            metadatas=[{"source": f"data/synthetic_{row // 100:05d}.pdf", "page": row % 100} for row in rows],
+        )
+    return db
+
+
+def bench_search(sizes, top_ks, backends, queries, work_dir, results):
+    from vector_index import MmapVectorIndex, export_index
+    from quantized_index import QuantizedVectorIndex, export_quantized
+
+    rng = np.random.default_rng(SEED)
+    for size in sizes:
+        vectors = synthetic_vectors(size, rng)
+        # query = نزدیک یک chunk موجود، مثل یک سوال واقعی
+        picks = rng.integers(0, size, queries)
+        query_vectors = vectors[picks] + 0.3 * rng.standard_normal((queries, DIM)).astype(np.float32)
+        embeddings = PrecomputedEmbeddings({f"q{i}": vector.tolist() for i, vector in enumerate(query_vectors)})
+
+        normalized = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+        exact = np.argsort(-(query_vectors @ normalized.T), axis=1)[:, :max(top_ks)]
+        expected = [[f"bench-{row}" for row in rows] for rows in exact]
+
+        path = os.path.join(work_dir, f"chroma_{size}")
+        chroma = build_chroma(path, vectors, embeddings)
+        stores = {"chroma": chroma}
+        if "mmap" in backends or "quantized" in backends:
+            export_index(chroma, os.path.join(path, "mmap_index"))
+            stores["mmap"] = MmapVectorIndex(os.path.join(path, "mmap_index"), embeddings)
+        if "quantized" in backends:
+            export_quantized(os.path.join(path, "mmap_index"), os.path.join(path, "quantized_index"))
+            stores["quantized"] = QuantizedVectorIndex(os.path.join(path, "quantized_index"), embeddings,
+                                                       float_path=os.path.join(path, "mmap_index"))
+
+        for backend in backends:
+            store = stores[backend]
+            for k in top_ks:
+                for i in range(min(10, queries)):
+                    store.similarity_search(f"q{i}", k=k)  # warm-up
+                latencies = []
+                for i in range(queries):
+                    started = time.perf_counter()
+                    store.similarity_search(f"q{i}", k=k)
+                    latencies.append((time.perf_counter() - started) * 1000)
+                latencies.sort()
+                key = f"search.{backend}.n{size}.k{k}"
+                p50 = statistics.median(latencies)
+                p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+                results[f"{key}.p50_ms"] = metric(p50, "ms", higher_is_better=False)
+                results[f"{key}.p99_ms"] = metric(p99, "ms", higher_is_better=False)
+                print(f"🔍 {key}: p50 {p50:.2f} ms, p99 {p99:.2f} ms")
+                if backend in ("mmap", "quantized"):
+                    # recall@k نسبت به جستجوی کامل float32
+                    hits = sum(
+                        len(set(expected[i][:k]) & {doc.id for doc in store.similarity_search(f"q{i}", k=k)})
+                        for i in range(queries)
+                    )
+                    recall = hits / (queries * min(k, size))
+                    results[f"{key}.recall"] = metric(recall, "ratio")
+                    print(f"🎯 {key}: recall {recall:.3f}")
+        del stores, chroma
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def environment():
+    packages = {}
+    with open("requirements_production.txt", encoding="utf-8") as fh:
+        for line in fh:
+            name = line.split("#")[0].strip().split("==")[0].split(">=")[0].split("<")[0]
+            if name and not name.startswith("-"):
+                name = name.split("+")[0]
+                try:
+                    packages[name] = metadata.version(name)
+                except metadata.PackageNotFoundError:
+                    packages[name] = None
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "embedding_backend": os.getenv("EMBEDDING_BACKEND", "torch"),
+        "packages": packages,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Prints the comparison table, returns the names of regressed metrics
+    (baseline metrics missing from `results` count as regressed)"""
+    regressions = []
+    print(f"\n{'metric':<52} {'baseline':>12} {'current':>12} {'change':>8}")
+    for name, old in sorted(baseline["results"].items()):
+        new = results["results"].get(name)
+        if new is None:
+            # a backend or loader that stopped working must not pass the gate
+            regressions.append(name)
+            print(f"{name:<52} {old['value']:>12.3f} {'missing':>12} {'':>8} ❌")
+            continue
+        if not old["value"]:
+            continue
+        change = (new["value"] - old["value"]) / old["value"]
+        worse = -change if old["higher_is_better"] else change
+        status = "❌" if worse > tolerance else "✅"
+        if worse > tolerance:
+            regressions.append(name)
+        print(f"{name:<52} {old['value']:>12.3f} {new['value']:>12.3f} {change:>+7.1%} {status}")
+    print(f"\n{len(regressions)} regression(s) beyond {tolerance:.0%}")
+    return regressions
+
+
+def run(args):
+    results = {}
+    work_dir = tempfile.mkdtemp(prefix="mia_bench_")
+    try:
+        corpora = {}
+        if args.corpus in ("synthetic", "both"):
+            corpora["synthetic"] = corpus_files(make_synthetic_corpus(os.path.join(work_dir, "synthetic"),
+                                                                      args.files_per_type))
+        if args.corpus in ("sample", "both"):
+            sample = corpus_files(data_path) if os.path.isdir(data_path) else []
+            if sample:
+                corpora["sample"] = sample
+            else:
+                print(f"⚠️ No supported files in {data_path}/, skipping the sample corpus")
+
+        texts = []
+        for name, files in corpora.items():
+            if "loader" in args.only or "splitter" in args.only or "embedding" in args.only:
+                documents = bench_loaders(name, files, args.repeats, results)
+                chunks = bench_splitter(name, documents, args.repeats, results)
+                texts = texts or chunks
+        if "embedding" in args.only:
+            bench_embedding(texts[:args.embed_texts], args.batch_sizes, args.repeats, results)
+        if "search" in args.only:
+            bench_search(args.sizes, args.top_k, args.backends, args.queries, work_dir, results)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "environment": environment(),
+        "settings": {key: value for key, value in vars(args).items() if key != "func"},
+        "results": results,
+    }
+    with open(args.out, "w", encoding="utf-8") as fh:
+        json.dump(report, fh, indent=2)
+    print(f"💾 Results written to {args.out}")
+
+    if args.save_baseline:
+        shutil.copyfile(args.out, args.baseline)
+        print(f"📌 Saved as baseline: {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as fh:
+            if compare(report, json.load(fh), args.tolerance):
+                sys.exit(1)
+
+
+def int_list(value):
+    return [int(part) for part in value.split(",") if part]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks for ingestion, embedding and retrieval")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="run the benchmarks")
+    run_parser.add_argument("--corpus", choices=["synthetic", "sample", "both"], default="both")
+    run_parser.add_argument("--only", type=lambda v: v.split(","), default=["loader", "splitter", "embedding", "search"],
+                            help="comma-separated subset of loader,splitter,embedding,search")
+    run_parser.add_argument("--files-per-type", type=int, default=10)
+    run_parser.add_argument("--embed-texts", type=int, default=256, help="chunks embedded per batch size")
+    run_parser.add_argument("--batch-sizes", type=int_list, default=list(DEFAULT_BATCH_SIZES))
+    run_parser.add_argument("--sizes", type=int_list, default=list(DEFAULT_SIZES), help="corpus sizes for search")
+    run_parser.add_argument("--top-k", type=int_list, default=list(DEFAULT_TOP_K))
+    run_parser.add_argument("--backends", type=lambda v: v.split(","), default=list(DEFAULT_BACKENDS))
+    run_parser.add_argument("--queries", type=int, default=200, help="timed queries per size / top_k")
+    run_parser.add_argument("--repeats", type=int, default=3, help="throughput runs, the best one counts")
+    run_parser.add_argument("--out", default="benchmark_results.json")
+    run_parser.add_argument("--baseline", default="benchmark_baseline.json")
+    run_parser.add_argument("--save-baseline", action="store_true", help="store these results as the baseline")
+    run_parser.add_argument("--tolerance", type=float, default=0.15, help="allowed slowdown before failing")
+    run_parser.add_argument("--quick", action="store_true", help="small sizes for a fast smoke run")
+
+    compare_parser = commands.add_parser("compare", help="compare two result files")
+    compare_parser.add_argument("results")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("--tolerance", type=float, default=0.15)
+
+    args = parser.parse_args()
+    if args.command == "run":
+        if args.quick:
+            args.files_per_type, args.embed_texts, args.queries, args.repeats = 3, 64, 50, 1
+            args.sizes = [size for size in args.sizes if size <= 10000] or [1000]
+        run(args)
+    else:
+        with open(args.results, encoding="utf-8") as fh:
+            current = json.load(fh)
+        with open(args.baseline, encoding="utf-8") as fh:
+            if compare(current, json.load(fh), args.tolerance):
+                sys.exit(1)
@@ -0,0 +1,410 @@
+"""
+Storage backends for the response cache and the rate limiter
+
+Every gunicorn worker has its own memory, so with the default memory://
+backend each worker keeps its own cache and its own rate-limit counters.
+Pointing CACHE_BACKEND_URL at a shared backend makes all workers (and all
+processes on the host) share one cache and one set of limits:
+
+    memory://                         per-process (default)
+    sqlite:////var/tmp/mia_cache.db   one file shared by every process on the host
+    redis://localhost:6379/0          Redis or any Redis-compatible server
+
+RATELIMIT_STORAGE_URI defaults to the same URL, so flask-limiter counts
+requests globally instead of per worker.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+from limits.storage import Storage
+
+CACHE_BACKEND_URL = os.getenv("CACHE_BACKEND_URL", "memory://")
+RATELIMIT_STORAGE_URI = os.getenv("RATELIMIT_STORAGE_URI", CACHE_BACKEND_URL)
+# false only for load tests, where every request comes from the same IP
+RATELIMIT_ENABLED = os.getenv("RATELIMIT_ENABLED", "true").lower() == "true"
+
+
+def _sqlite_path(url):
+    """sqlite:////abs/path.db -> /abs/path.db, sqlite://rel.db -> rel.db"""
+    path = url.split("://", 1)[1]
+    return path[1:] if path.startswith("//") else path
+
+
+def _connect(path):
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+# handles a forked child inherited: closing them there is as unsafe as using them, so they are kept
+_inherited_connections = []
+
+
+class ProcessConnection:
+    """
+    SQLite connection opened on first use in each process. SQLite handles must
+    not be carried across fork(): with gunicorn --preload the master opens the
+    caches, and every worker then opens its own connection instead.
+    """
+
+    def __init__(self, connect):
+        self._connect = connect
+        self._pid = None
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    if self._conn is not None:
+                        _inherited_connections.append(self._conn)
+                    self._conn = self._connect()
+                    self._pid = os.getpid()
+        return self._conn
+
+
+class MemoryBackend:
+    """Per-process LRU store (the old behaviour, minus the FIFO eviction)"""
+
+    shared = False
+
+    def __init__(self):
+        self._entries = OrderedDict()  # key -> (value, size, expires_at, scope, vector)
+        self._bytes = 0
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def _remove(self, key):
+        _, size, _, _, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def get(self, key, now):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[2] < now:
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value, size, expires_at, scope, vector, max_bytes):
+        evicted = 0
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, size, expires_at, scope, vector)
+            self._bytes += size
+            # بیرون انداختن کم‌استفاده‌ترین‌ها تا زیر سقف حجم برسیم
+            while self._bytes > max_bytes:
+                self._remove(next(iter(self._entries)))
+                evicted += 1
+        return evicted
+
+    def scope_vectors(self, scope, now):
+        with self._lock:
+            return [
+                (key, entry[4]) for key, entry in self._entries.items()
+                if entry[3] == scope and entry[4] is not None and entry[2] >= now
+            ]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def size(self):
+        return len(self._entries), self._bytes
+
+    def incr(self, name, amount=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def counters(self):
+        return dict(self._counters)
+
+
+class SQLiteBackend:
+    """One SQLite file shared by all workers on the same host"""
+
+    shared = True
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = ProcessConnection(self._open)
+        self._connection()  # schema (and a bad path) right away, not on the first request
+
+    @property
+    def _conn(self):
+        return self._connection()
+
+    def _open(self):
+        conn = _connect(self.path)
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS response_cache (
+                key TEXT PRIMARY KEY, value TEXT, size INTEGER, expires_at REAL,
+                last_used REAL, scope TEXT, vector BLOB
+            );
+            CREATE INDEX IF NOT EXISTS response_cache_lru ON response_cache(last_used);
+            CREATE INDEX IF NOT EXISTS response_cache_scope ON response_cache(scope);
+            CREATE TABLE IF NOT EXISTS response_cache_counters (name TEXT PRIMARY KEY, value INTEGER);
+        """)
+        return conn
+
+    def get(self, key, now):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, expires_at FROM response_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if row[1] < now:
+                self._conn.execute("DELETE FROM response_cache WHERE key = ?", (key,))
+                return None
+            self._conn.execute("UPDATE response_cache SET last_used = ? WHERE key = ?", (now, key))
+            return json.loads(row[0])
+
+    def put(self, key, value, size, expires_at, scope, vector, max_bytes):
+        blob = vector.astype(np.float32).tobytes() if vector is not None else None
+        evicted = 0
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO response_cache VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (key, json.dumps(value, ensure_ascii=False), size, expires_at, time.time(), scope, blob),
+                )
+                self._conn.execute("DELETE FROM response_cache WHERE expires_at < ?", (time.time(),))
+                (total,) = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM response_cache").fetchone()
+                while total > max_bytes:
+                    old_key, old_size = self._conn.execute(
+                        "SELECT key, size FROM response_cache ORDER BY last_used LIMIT 1"
+                    ).fetchone()
+                    self._conn.execute("DELETE FROM response_cache WHERE key = ?", (old_key,))
+                    total -= old_size
+                    evicted += 1
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return evicted
+
+    def scope_vectors(self, scope, now):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT key, vector FROM response_cache"
+                " WHERE scope = ? AND vector IS NOT NULL AND expires_at >= ?",
+                (scope, now),
+            ).fetchall()
+        return [(key, np.frombuffer(blob, dtype=np.float32)) for key, blob in rows]
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM response_cache")
+
+    def size(self):
+        with self._lock:
+            count, total = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM response_cache"
+            ).fetchone()
+        return count, total
+
+    def incr(self, name, amount=1):
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO response_cache_counters VALUES (?, ?)"
+                " ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+                (name, amount),
+            )
+
+    def counters(self):
+        with self._lock:
+            return dict(self._conn.execute("SELECT name, value FROM response_cache_counters"))
+
+
+class RedisBackend:
+    """Redis (or any Redis-compatible server) shared by all workers and hosts"""
+
+    shared = True
+    PREFIX = "mia:cache"
+
+    def __init__(self, url):
+        import redis  # optional dependency, only needed for redis:// URLs
+
+        self._redis = redis.Redis.from_url(url)
+
+    def _k(self, *parts):
+        return ":".join((self.PREFIX,) + parts)
+
+    def _forget(self, key):
+        """Drop a key and all of its bookkeeping"""
+        scope = self._redis.hget(self._k("scopes"), key)
+        pipe = self._redis.pipeline()
+        pipe.delete(self._k("value", key))
+        pipe.zrem(self._k("lru"), key)
+        pipe.hdel(self._k("sizes"), key)
+        pipe.hdel(self._k("scopes"), key)
+        if scope is not None:
+            pipe.hdel(self._k("vectors", scope.decode()), key)
+        pipe.execute()
+
+    def get(self, key, now):
+        raw = self._redis.get(self._k("value", key))
+        if raw is None:
+            # expired by the Redis TTL (or never set)
+            self._forget(key)
+            return None
+        self._redis.zadd(self._k("lru"), {key: now})
+        return json.loads(raw)
+
+    def put(self, key, value, size, expires_at, scope, vector, max_bytes):
+        ttl = max(1, int(expires_at - time.time()))
+        pipe = self._redis.pipeline()
+        pipe.set(self._k("value", key), json.dumps(value, ensure_ascii=False), ex=ttl)
+        pipe.zadd(self._k("lru"), {key: time.time()})
+        pipe.hset(self._k("sizes"), key, size)
+        pipe.hset(self._k("scopes"), key, scope)
+        if vector is not None:
+            pipe.hset(self._k("vectors", scope), key, vector.astype(np.float32).tobytes())
+        pipe.execute()
+
+        evicted = 0
+        sizes = {k.decode(): int(v) for k, v in self._redis.hgetall(self._k("sizes")).items()}
+        total = sum(sizes.values())
+        while total > max_bytes:
+            oldest = self._redis.zrange(self._k("lru"), 0, 0)
+            if not oldest:
+                break
+            old_key = oldest[0].decode()
+            self._forget(old_key)
+            total -= sizes.get(old_key, 0)
+            evicted += 1
+        return evicted
+
+    def scope_vectors(self, scope, now):
+        rows = self._redis.hgetall(self._k("vectors", scope))
+        return [(key.decode(), np.frombuffer(blob, dtype=np.float32)) for key, blob in rows.items()]
+
+    def clear(self):
+        keys = list(self._redis.scan_iter(match=self._k("*")))
+        counters = self._k("counters").encode()
+        keys = [k for k in keys if k != counters]
+        if keys:
+            self._redis.delete(*keys)
+
+    def size(self):
+        sizes = self._redis.hvals(self._k("sizes"))
+        return len(sizes), sum(int(v) for v in sizes)
+
+    def incr(self, name, amount=1):
+        self._redis.hincrby(self._k("counters"), name, amount)
+
+    def counters(self):
+        return {k.decode(): int(v) for k, v in self._redis.hgetall(self._k("counters")).items()}
+
+
+def backend_from_url(url=CACHE_BACKEND_URL):
+    if url.startswith("memory://"):
+        return MemoryBackend()
+    if url.startswith("sqlite://"):
+        return SQLiteBackend(_sqlite_path(url))
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisBackend(url)
+    raise ValueError(f"Unsupported cache backend URL: {url}")
+
+
+class SQLiteLimiterStorage(Storage):
+    """
+    flask-limiter storage on a shared SQLite file (fixed-window strategy).
+    Registered for sqlite:// URIs simply by importing this module.
+    """
+
+    STORAGE_SCHEME = ["sqlite"]
+
+    def __init__(self, uri=None, wrap_exceptions=False, **options):
+        super().__init__(uri, wrap_exceptions=wrap_exceptions, **options)
+        self._lock = threading.Lock()
+        self._path = _sqlite_path(uri)
+        self._connection = ProcessConnection(self._open)
+        self._connection()
+
+    @property
+    def _conn(self):
+        return self._connection()
+
+    def _open(self):
+        conn = _connect(self._path)
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS rate_limits (key TEXT PRIMARY KEY, value INTEGER, expires_at REAL)"
+        )
+        return conn
+
+    @property
+    def base_exceptions(self):
+        return sqlite3.Error
+
+    def incr(self, key, expiry, elastic_expiry=False, amount=1):
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT value, expires_at FROM rate_limits WHERE key = ?", (key,)
+                ).fetchone()
+                if row is None or row[1] <= now:
+                    value, expires_at = amount, now + expiry
+                else:
+                    value, expires_at = row[0] + amount, row[1]
+                    if elastic_expiry:
+                        expires_at = now + expiry
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO rate_limits VALUES (?, ?, ?)", (key, value, expires_at)
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return value
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM rate_limits WHERE key = ? AND expires_at > ?", (key, time.time())
+            ).fetchone()
+        return row[0] if row else 0
+
+    def get_expiry(self, key):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT expires_at FROM rate_limits WHERE key = ? AND expires_at > ?", (key, time.time())
+            ).fetchone()
+        return row[0] if row else time.time()
+
+    def check(self):
+        try:
+            with self._lock:
+                self._conn.execute("SELECT 1")
+            return True
+        except sqlite3.Error:
+            return False
+
+    def reset(self):
+        with self._lock:
+            count = self._conn.execute("DELETE FROM rate_limits").rowcount
+        return count
+
+    def clear(self, key):
+        with self._lock:
+            self._conn.execute("DELETE FROM rate_limits WHERE key = ?", (key,))
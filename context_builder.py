@@ -0,0 +1,154 @@
+"""
+Context assembly: retrieved chunks -> prompt context
+
+dataset.py splits with chunk_overlap=200, so neighbouring chunks of the same
+file repeat text, and a large top_k used to go straight into the prompt.
+Before the chunks are joined they are:
+
+1. trimmed: text already present in a higher-ranked chunk of the same source
+   (overlap at either end, or full containment) is cut away
+2. reordered with MMR: rank-based relevance vs. word-set (Jaccard) similarity
+   to the chunks already chosen; near-duplicates are dropped
+3. packed into CONTEXT_MAX_TOKENS, counted with tiktoken when it is installed
+"""
+
+import os
+import re
+
+from langchain_core.documents import Document
+
+from hybrid_search import tokenize
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# 0 = no token budget
+CONTEXT_MAX_TOKENS = int(os.getenv("CONTEXT_MAX_TOKENS", 3000))
+# 1 = relevance only, 0 = diversity only
+CONTEXT_MMR_LAMBDA = float(os.getenv("CONTEXT_MMR_LAMBDA", 0.7))
+NEAR_DUPLICATE_JACCARD = 0.9
+MIN_OVERLAP_CHARS = 50
+SEPARATOR = "\n\n---\n\n"
+
+_encoding = None
+_WORD_RE = re.compile(r"\w+|[^\w\s]")
+
+
+def _get_encoding():
+    global _encoding
+    if _encoding is None:
+        _encoding = False
+        if tiktoken is not None:
+            try:
+                _encoding = tiktoken.encoding_for_model(os.getenv("MODEL", "gpt-4o-mini"))
+            except KeyError:
+                # مدل ناشناخته (مثلاً مدل محلی در llm_router.py)
+                try:
+                    _encoding = tiktoken.get_encoding("o200k_base")
+                except Exception:
+                    _encoding = False
+            except Exception:
+                # فایل BPE دانلود نشد (مثلاً سرور بدون اینترنت)
+                _encoding = False
+    return _encoding
+
+
+def count_tokens(text):
+    encoding = _get_encoding()
+    if encoding:
+        return len(encoding.encode(text))
+    # بدون tiktoken: تقریب با تعداد کلمه و علامت
+    return len(_WORD_RE.findall(text)) * 4 // 3 + 1
+
+
+def truncate_to_tokens(text, max_tokens):
+    encoding = _get_encoding()
+    if encoding:
+        return encoding.decode(encoding.encode(text)[:max_tokens])
+    return text[:len(text) * max_tokens // max(count_tokens(text), 1)]
+
+
+def _overlap(head, tail):
+    """Length of the longest suffix of `head` that is also a prefix of `tail`"""
+    for size in range(min(len(head), len(tail)), MIN_OVERLAP_CHARS - 1, -1):
+        if head.endswith(tail[:size]):
+            return size
+    return 0
+
+
+def strip_overlaps(docs):
+    """Cut text that a higher-ranked chunk of the same source already contains"""
+    kept = []
+    for doc in docs:
+        text = doc.page_content
+        for other in kept:
+            if other.metadata.get("source") != doc.metadata.get("source"):
+                continue
+            if text in other.page_content:
+                text = ""
+                break
+            text = text[_overlap(other.page_content, text):]
+            cut = _overlap(text, other.page_content)
+            if cut:
+                text = text[:-cut]
+        text = text.strip()
+        if text == doc.page_content.strip():
+            kept.append(doc)
+        elif len(text) >= MIN_OVERLAP_CHARS:
+            kept.append(Document(page_content=text, metadata=doc.metadata))
+    return kept
+
+
+def _jaccard(a, b):
+    return len(a & b) / len(a | b) if a and b else 0.0
+
+
+def mmr_order(docs, mmr_lambda=CONTEXT_MMR_LAMBDA):
+    """Maximal marginal relevance order; input order is the relevance ranking"""
+    words = [set(tokenize(doc.page_content)) for doc in docs]
+    relevance = [1 - i / len(docs) for i in range(len(docs))]
+    selected = []
+    remaining = list(range(len(docs)))
+    while remaining:
+        redundancy = {
+            i: max((_jaccard(words[i], words[j]) for j in selected), default=0.0) for i in remaining
+        }
+        best = max(remaining, key=lambda i: mmr_lambda * relevance[i] - (1 - mmr_lambda) * redundancy[i])
+        remaining.remove(best)
+        if redundancy[best] < NEAR_DUPLICATE_JACCARD:
+            selected.append(best)
+    return [docs[i] for i in selected]
+
+
+def assemble_context(docs, max_tokens=CONTEXT_MAX_TOKENS, mmr_lambda=CONTEXT_MMR_LAMBDA):
+    """The chunks that go into the prompt, trimmed, diversified and within max_tokens"""
+    docs = mmr_order(strip_overlaps(docs), mmr_lambda)
+    if not max_tokens:
+        return docs
+
+    separator = count_tokens(SEPARATOR)
+    packed = []
+    used = 0
+    for doc in docs:
+        cost = count_tokens(doc.page_content) + (separator if packed else 0)
+        if used + cost <= max_tokens:
+            packed.append(doc)
+            used += cost
+        elif not packed:
+            # حتی اولین chunk جا نمیشه: کوتاهش می‌کنیم
+            packed.append(Document(
+                page_content=truncate_to_tokens(doc.page_content, max_tokens), metadata=doc.metadata
+            ))
+            used = max_tokens
+    return packed
+
+
+def join_context(docs):
+    """Prompt context of already assembled chunks"""
+    return SEPARATOR.join(doc.page_content for doc in docs)
+
+
+def build_context(docs, max_tokens=CONTEXT_MAX_TOKENS):
+    return join_context(assemble_context(docs, max_tokens))
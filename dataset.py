@@ -1,58 +1,294 @@
 from langchain_community.document_loaders import PyPDFLoader, TextLoader, Docx2txtLoader
 from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_community.vectorstores.chroma import Chroma
+from embedding_cache import with_cache
+from embedding_backend import embedding_cache_name, load_embedding_model
+from vector_index import INDEX_DIR_NAME, export_index
+from quantized_index import QUANTIZED_DIR_NAME, directory_size, export_quantized
+from hybrid_search import build_lexical_index
+from metadata_index import (
+    INDEX_SHARD_BY, build_metadata_index, detect_language, load_subjects, subject_for, subjects_hash
+)
+from index_snapshots import INDEX_SNAPSHOTS_KEEP, publish_snapshot
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import argparse
+import hashlib
+import json
+import itertools
+import multiprocessing
 import os
 
 data_path = "data"
 db_path = "vector_db"
+manifest_path = os.path.join(db_path, "manifest.json")
+
+MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 200
+SUPPORTED_EXTENSIONS = (".pdf", ".txt", ".docx")
+EMBED_BATCH_SIZE = 64
+
+
+def file_hash(path):
+    """SHA-256 of the file contents, read in 1 MB blocks"""
+    h = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for block in iter(lambda: fh.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def chunk_ids(name, content_hash, count):
+    """Stable chunk IDs: same file name + same content -> same IDs"""
+    prefix = hashlib.sha1(f"{name}:{content_hash}".encode()).hexdigest()[:16]
+    return [f"{prefix}-{i}" for i in range(count)]
+
+
+def new_manifest():
+    return {
+        "model": MODEL_NAME,
+        "chunk_size": CHUNK_SIZE,
+        "chunk_overlap": CHUNK_OVERLAP,
+        "files": {},
+    }
+
+
+def load_manifest():
+    """Manifest of the last build, or None if there is none"""
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, encoding="utf-8") as fh:
+        return json.load(fh)
+
+
+def save_manifest(manifest):
+    """Write the manifest atomically so a crash never leaves half a file"""
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as fh:
+        json.dump(manifest, fh, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, manifest_path)
 
-os.makedirs(data_path, exist_ok=True)
 
-docs = []
+def manifest_matches_settings(manifest):
+    """Chunks are only reusable if they were built with the same model and splitter"""
+    return (
+        manifest.get("model") == MODEL_NAME
+        and manifest.get("chunk_size") == CHUNK_SIZE
+        and manifest.get("chunk_overlap") == CHUNK_OVERLAP
+    )
 
-print("📂 Loading documents...")
-for f in os.listdir(data_path):
-    path = os.path.join(data_path, f)
+
+def load_file(f, path):
+    """Load one file with the matching loader"""
+    if f.endswith(".pdf"):
+        return PyPDFLoader(path).load()
+    elif f.endswith(".txt"):
+        return TextLoader(path).load()
+    elif f.endswith(".docx"):
+        return Docx2txtLoader(path).load()
+    raise ValueError(f"Unsupported file type: {f}")
+
+
+def load_and_split(f, path):
+    """Worker: extract and chunk one file. Returns (file, chunks, error)"""
     try:
-        if f.endswith(".pdf"):
-            loaded = PyPDFLoader(path).load()
-        elif f.endswith(".txt"):
-            loaded = TextLoader(path).load()
-        elif f.endswith(".docx"):
-            loaded = Docx2txtLoader(path).load()
+        loaded = load_file(f, path)
+    except Exception as e:
+        return f, None, str(e)
+
+    if not loaded:
+        print(f"⚠️ No text found in {f}")
+
+    try:
+        splitter = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
+        chunks = splitter.split_documents(loaded)
+        chunks = [c for c in chunks if c.page_content.strip()]  # حذف تکه‌های خالی
+        for c in chunks:
+            # برای فیلتر در درخواست‌ها (metadata_index.py)
+            c.metadata["file"] = f
+            c.metadata["language"] = detect_language(c.page_content)
+    except Exception as e:
+        # یک سند خراب نباید کل pool و build رو از کار بندازه
+        return f, None, f"split failed: {e}"
+    return f, chunks, None
+
+
+def stream_results(pool, fn, items, max_in_flight):
+    """Like pool.map, but yields results as they finish and never keeps more
+    than max_in_flight files (and their chunks) in memory at once"""
+    items = iter(items)
+    in_flight = set()
+    while True:
+        for item in itertools.islice(items, max_in_flight - len(in_flight)):
+            in_flight.add(pool.submit(fn, *item))
+        if not in_flight:
+            return
+        done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+        for future in done:
+            yield future.result()
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(itertools.islice(iterator, size)):
+        yield batch
+
+
+def add_in_batches(db, chunks, ids, batch_size):
+    """Embed and write chunks batch by batch instead of all at once"""
+    for batch in batched(zip(chunks, ids), batch_size):
+        db.add_texts(
+            texts=[c.page_content for c, _ in batch],
+            metadatas=[c.metadata for c, _ in batch],
+            ids=[i for _, i in batch],
+        )
+
+
+def retag_chunks(db, files, subjects):
+    """Rewrite the file / subject / language metadata of already indexed chunks without
+    re-embedding them: after subjects.json changed, or for chunks from before the filters"""
+    collection = db._collection
+    for f, entry in sorted(files.items()):
+        for ids in batched(entry["chunk_ids"], 500):
+            found = collection.get(ids=ids, include=["documents", "metadatas"])
+            if not found["ids"]:
+                continue
+            collection.update(ids=found["ids"], metadatas=[
+                dict(metadata or {}, file=f, subject=subject_for(f, subjects),
+                     language=(metadata or {}).get("language") or detect_language(text or ""))
+                for text, metadata in zip(found["documents"], found["metadatas"])
+            ])
+
+
+def scan_data_dir():
+    """{file name: path} for every supported file in data/"""
+    files = {}
+    for f in sorted(os.listdir(data_path)):
+        if f.endswith(SUPPORTED_EXTENSIONS):
+            files[f] = os.path.join(data_path, f)
         else:
             print(f"⚠️ Skipping unsupported file: {f}")
-            continue
+    return files
 
-        if not loaded:
-            print(f"⚠️ No text found in {f}")
-        else:
-            docs.extend(loaded)
-    except Exception as e:
-        print(f"❌ Error loading {f}: {e}")
 
-print(f"📄 Loaded {len(docs)} documents")
+def open_db(embeddings):
+    return Chroma(persist_directory=db_path, embedding_function=embeddings)
 
-# تقسیم متن‌ها
-splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-chunks = splitter.split_documents(docs)
-chunks = [c for c in chunks if c.page_content.strip()]  # حذف تکه‌های خالی
 
-print(f"🧩 Split into {len(chunks)} chunks after cleaning")
+def build(full=False, workers=None, batch_size=EMBED_BATCH_SIZE, keep_snapshots=INDEX_SNAPSHOTS_KEEP,
+          shard_by=INDEX_SHARD_BY):
+    os.makedirs(data_path, exist_ok=True)
+    os.makedirs(db_path, exist_ok=True)
 
-if not chunks:
-    raise ValueError("❌ هیچ متنی برای embedding پیدا نشد. فایل‌هات رو بررسی کن.")
+    embeddings = with_cache(
+        load_embedding_model(MODEL_NAME, batch_size=batch_size),
+        embedding_cache_name(MODEL_NAME),
+    )
+    db = open_db(embeddings)
 
-# ساخت embedding
-embeddings = HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2")
+    manifest = load_manifest()
+    if manifest is None or full or not manifest_matches_settings(manifest):
+        # بدون manifest نمی‌دونیم چه ID هایی داخل دیتابیس هست، پس از صفر می‌سازیم
+        print("♻️ Full rebuild")
+        db.delete_collection()
+        db = open_db(embeddings)
+        manifest = new_manifest()
+
+    known = manifest["files"]
+    current = scan_data_dir()
+    subjects = load_subjects()
+
+    # حذف chunk های فایل‌هایی که دیگه وجود ندارن
+    for f in sorted(set(known) - set(current)):
+        ids = known.pop(f)["chunk_ids"]
+        if ids:
+            db.delete(ids=ids)
+        save_manifest(manifest)
+        print(f"🗑️ Removed {len(ids)} chunks of deleted file: {f}")
+
+    hashes = {f: file_hash(path) for f, path in current.items()}
+    pending = [f for f in current if f not in known or known[f]["hash"] != hashes[f]]
+
+    # subject ها در metadata هر chunk ذخیره میشن، پس با تغییر subjects.json دوباره برچسب می‌خورن
+    tag = subjects_hash(subjects)
+    if manifest.get("subjects") != tag:
+        stale = {f: entry for f, entry in known.items() if f not in pending and entry["chunk_ids"]}
+        if stale:
+            print(f"🏷️ Re-tagging {sum(len(e['chunk_ids']) for e in stale.values())} chunks of {len(stale)} files "
+                  "(subjects.json changed, or chunks without filter metadata)")
+            retag_chunks(db, stale, subjects)
+        manifest["subjects"] = tag
+        save_manifest(manifest)
+
+    workers = workers or os.cpu_count() or 1
+    print(f"📂 Loading {len(pending)} new or changed documents with {workers} workers...")
+    errors = {}
+    # spawn: مدل embedding (torch / OpenMP) قبلاً لود شده و fork بعد از اون ممکنه قفل کنه
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        # هر فایلی که آماده شد همون لحظه وارد دیتابیس میشه
+        jobs = ((f, current[f]) for f in pending)
+        for f, chunks, error in stream_results(pool, load_and_split, jobs, workers * 2):
+            if error:
+                print(f"❌ Error processing {f}: {error}")
+                errors[f] = error
+                continue
+
+            for c in chunks:
+                c.metadata["subject"] = subject_for(f, subjects)
+            entry = known.get(f)
+            ids = chunk_ids(f, hashes[f], len(chunks))
+            if entry and entry["chunk_ids"]:
+                db.delete(ids=entry["chunk_ids"])
+            add_in_batches(db, chunks, ids, batch_size)
+
+            known[f] = {"hash": hashes[f], "chunk_ids": ids}
+            save_manifest(manifest)
+            print(f"🧩 {f}: {len(chunks)} chunks")
+
+    total = sum(len(entry["chunk_ids"]) for entry in known.values())
+    print(f"📄 {len(pending) - len(errors)} files (re)indexed, {len(known)} files / {total} chunks in the index")
+
+    if errors:
+        print(f"⚠️ {len(errors)} files failed to load or split:")
+        for f, error in sorted(errors.items()):
+            print(f"  - {f}: {error}")
+
+    if not total:
+        raise ValueError("❌ هیچ متنی برای embedding پیدا نشد. فایل‌هات رو بررسی کن.")
+
+    db.persist()
+    print("✅ دیتاست ساخته شد و در", db_path, "ذخیره شد.")
+
+    # خروجی memory-mapped برای RETRIEVAL_BACKEND=mmap
+    count = export_index(db, os.path.join(db_path, INDEX_DIR_NAME), MODEL_NAME, shard_by=shard_by or None)
+    print(f"🗺️ Exported {count} vectors to {os.path.join(db_path, INDEX_DIR_NAME)}"
+          + (f", sharded by {shard_by}" if shard_by else ""))
+    # int8 + فشرده برای RETRIEVAL_BACKEND=quantized (حافظه کمتر برای هر worker)
+    quantized_dir = os.path.join(db_path, QUANTIZED_DIR_NAME)
+    export_quantized(os.path.join(db_path, INDEX_DIR_NAME), quantized_dir)
+    print(f"🗜️ Quantized index: {directory_size(quantized_dir) / 1e6:.1f} MB in {quantized_dir}")
+    # ایندکس BM25 برای RETRIEVAL_MODE=hybrid
+    print(f"🔤 Lexical index: {build_lexical_index(db_path)} terms")
+    # فیلتر بر اساس فایل، صفحه، موضوع و زبان
+    values = build_metadata_index(db_path, subjects)
+    print("🏷️ Metadata index: " + ", ".join(f"{n} {field} values" for field, n in values.items()))
+    # نسخه تغییرناپذیر برای سرورها؛ سرور در حال اجرا با /admin/reload یا INDEX_WATCH_INTERVAL عوض میشه
+    version = publish_snapshot(db_path, manifest, keep=keep_snapshots)
+    print(f"📸 Published index snapshot {version}")
+    return errors
 
-# ساخت دیتابیس
-db = Chroma.from_documents(
-    documents=chunks,
-    embedding=embeddings,
-    persist_directory=db_path
-)
 
-db.persist()
-print("✅ دیتاست ساخته شد و در", db_path, "ذخیره شد.")
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build or update the Mia vector database")
+    parser.add_argument("--full", action="store_true", help="rebuild everything from scratch")
+    parser.add_argument("--workers", type=int, default=int(os.getenv("INGEST_WORKERS", 0)) or None,
+                        help="parallel loader processes (default: CPU count)")
+    parser.add_argument("--batch-size", type=int, default=int(os.getenv("EMBED_BATCH_SIZE", EMBED_BATCH_SIZE)),
+                        help="chunks embedded and written per batch")
+    parser.add_argument("--keep-snapshots", type=int, default=INDEX_SNAPSHOTS_KEEP,
+                        help="published index snapshots to keep (including the new one)")
+    parser.add_argument("--shard-by", choices=["", "subject", "language"], default=INDEX_SHARD_BY,
+                        help="group the exported index by subject or language")
+    args = parser.parse_args()
+    build(full=args.full, workers=args.workers, batch_size=args.batch_size, keep_snapshots=args.keep_snapshots,
+          shard_by=args.shard_by)
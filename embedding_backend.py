@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+Embedding backends for all-MiniLM-L6-v2
+
+    EMBEDDING_BACKEND=torch   sentence-transformers on PyTorch (default)
+    EMBEDDING_BACKEND=onnx    ONNX Runtime, no torch needed at serving time
+
+The ONNX path uses the exports published in the model repository
+(onnx/model.onnx, or the int8 onnx/model_quint8_avx2.onnx with
+EMBEDDING_ONNX_QUANTIZED=true), downloaded or from a local copy of it, and
+reproduces the sentence-transformers pipeline:
+tokenizer -> transformer -> mean pooling -> L2 normalization.
+
+Check that a backend agrees with torch before switching:
+
+    python embedding_backend.py check --backend onnx --quantized
+"""
+
+import argparse
+import os
+import sys
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch")
+EMBEDDING_ONNX_QUANTIZED = os.getenv("EMBEDDING_ONNX_QUANTIZED", "false").lower() == "true"
+# explicit .onnx file (local path or file inside the model repository)
+EMBEDDING_ONNX_FILE = os.getenv("EMBEDDING_ONNX_FILE")
+# 0 = let ONNX Runtime decide
+EMBEDDING_THREADS = int(os.getenv("EMBEDDING_THREADS", 0))
+MAX_SEQ_LENGTH = 256
+
+ONNX_FILES = {False: "onnx/model.onnx", True: "onnx/model_quint8_avx2.onnx"}
+
+
+def _model_file(model_name, filename):
+    """File of a local model directory, or downloaded from the Hugging Face Hub"""
+    if os.path.isdir(model_name):
+        return os.path.join(model_name, filename)
+    from huggingface_hub import hf_hub_download
+
+    return hf_hub_download(model_name, filename)
+
+
+class OnnxEmbeddings(Embeddings):
+    """sentence-transformers compatible embeddings on ONNX Runtime"""
+
+    def __init__(self, model_name, quantized=EMBEDDING_ONNX_QUANTIZED, onnx_file=EMBEDDING_ONNX_FILE,
+                 batch_size=32, threads=EMBEDDING_THREADS):
+        import onnxruntime
+        from tokenizers import Tokenizer
+
+        onnx_file = onnx_file or ONNX_FILES[quantized]
+        model_path = onnx_file if os.path.exists(onnx_file) else _model_file(model_name, onnx_file)
+        options = onnxruntime.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(
+            model_path, sess_options=options, providers=["CPUExecutionProvider"]
+        )
+        self.input_names = {i.name for i in self.session.get_inputs()}
+
+        self.tokenizer = Tokenizer.from_file(_model_file(model_name, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length=MAX_SEQ_LENGTH)
+        self.tokenizer.enable_padding()
+        self.batch_size = batch_size
+
+    def _embed(self, texts):
+        encoded = self.tokenizer.encode_batch(texts)
+        input_ids = np.array([e.ids for e in encoded], dtype=np.int64)
+        attention_mask = np.array([e.attention_mask for e in encoded], dtype=np.int64)
+        inputs = {"input_ids": input_ids, "attention_mask": attention_mask}
+        if "token_type_ids" in self.input_names:
+            inputs["token_type_ids"] = np.array([e.type_ids for e in encoded], dtype=np.int64)
+
+        token_embeddings = self.session.run(None, inputs)[0]
+        # mean pooling روی توکن‌های واقعی (بدون padding)
+        mask = attention_mask[..., None].astype(np.float32)
+        pooled = (token_embeddings * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+        return pooled / np.maximum(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12)
+
+    def embed_documents(self, texts):
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            vectors.extend(self._embed(texts[start:start + self.batch_size]).tolist())
+        return vectors
+
+    def embed_query(self, text):
+        return self._embed([text])[0].tolist()
+
+
+def load_embedding_model(model_name, backend=EMBEDDING_BACKEND, batch_size=32):
+    if backend == "onnx":
+        return OnnxEmbeddings(model_name, batch_size=batch_size)
+    if backend == "torch":
+        from langchain_huggingface import HuggingFaceEmbeddings
+
+        return HuggingFaceEmbeddings(
+            model_name=model_name, model_kwargs={'device': 'cpu'}, encode_kwargs={"batch_size": batch_size}
+        )
+    raise ValueError(f"Unknown EMBEDDING_BACKEND: {backend}")
+
+
+def embedding_cache_name(model_name, backend=EMBEDDING_BACKEND):
+    """Embedding-cache namespace: vectors of different backends are not mixed"""
+    if backend == "torch":
+        return model_name
+    return f"{model_name}@{backend}{'-int8' if EMBEDDING_ONNX_QUANTIZED else ''}"
+
+
+SAMPLE_TEXTS = [
+    "What is the mechanism of action of aspirin?",
+    "Metformin 500 mg twice daily with meals",
+    "Paracetamol 5/325 tablets, maximum daily dose",
+    "Contraindications of ACE inhibitors in pregnancy",
+    "دوز مجاز ایبوپروفن برای کودکان چقدر است؟",
+    "Pharmacokinetics: absorption, distribution, metabolism and excretion of drugs.",
+]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare an embedding backend with torch (cosine agreement)")
+    parser.add_argument("command", choices=["check"])
+    parser.add_argument("--model", default="sentence-transformers/all-MiniLM-L6-v2")
+    parser.add_argument("--backend", default="onnx")
+    parser.add_argument("--quantized", action="store_true", default=EMBEDDING_ONNX_QUANTIZED)
+    parser.add_argument("--texts", help="text file, one sample per line (default: built-in samples)")
+    parser.add_argument("--threshold", type=float, default=None,
+                        help="minimum cosine similarity (default 0.99, 0.95 when quantized)")
+    args = parser.parse_args()
+
+    texts = SAMPLE_TEXTS
+    if args.texts:
+        with open(args.texts, encoding="utf-8") as fh:
+            texts = [line.strip() for line in fh if line.strip()]
+
+    reference = np.array(load_embedding_model(args.model, "torch").embed_documents(texts))
+    candidate = OnnxEmbeddings(args.model, quantized=args.quantized) if args.backend == "onnx" \
+        else load_embedding_model(args.model, args.backend)
+    vectors = np.array(candidate.embed_documents(texts))
+
+    cosine = (reference * vectors).sum(axis=1) / (
+        np.linalg.norm(reference, axis=1) * np.linalg.norm(vectors, axis=1)
+    )
+    threshold = args.threshold or (0.95 if args.quantized else 0.99)
+    print(f"📊 {args.backend}{' int8' if args.quantized else ''} vs torch on {len(texts)} texts: "
+          f"min cosine {cosine.min():.4f}, mean {cosine.mean():.4f}")
+    if cosine.min() < threshold:
+        print(f"❌ Below threshold {threshold}")
+        sys.exit(1)
+    print(f"✅ Agreement above {threshold}")
@@ -0,0 +1,210 @@
+"""
+Persistent embedding cache shared by dataset.py and the API servers
+
+Vectors are stored as float32 rows of a memory-mapped file; a small SQLite
+index maps hash(model + normalized text) -> row. When the file is full the
+least recently used row is overwritten, so the cache never grows past
+EMBEDDING_CACHE_MAX_MB.
+"""
+
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+import zlib
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from cache_backends import ProcessConnection
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = os.getenv("EMBEDDING_CACHE_DIR", ".embedding_cache")
+CACHE_MAX_MB = int(os.getenv("EMBEDDING_CACHE_MAX_MB", 256))
+CACHE_ENABLED = os.getenv("EMBEDDING_CACHE", "true").lower() == "true"
+
+
+def normalize_text(text):
+    """Unicode-normalize and collapse whitespace so trivial variants share a key"""
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def cache_key(text, model_name):
+    return hashlib.sha256(f"{model_name}\0{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """Size-bounded, process-safe vector store keyed by text hash"""
+
+    def __init__(self, path=CACHE_DIR, max_bytes=CACHE_MAX_MB * 1024 * 1024):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._vectors = None
+        # one connection per process (gunicorn --preload forks after the cache is opened)
+        self._connection = ProcessConnection(self._open_index)
+        self._ensure_open()
+
+    @property
+    def _conn(self):
+        return self._connection()
+
+    def _open_index(self):
+        conn = sqlite3.connect(os.path.join(self.path, "index.sqlite"), timeout=30, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER);
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY, slot INTEGER UNIQUE, crc INTEGER, last_used REAL
+            );
+            CREATE INDEX IF NOT EXISTS entries_last_used ON entries(last_used);
+        """)
+        conn.commit()
+        return conn
+
+    def _ensure_open(self):
+        """Pick up storage that another process may have created since we started"""
+        if self._vectors is None:
+            meta = dict(self._conn.execute("SELECT name, value FROM meta"))
+            if meta:
+                self._open(meta["dim"], meta["capacity"])
+
+    def _open(self, dim, capacity):
+        """Open (or create) the vector file for rows of `dim` floats"""
+        vectors_path = os.path.join(self.path, "vectors.f32")
+        mode = "r+" if os.path.exists(vectors_path) else "w+"
+        self._vectors = np.memmap(vectors_path, dtype=np.float32, mode=mode, shape=(capacity, dim))
+        self.dim, self.capacity = dim, capacity
+
+    def _init_storage(self, dim):
+        capacity = max(1, self.max_bytes // (dim * 4))
+        with self._conn:
+            self._conn.execute("DELETE FROM entries")
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO meta VALUES (?, ?)", [("dim", dim), ("capacity", capacity)]
+            )
+        vectors_path = os.path.join(self.path, "vectors.f32")
+        if os.path.exists(vectors_path):
+            os.remove(vectors_path)
+        self._open(dim, capacity)
+
+    def get_many(self, keys):
+        """Cached vectors for `keys` (None for misses)"""
+        with self._lock:
+            self._ensure_open()
+            if self._vectors is None or not keys:
+                return [None] * len(keys)
+
+            placeholders = ",".join("?" * len(keys))
+            rows = self._conn.execute(
+                f"SELECT key, slot, crc FROM entries WHERE key IN ({placeholders})", keys
+            ).fetchall()
+            found = {}
+            for key, slot, crc in rows:
+                vector = np.array(self._vectors[slot])
+                # یه پروسس دیگه ممکنه همین الان این ردیف رو عوض کرده باشه
+                if zlib.crc32(vector.tobytes()) == crc:
+                    found[key] = vector
+            if found:
+                now = time.time()
+                with self._conn:
+                    self._conn.executemany(
+                        "UPDATE entries SET last_used = ? WHERE key = ?", [(now, k) for k in found]
+                    )
+        return [found.get(k) for k in keys]
+
+    def put_many(self, keys, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if not len(keys):
+            return
+
+        with self._lock:
+            self._ensure_open()
+            if self._vectors is None or self.dim != vectors.shape[1]:
+                self._init_storage(vectors.shape[1])
+
+            now = time.time()
+            with self._conn:
+                self._conn.execute("BEGIN IMMEDIATE")
+                for key, vector in zip(keys, vectors):
+                    row = self._conn.execute("SELECT slot FROM entries WHERE key = ?", (key,)).fetchone()
+                    if row:
+                        slot = row[0]
+                    else:
+                        (count,) = self._conn.execute("SELECT COUNT(*) FROM entries").fetchone()
+                        if count < self.capacity:
+                            # ردیف‌ها فقط با eviction آزاد میشن، پس تا پر نشده ردیف‌ها پشت سر هم هستن
+                            slot = count
+                        else:
+                            # پر شده: قدیمی‌ترین ردیف رو بیرون بنداز
+                            old_key, slot = self._conn.execute(
+                                "SELECT key, slot FROM entries ORDER BY last_used LIMIT 1"
+                            ).fetchone()
+                            self._conn.execute("DELETE FROM entries WHERE key = ?", (old_key,))
+                    self._vectors[slot] = vector
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)",
+                        (key, slot, zlib.crc32(vector.tobytes()), now),
+                    )
+                self._vectors.flush()
+
+    def stats(self):
+        (count,) = self._conn.execute("SELECT COUNT(*) FROM entries").fetchone()
+        return {
+            "entries": count,
+            "capacity": getattr(self, "capacity", 0),
+            "max_bytes": self.max_bytes,
+        }
+
+
+class CachedEmbeddings(Embeddings):
+    """Wraps any LangChain embeddings object with an EmbeddingCache"""
+
+    def __init__(self, base, model_name, cache=None):
+        self.base = base
+        self.model_name = model_name
+        self.cache = cache or EmbeddingCache()
+        self.hits = 0
+        self.misses = 0
+
+    def embed_documents(self, texts):
+        keys = [cache_key(t, self.model_name) for t in texts]
+        vectors = self.cache.get_many(keys)
+        missing = [i for i, v in enumerate(vectors) if v is None]
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+
+        if missing:
+            computed = self.base.embed_documents([texts[i] for i in missing])
+            self.cache.put_many([keys[i] for i in missing], computed)
+            for i, vector in zip(missing, computed):
+                vectors[i] = vector
+
+        return [list(map(float, v)) for v in vectors]
+
+    def embed_query(self, text):
+        key = cache_key(text, self.model_name)
+        (vector,) = self.cache.get_many([key])
+        if vector is None:
+            self.misses += 1
+            vector = self.base.embed_query(text)
+            self.cache.put_many([key], [vector])
+        else:
+            self.hits += 1
+        return list(map(float, vector))
+
+
+def with_cache(base, model_name):
+    """Wrap `base` with the shared disk cache unless EMBEDDING_CACHE=false"""
+    if not CACHE_ENABLED:
+        return base
+    try:
+        return CachedEmbeddings(base, model_name)
+    except Exception as e:
+        logger.warning(f"⚠️ Embedding cache disabled: {e}")
+        return base
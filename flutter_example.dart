@@ -42,6 +42,44 @@ class MiaRagService {
     }
   }
 
+  /// سوال پرسیدن با جواب streaming (SSE) - متن همزمان با تولید نمایش داده میشه
+  /// هر event یه Map با کلید 'event' و 'data' هست: sources, delta, done, error
+  Stream<Map<String, dynamic>> askQuestionStream({
+    required String question,
+    String language = 'en',
+    int topK = 5,
+  }) async* {
+    final request = http.Request('POST', Uri.parse('$baseUrl/query/stream'))
+      ..headers['Content-Type'] = 'application/json'
+      ..body = jsonEncode({
+        'question': question,
+        'language': language,
+        'top_k': topK,
+      });
+
+    // finally: بعد از پایان stream یا cancel شدن subscription بسته میشه
+    final client = http.Client();
+    try {
+      final response = await client.send(request);
+      if (response.statusCode != 200) {
+        throw Exception('Failed to get response: ${response.statusCode}');
+      }
+
+      String event = 'message';
+      await for (final line in response.stream
+          .transform(utf8.decoder)
+          .transform(const LineSplitter())) {
+        if (line.startsWith('event: ')) {
+          event = line.substring(7);
+        } else if (line.startsWith('data: ')) {
+          yield {'event': event, 'data': jsonDecode(line.substring(6))};
+        }
+      }
+    } finally {
+      client.close();
+    }
+  }
+
   /// جستجو در اسناد (بدون استفاده از OpenAI)
   Future<SearchResults> searchDocuments({
     required String query,
@@ -0,0 +1,36 @@
+"""
+gunicorn settings for api_server_production.py
+
+    gunicorn -c gunicorn.conf.py api_server_production:app
+
+GUNICORN_PRELOAD=true loads the model in the master before forking, so every
+worker shares the same copy (copy-on-write) instead of loading its own.
+Without it each worker binds immediately and warms up in the background.
+"""
+
+import gc
+import os
+import sys
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+workers = int(os.getenv("WEB_CONCURRENCY", 1))
+threads = int(os.getenv("GUNICORN_THREADS", 2))
+timeout = 120
+
+preload_app = os.getenv("GUNICORN_PRELOAD", "false").lower() == "true"
+if preload_app:
+    # master باید قبل از fork مدل رو کامل لود کرده باشه
+    os.environ.setdefault("MODEL_LOADING", "eager")
+
+
+def pre_fork(server, worker):
+    # objects loaded by the master move to the permanent generation, so the
+    # workers' garbage collector doesn't touch (and copy) their pages
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    # SQLite handles must not cross fork(): the worker reopens what the master opened
+    module = sys.modules.get(server.app.app_uri.split(":")[0])
+    if hasattr(module, "reopen_after_fork"):
+        module.reopen_after_fork()
@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+"""
+Hybrid (BM25 + vector) retrieval
+
+MiniLM is English-centric: drug names, dosage strings ("2.5 mg", "5/325") and
+Persian questions often rank poorly by embedding similarity alone. A lexical
+BM25 index over the same chunks catches those, and the two rankings are
+merged with reciprocal rank fusion (RRF).
+
+The inverted index is built by dataset.py from the memory-mapped export
+(vector_index.py) and stored next to it in vector_db/lexical_index:
+
+    terms.json     term -> [start, document frequency]
+    postings.npy   row numbers, grouped by term
+    tfs.npy        term frequency of every posting
+    doc_len.npy    tokens per row
+    meta.json      count, avgdl
+
+    python hybrid_search.py build
+    python hybrid_search.py search "metformin 500 mg"
+"""
+
+import argparse
+import json
+import math
+import os
+import re
+import shutil
+import unicodedata
+from collections import Counter
+
+import numpy as np
+
+from metadata_index import filter_rows, open_metadata_index
+from vector_index import INDEX_DIR_NAME, ChunkStore
+
+LEXICAL_DIR_NAME = "lexical_index"
+# candidates taken from each ranking before fusion
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", 20))
+RRF_K = 60
+BM25_K1 = 1.2
+BM25_B = 0.75
+# postings held in memory at once while building the index; the rest waits on disk
+LEXICAL_PAGE_SIZE = int(os.getenv("LEXICAL_PAGE_SIZE", 1_000_000))
+
+_CHAR_MAP = str.maketrans({
+    "ي": "ی", "ى": "ی", "ك": "ک", "ة": "ه", "ۀ": "ه",
+    "\u200c": " ",  # نیم‌فاصله
+    **{persian: str(i) for i, persian in enumerate("۰۱۲۳۴۵۶۷۸۹")},
+    **{arabic: str(i) for i, arabic in enumerate("٠١٢٣٤٥٦٧٨٩")},
+})
+_DIACRITICS_RE = re.compile(r"[\u064B-\u065F\u0670]")
+# numbers keep their separators: 2.5, 1,000, 5/325
+_TOKEN_RE = re.compile(r"[^\W_]+(?:[.,/][^\W_]+)*")
+
+
+def tokenize(text):
+    """Lowercased word tokens, Arabic/Persian letters and digits unified"""
+    text = unicodedata.normalize("NFKC", text).lower().translate(_CHAR_MAP)
+    return _TOKEN_RE.findall(_DIACRITICS_RE.sub("", text))
+
+
+def _spill(tmp_dir, pages, term_ids, rows, tfs):
+    """Write one page of (term id, row, tf) postings to disk"""
+    path = os.path.join(tmp_dir, f"page-{len(pages)}.npz")
+    np.savez(path, term_ids=term_ids, rows=rows, tfs=tfs)
+    pages.append(path)
+
+
+def build_lexical_index(db_path, page_size=LEXICAL_PAGE_SIZE):
+    """Build db_path/lexical_index from the rows of db_path/mmap_index.
+    Postings are collected in pages of `page_size` entries and spilled to disk, then
+    scattered into postings.npy / tfs.npy, so memory does not grow with the corpus"""
+    index_dir = os.path.join(db_path, INDEX_DIR_NAME)
+    out_dir = os.path.join(db_path, LEXICAL_DIR_NAME)
+    with open(os.path.join(index_dir, "meta.json"), encoding="utf-8") as fh:
+        count = json.load(fh)["count"]
+    chunks = ChunkStore(index_dir, count)
+
+    tmp_dir = out_dir + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    doc_len = np.lib.format.open_memmap(os.path.join(tmp_dir, "doc_len.npy"), mode="w+",
+                                        dtype=np.float32, shape=(count,))
+
+    term_ids = {}
+    pages = []
+    page_terms = np.empty(page_size, dtype=np.int32)
+    page_rows = np.empty(page_size, dtype=np.int32)
+    page_tfs = np.empty(page_size, dtype=np.uint16)
+    filled = 0
+    for row in range(count):
+        tokens = tokenize(chunks.chunk(row)["text"])
+        doc_len[row] = len(tokens)
+        for term, tf in Counter(tokens).items():
+            if filled == page_size:
+                _spill(tmp_dir, pages, page_terms, page_rows, page_tfs)
+                filled = 0
+            page_terms[filled] = term_ids.setdefault(term, len(term_ids))
+            page_rows[filled] = row
+            page_tfs[filled] = min(tf, 65535)
+            filled += 1
+    if filled:
+        _spill(tmp_dir, pages, page_terms[:filled], page_rows[:filled], page_tfs[:filled])
+    del page_terms, page_rows, page_tfs
+
+    # document frequency -> where every term's postings start
+    df = np.zeros(len(term_ids), dtype=np.int64)
+    for path in pages:
+        with np.load(path) as page:
+            df += np.bincount(page["term_ids"], minlength=len(term_ids))
+    starts = np.concatenate(([0], np.cumsum(df)[:-1])) if len(df) else df
+    total = int(df.sum())
+
+    # pages are in row order, so appending each page per term keeps the rows of a term sorted
+    rows = np.lib.format.open_memmap(os.path.join(tmp_dir, "postings.npy"), mode="w+", dtype=np.int32, shape=(total,))
+    tfs = np.lib.format.open_memmap(os.path.join(tmp_dir, "tfs.npy"), mode="w+", dtype=np.uint16, shape=(total,))
+    cursor = starts.copy()
+    for path in pages:
+        with np.load(path) as page:
+            order = np.argsort(page["term_ids"], kind="stable")
+            terms_sorted = page["term_ids"][order]
+            uniq, first, n = np.unique(terms_sorted, return_index=True, return_counts=True)
+            positions = cursor[terms_sorted] + (np.arange(len(order)) - np.repeat(first, n))
+            rows[positions] = page["rows"][order]
+            tfs[positions] = page["tfs"][order]
+            cursor[uniq] += n
+        os.remove(path)
+    avgdl = float(doc_len.mean()) if count else 0.0
+    for array in (rows, tfs, doc_len):
+        array.flush()
+    del rows, tfs, doc_len
+
+    terms = {term: [int(starts[i]), int(df[i])] for term, i in term_ids.items()}
+    with open(os.path.join(tmp_dir, "terms.json"), "w", encoding="utf-8") as fh:
+        json.dump(terms, fh, ensure_ascii=False)
+    with open(os.path.join(tmp_dir, "meta.json"), "w", encoding="utf-8") as fh:
+        json.dump({"count": count, "avgdl": avgdl}, fh, indent=2)
+
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.rename(tmp_dir, out_dir)
+    return len(terms)
+
+
+class LexicalIndex:
+    """BM25 over the persisted inverted index; postings are memory-mapped"""
+
+    def __init__(self, db_path):
+        path = os.path.join(db_path, LEXICAL_DIR_NAME)
+        with open(os.path.join(path, "meta.json"), encoding="utf-8") as fh:
+            meta = json.load(fh)
+        with open(os.path.join(path, "terms.json"), encoding="utf-8") as fh:
+            self.terms = json.load(fh)
+        self.count = meta["count"]
+        self.avgdl = meta["avgdl"] or 1.0
+        self.postings = np.load(os.path.join(path, "postings.npy"), mmap_mode="r")
+        self.tfs = np.load(os.path.join(path, "tfs.npy"), mmap_mode="r")
+        self.doc_len = np.load(os.path.join(path, "doc_len.npy"), mmap_mode="r")
+        if os.path.exists(os.path.join(db_path, INDEX_DIR_NAME, "chunks.jsonl")):
+            self.chunks = ChunkStore(os.path.join(db_path, INDEX_DIR_NAME), self.count)
+        else:
+            # image with only quantized_index (same row order)
+            from quantized_index import QUANTIZED_DIR_NAME, CompressedChunkStore
+
+            self.chunks = CompressedChunkStore(os.path.join(db_path, QUANTIZED_DIR_NAME))
+        self.metadata = open_metadata_index(db_path)
+
+    def search_rows(self, query, k, allowed=None):
+        """(rows, scores) of the top-k rows by BM25, rows without any query term
+        (or outside `allowed`) excluded"""
+        scores = np.zeros(self.count, dtype=np.float32)
+        for term in set(tokenize(query)):
+            if term not in self.terms:
+                continue
+            start, df = self.terms[term]
+            rows = self.postings[start:start + df]
+            tf = self.tfs[start:start + df].astype(np.float32)
+            idf = math.log(1 + (self.count - df + 0.5) / (df + 0.5))
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * self.doc_len[rows] / self.avgdl)
+            scores[rows] += idf * tf * (BM25_K1 + 1) / (tf + norm)
+        if allowed is not None:
+            keep = np.zeros(self.count, dtype=bool)
+            keep[allowed] = True
+            scores[~keep] = 0
+
+        hits = np.flatnonzero(scores)
+        if len(hits) > k:
+            hits = hits[np.argpartition(-scores[hits], k - 1)[:k]]
+        hits = hits[np.argsort(-scores[hits])]
+        return hits, scores[hits]
+
+    def search(self, query, k, filters=None):
+        rows, _ = self.search_rows(query, k, filter_rows(self.metadata, filters))
+        return [self.chunks.document(row) for row in rows]
+
+
+def reciprocal_rank_fusion(rankings, k, rrf_k=RRF_K):
+    """Merge ranked document lists: score = sum of 1 / (rrf_k + rank)"""
+    scores = {}
+    docs = {}
+    for ranking in rankings:
+        for rank, doc in enumerate(ranking, 1):
+            # Chroma همیشه id برنمی‌گردونه، پس متن chunk کلید مشترک دو لیسته
+            key = doc.page_content
+            scores[key] = scores.get(key, 0.0) + 1 / (rrf_k + rank)
+            docs.setdefault(key, doc)
+    return [docs[key] for key in sorted(scores, key=scores.get, reverse=True)[:k]]
+
+
+class HybridRetriever:
+    """Wraps a dense vector store (Chroma or MmapVectorIndex) and fuses it with BM25"""
+
+    def __init__(self, dense, lexical, candidates=HYBRID_CANDIDATES):
+        self.dense = dense
+        self.lexical = lexical
+        self.candidates = candidates
+
+    def __getattr__(self, name):
+        # everything else (embeddings, similarity_search_by_vector, ...) stays dense
+        return getattr(self.dense, name)
+
+    def fused_search(self, query, vector, k, filters=None):
+        from mia_rag import filter_kwargs
+
+        n = max(k, self.candidates)
+        return reciprocal_rank_fusion([
+            self.dense.similarity_search_by_vector(vector, k=n, **filter_kwargs(self.dense, filters)),
+            self.lexical.search(query, n, filters),
+        ], k)
+
+    def fused_search_many(self, queries, vectors, k, filters=None):
+        from mia_rag import search_by_vectors
+
+        n = max(k, self.candidates)
+        dense = search_by_vectors(self.dense, vectors, n, filters=filters)
+        return [
+            reciprocal_rank_fusion([dense_docs, self.lexical.search(query, n, filters)], k)
+            for query, dense_docs in zip(queries, dense)
+        ]
+
+    def similarity_search(self, query, k=4, filter=None, **kwargs):
+        return self.fused_search(query, self.dense.embeddings.embed_query(query), k, filter)
+
+
+if __name__ == "__main__":
+    from mia_rag import DB_PATH
+
+    parser = argparse.ArgumentParser(description="Build / query the BM25 index")
+    parser.add_argument("command", choices=["build", "search"])
+    parser.add_argument("query", nargs="?")
+    parser.add_argument("--db", default=DB_PATH, help="vector_db directory (with mmap_index)")
+    parser.add_argument("--k", type=int, default=5)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        terms = build_lexical_index(args.db)
+        print(f"✅ Lexical index with {terms} terms saved to {os.path.join(args.db, LEXICAL_DIR_NAME)}")
+    else:
+        index = LexicalIndex(args.db)
+        rows, scores = index.search_rows(args.query or "", args.k)
+        for row, score in zip(rows, scores):
+            chunk = index.chunks.chunk(row)
+            print(f"{score:7.3f}  {os.path.basename(chunk['metadata'].get('source', 'Unknown'))}  {chunk['text'][:80]!r}")
@@ -0,0 +1,233 @@
+"""
+Versioned, immutable index snapshots
+
+dataset.py keeps building incrementally in DB_PATH (Chroma files, mmap_index,
+lexical_index) and then publishes the result as a snapshot:
+
+    vector_db/snapshots/<version>/                Chroma files + mmap_index, quantized, lexical, metadata index
+    vector_db/snapshots/<version>/snapshot.json   manifest: version, model, files, chunk count
+    vector_db/CURRENT                             version the servers should serve
+
+A snapshot is never modified after it is published; CURRENT is replaced
+atomically. The servers open the snapshot CURRENT names (DB_PATH itself when
+there is none, i.e. a vector_db from before snapshots) and switch to a newer
+one without restarting: POST /admin/reload, or a SnapshotWatcher polling
+CURRENT every INDEX_WATCH_INTERVAL seconds (needed with several gunicorn
+workers, the admin endpoint only reaches one of them).
+
+Snapshots are full copies of the collection and stay out of the Docker image
+(.dockerignore): the image serves the last build in DB_PATH, hot swaps are
+for a DB_PATH on a volume.
+
+    python index_snapshots.py list
+    python index_snapshots.py activate 20261017T120000-ab12cd34    # rollback
+    python index_snapshots.py publish                               # snapshot of an existing vector_db
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+SNAPSHOTS_DIR_NAME = "snapshots"
+CURRENT_FILE_NAME = "CURRENT"
+SNAPSHOT_MANIFEST = "snapshot.json"
+INDEX_SNAPSHOTS_KEEP = int(os.getenv("INDEX_SNAPSHOTS_KEEP", 3))
+# 0 = no watcher, only POST /admin/reload
+INDEX_WATCH_INTERVAL = float(os.getenv("INDEX_WATCH_INTERVAL", 0))
+
+# written to a fresh directory on every build (atomic replace), so hard links are safe
+IMMUTABLE_DIRS = ("mmap_index", "quantized_index", "lexical_index", "metadata_index")
+# build bookkeeping, not part of the index
+SKIPPED = (SNAPSHOTS_DIR_NAME, CURRENT_FILE_NAME, "manifest.json")
+
+
+def snapshots_dir(db_path):
+    return os.path.join(db_path, SNAPSHOTS_DIR_NAME)
+
+
+def current_version(db_path):
+    try:
+        with open(os.path.join(db_path, CURRENT_FILE_NAME), encoding="utf-8") as fh:
+            return fh.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def snapshot_path(db_path, version):
+    """Directory of `version`; DB_PATH itself for None (no snapshots yet)"""
+    if version is None:
+        return db_path
+    path = os.path.join(snapshots_dir(db_path), version)
+    if not os.path.isdir(path):
+        raise FileNotFoundError(f"Unknown index snapshot: {version}")
+    return path
+
+
+def read_snapshot_manifest(path):
+    try:
+        with open(os.path.join(path, SNAPSHOT_MANIFEST), encoding="utf-8") as fh:
+            return json.load(fh)
+    except FileNotFoundError:
+        return None
+
+
+def list_snapshots(db_path):
+    """Published versions, oldest first"""
+    root = snapshots_dir(db_path)
+    if not os.path.isdir(root):
+        return []
+    return sorted(v for v in os.listdir(root) if os.path.exists(os.path.join(root, v, SNAPSHOT_MANIFEST)))
+
+
+def _copy_sqlite(src, dst):
+    # backup API: a consistent copy even if a connection (Chroma) still has the file open
+    source, target = sqlite3.connect(src), sqlite3.connect(dst)
+    try:
+        source.backup(target)
+    finally:
+        source.close()
+        target.close()
+
+
+def _link_or_copy_tree(src, dst):
+    os.makedirs(dst)
+    for name in os.listdir(src):
+        src_file, dst_file = os.path.join(src, name), os.path.join(dst, name)
+        try:
+            os.link(src_file, dst_file)
+        except OSError:
+            shutil.copy2(src_file, dst_file)
+
+
+def _copy_index(db_path, out_dir):
+    os.makedirs(out_dir)
+    for name in os.listdir(db_path):
+        if name in SKIPPED or name.endswith((".tmp", ".old", "-wal", "-shm", "-journal")):
+            continue
+        src, dst = os.path.join(db_path, name), os.path.join(out_dir, name)
+        if name in IMMUTABLE_DIRS:
+            _link_or_copy_tree(src, dst)
+        elif os.path.isdir(src):
+            shutil.copytree(src, dst)
+        elif name.endswith(".sqlite3"):
+            _copy_sqlite(src, dst)
+        else:
+            shutil.copy2(src, dst)
+
+
+def _write_current(db_path, version):
+    tmp_path = os.path.join(db_path, CURRENT_FILE_NAME + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as fh:
+        fh.write(version + "\n")
+    os.replace(tmp_path, os.path.join(db_path, CURRENT_FILE_NAME))
+
+
+def publish_snapshot(db_path, build_manifest, keep=INDEX_SNAPSHOTS_KEEP):
+    """Copy the freshly built index into a new snapshot and make it CURRENT. Returns the version"""
+    files = {name: entry["hash"] for name, entry in sorted(build_manifest["files"].items())}
+    content_hash = hashlib.sha1(json.dumps(files, sort_keys=True).encode("utf-8")).hexdigest()[:8]
+    version = f"{time.strftime('%Y%m%dT%H%M%S')}-{content_hash}"
+
+    root = snapshots_dir(db_path)
+    os.makedirs(root, exist_ok=True)
+    tmp_dir = os.path.join(root, f".tmp-{version}")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    _copy_index(db_path, tmp_dir)
+    with open(os.path.join(tmp_dir, SNAPSHOT_MANIFEST), "w", encoding="utf-8") as fh:
+        json.dump({
+            "version": version,
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "model": build_manifest.get("model"),
+            "chunk_size": build_manifest.get("chunk_size"),
+            "chunk_overlap": build_manifest.get("chunk_overlap"),
+            # set by builds whose chunks all carry the filter metadata (metadata_index.py)
+            "subjects": build_manifest.get("subjects"),
+            "chunks": sum(len(entry["chunk_ids"]) for entry in build_manifest["files"].values()),
+            "files": files,
+        }, fh, ensure_ascii=False, indent=2)
+    os.rename(tmp_dir, os.path.join(root, version))
+
+    _write_current(db_path, version)
+    prune_snapshots(db_path, keep)
+    return version
+
+
+def activate_snapshot(db_path, version):
+    """Point CURRENT at an already published version (e.g. a rollback)"""
+    snapshot_path(db_path, version)
+    _write_current(db_path, version)
+
+
+def prune_snapshots(db_path, keep=INDEX_SNAPSHOTS_KEEP):
+    """Remove the oldest snapshots beyond `keep`, never the current one.
+    Servers still reading a removed snapshot keep their open files (POSIX)."""
+    current = current_version(db_path)
+    old = [v for v in list_snapshots(db_path) if v != current]
+    for version in old[:max(len(old) - max(keep - 1, 0), 0)]:
+        shutil.rmtree(os.path.join(snapshots_dir(db_path), version), ignore_errors=True)
+
+
+class SnapshotWatcher:
+    """Calls `on_change(version)` when CURRENT changes; one polling thread per process"""
+
+    def __init__(self, db_path, on_change, interval=INDEX_WATCH_INTERVAL):
+        self.db_path = db_path
+        self.on_change = on_change
+        self.interval = interval
+        self.seen = current_version(db_path)
+        self.error = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Cheap no-op once running in this process (restarts in a forked gunicorn worker)"""
+        if not self.interval or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name="index-watcher", daemon=True).start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            version = current_version(self.db_path)
+            if version == self.seen:
+                continue
+            try:
+                self.on_change(version)
+                self.seen = version
+                self.error = None
+            except Exception as e:
+                # دفعه بعد دوباره امتحان میشه
+                self.error = str(e)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="List, publish or activate index snapshots")
+    parser.add_argument("command", choices=["list", "activate", "publish"])
+    parser.add_argument("version", nargs="?")
+    parser.add_argument("--db-path", default=os.getenv("DB_PATH", "vector_db"))
+    parser.add_argument("--keep", type=int, default=INDEX_SNAPSHOTS_KEEP)
+    args = parser.parse_args()
+
+    if args.command == "list":
+        current = current_version(args.db_path)
+        for version in list_snapshots(args.db_path):
+            manifest = read_snapshot_manifest(snapshot_path(args.db_path, version))
+            print(f"{'*' if version == current else ' '} {version}  {manifest['chunks']} chunks, "
+                  f"{len(manifest['files'])} files")
+    elif args.command == "activate":
+        if not args.version:
+            parser.error("activate needs a version")
+        activate_snapshot(args.db_path, args.version)
+        print(f"✅ CURRENT -> {args.version}")
+    else:
+        with open(os.path.join(args.db_path, "manifest.json"), encoding="utf-8") as fh:
+            print(f"📸 Published index snapshot {publish_snapshot(args.db_path, json.load(fh), keep=args.keep)}")
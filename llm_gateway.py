@@ -0,0 +1,281 @@
+"""
+LLM gateway: one pooled OpenAI client with timeouts, retries, a circuit
+breaker and optional hedged requests
+
+Drop-in for the OpenAI client (`gateway.chat.completions.create(...)`):
+
+- one client per process, so every request reuses its keep-alive connections
+- connect / read timeouts (LLM_CONNECT_TIMEOUT, LLM_TIMEOUT) instead of
+  waiting for gunicorn's 120 s worker timeout
+- retries on 429, 5xx, timeouts and connection errors with full-jitter
+  exponential backoff, honouring Retry-After (LLM_MAX_RETRIES)
+- circuit breaker: after LLM_BREAKER_FAILURES consecutive upstream failures
+  calls fail fast for LLM_BREAKER_RESET seconds, then one trial call is let through
+- hedging (non-streaming calls only): if the first call hasn't answered after
+  LLM_HEDGE_AFTER_MS (a number, or "p95" of recent latencies) a second identical
+  call is sent and the first response wins. Costs extra tokens, off by default.
+
+OPENAI_BASE_URL points the gateway at any OpenAI-compatible server, e.g.
+mock_openai_server.py for local testing.
+"""
+
+import asyncio
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from types import SimpleNamespace
+
+from openai import APIConnectionError, APIStatusError, AsyncOpenAI, OpenAI, Timeout
+
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL") or None
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", 60))
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", 5))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", 2))
+LLM_RETRY_BASE_DELAY = 0.5
+LLM_RETRY_MAX_DELAY = 8.0
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", 5))
+LLM_BREAKER_RESET = float(os.getenv("LLM_BREAKER_RESET", 30))
+# 0 = no hedging, "p95" = adaptive, number = fixed delay in ms
+LLM_HEDGE_AFTER_MS = os.getenv("LLM_HEDGE_AFTER_MS", "0")
+HEDGE_MIN_SAMPLES = 20
+HEDGE_WORKERS = 32
+
+
+class CircuitOpenError(Exception):
+    """Raised without calling upstream while the circuit breaker is open"""
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold=LLM_BREAKER_FAILURES, reset_after=LLM_BREAKER_RESET):
+        self.failure_threshold = failure_threshold
+        self.reset_after = reset_after
+        self.failures = 0
+        self.opened_at = None
+        self.trips = 0
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        return "half-open" if time.monotonic() - self.opened_at >= self.reset_after else "open"
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.reset_after:
+                # half-open: یک درخواست آزمایشی، و تایمر دوباره شروع میشه
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold and self.opened_at is None:
+                self.trips += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+
+def is_retryable(error):
+    """Upstream trouble (worth a retry and counted by the breaker), not a bad request"""
+    if isinstance(error, APIStatusError):
+        return error.status_code == 429 or error.status_code >= 500
+    return isinstance(error, APIConnectionError)
+
+
+def retry_delay(error, attempt):
+    """Full-jitter exponential backoff, or the server's Retry-After when it sends one"""
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    if retry_after:
+        try:
+            return min(float(retry_after), LLM_RETRY_MAX_DELAY)
+        except ValueError:
+            pass
+    return random.uniform(0, min(LLM_RETRY_MAX_DELAY, LLM_RETRY_BASE_DELAY * 2 ** attempt))
+
+
+class _GatewayBase:
+    def __init__(self, hedge_after_ms=LLM_HEDGE_AFTER_MS, max_retries=LLM_MAX_RETRIES):
+        self.breaker = CircuitBreaker()
+        self.max_retries = max_retries
+        self.hedge_after_ms = hedge_after_ms
+        self.latencies = deque(maxlen=200)
+        self.calls = 0
+        self.retries = 0
+        self.failures = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        # OpenAI-client shape: gateway.chat.completions.create(...)
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def hedge_delay(self):
+        """Seconds to wait before sending the hedge, None = don't hedge"""
+        if self.hedge_after_ms == "p95":
+            if len(self.latencies) < HEDGE_MIN_SAMPLES:
+                return None
+            return sorted(self.latencies)[int(len(self.latencies) * 0.95) - 1]
+        delay = float(self.hedge_after_ms or 0)
+        return delay / 1000 if delay > 0 else None
+
+    def _check_breaker(self):
+        if not self.breaker.allow():
+            self.failures += 1
+            raise CircuitOpenError("LLM upstream unavailable (circuit open), try again later")
+
+    def _record(self, error, started, stream):
+        if error is None:
+            self.breaker.record_success()
+            if not stream:
+                self.latencies.append(time.monotonic() - started)
+        elif is_retryable(error):
+            self.breaker.record_failure()
+
+    def stats(self):
+        p95 = self.hedge_delay() if self.hedge_after_ms == "p95" else None
+        return {
+            "calls": self.calls,
+            "retries": self.retries,
+            "failures": self.failures,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "hedge_after_ms": round(p95 * 1000) if p95 else self.hedge_after_ms,
+            "circuit": self.breaker.state,
+            "circuit_trips": self.breaker.trips,
+        }
+
+
+class LLMGateway(_GatewayBase):
+    """Thread-safe gateway for the Flask server and query_rag.py"""
+
+    def __init__(self, api_key, base_url=OPENAI_BASE_URL, timeout=LLM_TIMEOUT, **kwargs):
+        super().__init__(**kwargs)
+        self.client = OpenAI(
+            api_key=api_key,
+            base_url=base_url,
+            timeout=Timeout(timeout, connect=LLM_CONNECT_TIMEOUT),
+            max_retries=0,  # retries are done here, with the breaker in the loop
+        )
+        self._hedge_pool = ThreadPoolExecutor(max_workers=HEDGE_WORKERS, thread_name_prefix="llm-hedge")
+
+    def _call(self, kwargs):
+        self._check_breaker()
+        started = time.monotonic()
+        try:
+            response = self.client.chat.completions.create(**kwargs)
+        except Exception as e:
+            self._record(e, started, kwargs.get("stream"))
+            raise
+        self._record(None, started, kwargs.get("stream"))
+        return response
+
+    def _hedged_call(self, kwargs):
+        delay = None if kwargs.get("stream") else self.hedge_delay()
+        if delay is None:
+            return self._call(kwargs)
+
+        first = self._hedge_pool.submit(self._call, kwargs)
+        done, _ = wait([first], timeout=delay)
+        if done:
+            return first.result()
+        self.hedges += 1
+        second = self._hedge_pool.submit(self._call, kwargs)
+        done, _ = wait([first, second], return_when=FIRST_COMPLETED)
+        winner = done.pop()
+        if winner.exception() is not None:
+            # اون یکی هنوز ممکنه موفق بشه
+            winner = second if winner is first else first
+        if winner is second:
+            self.hedge_wins += 1
+        # the slower call keeps running in the pool and its result is dropped
+        return winner.result()
+
+    def create(self, **kwargs):
+        """chat.completions.create() with timeouts, retries, breaker and hedging"""
+        self.calls += 1
+        for attempt in range(self.max_retries + 1):
+            try:
+                return self._hedged_call(kwargs)
+            except CircuitOpenError:
+                raise
+            except Exception as e:
+                if not is_retryable(e) or attempt == self.max_retries:
+                    self.failures += 1
+                    raise
+                self.retries += 1
+                time.sleep(retry_delay(e, attempt))
+
+
+class AsyncLLMGateway(_GatewayBase):
+    """asyncio gateway for api_server_async.py; the losing hedge is cancelled"""
+
+    def __init__(self, api_key, base_url=OPENAI_BASE_URL, timeout=LLM_TIMEOUT, **kwargs):
+        super().__init__(**kwargs)
+        self.client = AsyncOpenAI(
+            api_key=api_key,
+            base_url=base_url,
+            timeout=Timeout(timeout, connect=LLM_CONNECT_TIMEOUT),
+            max_retries=0,
+        )
+
+    async def _call(self, kwargs):
+        self._check_breaker()
+        started = time.monotonic()
+        try:
+            response = await self.client.chat.completions.create(**kwargs)
+        except Exception as e:
+            self._record(e, started, kwargs.get("stream"))
+            raise
+        self._record(None, started, kwargs.get("stream"))
+        return response
+
+    async def _hedged_call(self, kwargs):
+        delay = None if kwargs.get("stream") else self.hedge_delay()
+        if delay is None:
+            return await self._call(kwargs)
+
+        first = asyncio.ensure_future(self._call(kwargs))
+        done, _ = await asyncio.wait([first], timeout=delay)
+        if done:
+            return first.result()
+        self.hedges += 1
+        second = asyncio.ensure_future(self._call(kwargs))
+        pending = {first, second}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is second:
+                            self.hedge_wins += 1
+                        return task.result()
+            # both failed: surface the first call's error
+            return first.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def create(self, **kwargs):
+        self.calls += 1
+        for attempt in range(self.max_retries + 1):
+            try:
+                return await self._hedged_call(kwargs)
+            except CircuitOpenError:
+                raise
+            except Exception as e:
+                if not is_retryable(e) or attempt == self.max_retries:
+                    self.failures += 1
+                    raise
+                self.retries += 1
+                await asyncio.sleep(retry_delay(e, attempt))
@@ -0,0 +1,123 @@
+"""
+Generation backends: hosted OpenAI model and a local OpenAI-compatible server
+
+A local server (llama.cpp `llama-server`, Ollama, vLLM, ...) exposing
+/v1/chat/completions can answer cheap requests without the round trip to
+OpenAI. LLM_ROUTING decides who answers:
+
+    hosted   always the hosted MODEL (default; same as before)
+    local    always LOCAL_LLM_MODEL at LOCAL_LLM_BASE_URL
+    auto     local for prompts up to LOCAL_LLM_MAX_PROMPT_TOKENS, hosted otherwise
+
+With LLM_FALLBACK=true (default) a failed local call (error, timeout, circuit
+open) is retried on the hosted model. Both backends go through llm_gateway.py.
+The router keeps the `client.chat.completions.create(...)` shape.
+"""
+
+import logging
+import os
+from types import SimpleNamespace
+
+from llm_gateway import AsyncLLMGateway, LLMGateway
+
+LLM_ROUTING = os.getenv("LLM_ROUTING", "hosted")
+LOCAL_LLM_BASE_URL = os.getenv("LOCAL_LLM_BASE_URL")
+LOCAL_LLM_MODEL = os.getenv("LOCAL_LLM_MODEL", "local")
+LOCAL_LLM_API_KEY = os.getenv("LOCAL_LLM_API_KEY", "local")
+# CPU generation is slow: give the local server its own, shorter budget before falling back
+LOCAL_LLM_TIMEOUT = float(os.getenv("LOCAL_LLM_TIMEOUT", 30))
+LOCAL_LLM_MAX_PROMPT_TOKENS = int(os.getenv("LOCAL_LLM_MAX_PROMPT_TOKENS", 1500))
+LLM_FALLBACK = os.getenv("LLM_FALLBACK", "true").lower() == "true"
+
+logger = logging.getLogger(__name__)
+
+
+def prompt_tokens(messages):
+    from context_builder import count_tokens
+
+    return sum(count_tokens(message.get("content") or "") for message in messages)
+
+
+class _RouterBase:
+    def __init__(self, hosted, local, policy=LLM_ROUTING, fallback=LLM_FALLBACK):
+        if policy not in ("hosted", "local", "auto"):
+            raise ValueError(f"Unknown LLM_ROUTING: {policy}")
+        self.hosted = hosted
+        self.local = local
+        self.policy = policy
+        self.fallback = fallback
+        self.routes = {"local": 0, "hosted": 0}
+        self.fallbacks = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def plan(self, kwargs):
+        """[(backend, gateway, call kwargs), ...] in the order they are tried"""
+        hosted = ("hosted", self.hosted, kwargs)
+        local = ("local", self.local, dict(kwargs, model=LOCAL_LLM_MODEL))
+        if self.local is None:
+            return [hosted]
+        if self.hosted is None:
+            return [local]
+        if self.policy == "local" or (
+            self.policy == "auto" and prompt_tokens(kwargs.get("messages", [])) <= LOCAL_LLM_MAX_PROMPT_TOKENS
+        ):
+            return [local, hosted] if self.fallback else [local]
+        return [hosted]
+
+    def _failed(self, backend, error, last):
+        if last:
+            return True
+        self.fallbacks += 1
+        logger.warning(f"⚠️ {backend} LLM failed ({error}), falling back")
+        return False
+
+    def stats(self):
+        return {
+            "routing": self.policy,
+            "routes": dict(self.routes),
+            "fallbacks": self.fallbacks,
+            "hosted": self.hosted.stats() if self.hosted else None,
+            "local": self.local.stats() if self.local else None,
+        }
+
+
+class LLMRouter(_RouterBase):
+    def create(self, **kwargs):
+        plan = self.plan(kwargs)
+        for i, (backend, gateway, call_kwargs) in enumerate(plan):
+            try:
+                response = gateway.create(**call_kwargs)
+            except Exception as e:
+                if self._failed(backend, e, i == len(plan) - 1):
+                    raise
+                continue
+            self.routes[backend] += 1
+            return response
+
+
+class AsyncLLMRouter(_RouterBase):
+    async def create(self, **kwargs):
+        plan = self.plan(kwargs)
+        for i, (backend, gateway, call_kwargs) in enumerate(plan):
+            try:
+                response = await gateway.create(**call_kwargs)
+            except Exception as e:
+                if self._failed(backend, e, i == len(plan) - 1):
+                    raise
+                continue
+            self.routes[backend] += 1
+            return response
+
+
+def create_llm_client(api_key, use_async=False):
+    """Gateway / router for the configured backends, None if there is none"""
+    gateway_class = AsyncLLMGateway if use_async else LLMGateway
+    hosted = gateway_class(api_key=api_key) if api_key else None
+    local = None
+    if LOCAL_LLM_BASE_URL and LLM_ROUTING != "hosted":
+        # خطای سرور محلی با fallback جبران میشه، نه با retry
+        local = gateway_class(api_key=LOCAL_LLM_API_KEY, base_url=LOCAL_LLM_BASE_URL,
+                              timeout=LOCAL_LLM_TIMEOUT, max_retries=0)
+    if local is None:
+        return hosted
+    return (AsyncLLMRouter if use_async else LLMRouter)(hosted, local)
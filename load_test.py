@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+"""
+Load / soak test for api_server_production.py against mock_openai_server.py
+
+Starts the mock OpenAI server (latency / token-rate profile) and the API under
+gunicorn with the given workers / threads, waits for /health, then replays a
+question mix against /query and /search at one or more target request rates:
+
+    python load_test.py --profile typical --rps 1,2,5,10 --step-seconds 60 --workers 1 --threads 2
+    python load_test.py --profile slow --rps 3 --step-seconds 3600          # soak: RSS over an hour
+    python load_test.py --url http://localhost:5000 --server-pid 1234 --rps 5   # an already running server
+
+Requests are sent open-loop (Poisson arrivals at the target rate, however slow
+the server is) and latency is measured from the scheduled send time, so queueing
+shows up in the percentiles. Per step it reports throughput, p50 / p90 / p99,
+error and 429 rates, the response-cache hit ratio and the server's RSS; the
+full report (with a per-second timeline) is written as JSON.
+
+Rate limits are switched off (RATELIMIT_ENABLED=false) unless --rate-limits is
+given: every request comes from the same IP.
+"""
+
+import argparse
+import http.client
+import json
+import os
+import random
+import shlex
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+DRUGS = ["aspirin", "ibuprofen", "paracetamol", "metformin", "amoxicillin", "warfarin", "atorvastatin",
+         "omeprazole", "insulin", "lisinopril", "salbutamol", "prednisolone"]
+TEMPLATES = [
+    "What is the usual adult dose of {drug}?",
+    "What are the common side effects of {drug}?",
+    "Can {drug} be taken during pregnancy?",
+    "How does {drug} interact with {other}?",
+    "What is the mechanism of action of {drug}?",
+    "How should {drug} be stored?",
+    "عوارض جانبی {drug} چیست؟",
+    "دوز مجاز {drug} برای کودکان چقدر است؟",
+]
+
+
+def generated_questions(count, seed=0):
+    rng = random.Random(seed)
+    questions = []
+    for _ in range(count):
+        drug, other = rng.sample(DRUGS, 2)
+        questions.append(rng.choice(TEMPLATES).format(drug=drug, other=other))
+    return questions
+
+
+def load_questions(path):
+    """Questions from a .jsonl file ("question", or "title" as fallback) or a text file, one per line"""
+    questions = []
+    with open(path, encoding="utf-8") as fh:
+        for line in fh:
+            line = line.strip()
+            if not line:
+                continue
+            if path.endswith(".jsonl"):
+                item = json.loads(line)
+                line = item.get("question") or item.get("title")
+            if line:
+                questions.append(line)
+    return questions
+
+
+def process_tree_rss(pid):
+    """RSS in MB of `pid` and all its descendants (gunicorn master + workers), Linux /proc only"""
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as fh:
+                # the command name can contain spaces: ppid comes after the closing parenthesis
+                ppid = int(fh.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+
+    total_kb, stack = 0, [pid]
+    while stack:
+        current = stack.pop()
+        stack.extend(children.get(current, []))
+        try:
+            with open(f"/proc/{current}/status") as fh:
+                for line in fh:
+                    if line.startswith("VmRSS:"):
+                        total_kb += int(line.split()[1])
+        except OSError:
+            pass
+    return total_kb / 1024
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+class LoadClient:
+    """One keep-alive connection per sending thread"""
+
+    def __init__(self, url, timeout):
+        parsed = urlparse(url)
+        self.host, self.port = parsed.hostname, parsed.port or 80
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def request(self, method, path, body=None):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = self.local.connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        try:
+            payload = json.dumps(body).encode("utf-8") if body is not None else None
+            connection.request(method, path, body=payload, headers={"Content-Type": "application/json"})
+            response = connection.getresponse()
+            return response.status, response.read()
+        except Exception:
+            connection.close()
+            self.local.connection = None
+            raise
+
+
+class LoadTest:
+    def __init__(self, args, questions):
+        self.args = args
+        self.questions = questions
+        self.client = LoadClient(args.url, args.timeout)
+        self.rng = random.Random(args.seed)
+        self.records = []  # (step, endpoint, sent offset, latency s, status, cached, error)
+        self.samples = []  # (offset, rss MB)
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.started = None
+
+    def fire(self, step, endpoint, scheduled, body):
+        status, cached, error = None, False, None
+        try:
+            status, raw = self.client.request("POST", endpoint, body)
+            if status == 200 and endpoint == "/query":
+                cached = bool(json.loads(raw).get("cached"))
+        except Exception as e:
+            error = type(e).__name__
+        latency = time.monotonic() - scheduled
+        with self.lock:
+            self.in_flight -= 1
+            self.records.append((step, endpoint, scheduled - self.started, latency, status, cached, error))
+
+    def next_request(self):
+        question = self.rng.choice(self.questions)
+        if self.rng.random() < self.args.search_ratio:
+            return "/search", {"query": question, "top_k": self.args.top_k}
+        return "/query", {"question": question, "top_k": self.args.top_k, "use_cache": not self.args.no_cache}
+
+    def sample_rss(self, stop):
+        while not stop.wait(1.0):
+            if self.args.server_pid:
+                self.samples.append((time.monotonic() - self.started, process_tree_rss(self.args.server_pid)))
+
+    def run(self):
+        stop = threading.Event()
+        self.started = time.monotonic()
+        sampler = threading.Thread(target=self.sample_rss, args=(stop,), daemon=True)
+        sampler.start()
+        pool = ThreadPoolExecutor(max_workers=self.args.max_in_flight, thread_name_prefix="load")
+        try:
+            for step, rps in enumerate(self.args.rps):
+                print(f"\n🚦 Step {step + 1}/{len(self.args.rps)}: {rps} req/s for {self.args.step_seconds}s")
+                step_end = time.monotonic() + self.args.step_seconds
+                next_send = time.monotonic()
+                next_report = time.monotonic() + self.args.report_every
+                while next_send < step_end:
+                    now = time.monotonic()
+                    if next_send > now:
+                        time.sleep(next_send - now)
+                    endpoint, body = self.next_request()
+                    with self.lock:
+                        self.in_flight += 1
+                    pool.submit(self.fire, step, endpoint, next_send, body)
+                    next_send += self.rng.expovariate(rps)
+                    if time.monotonic() >= next_report:
+                        self.progress(step)
+                        next_report += self.args.report_every
+        except KeyboardInterrupt:
+            print("\n⏹️ Interrupted, waiting for requests in flight...")
+        finally:
+            pool.shutdown(wait=True)
+            stop.set()
+        return self.report()
+
+    def progress(self, step):
+        window = time.monotonic() - self.started - self.args.report_every
+        with self.lock:
+            recent = [r for r in self.records if r[0] == step and r[2] >= window]
+            in_flight = self.in_flight
+        latencies = sorted(r[3] for r in recent)
+        rss = f", RSS {self.samples[-1][1]:.0f} MB" if self.samples else ""
+        print(f"  {len(recent) / self.args.report_every:5.1f} req/s done, p50 {fmt_ms(percentile(latencies, 0.5))}, "
+              f"p99 {fmt_ms(percentile(latencies, 0.99))}, in flight {in_flight}{rss}")
+
+    def summarize(self, records, duration):
+        summary = {"requests": len(records), "throughput_rps": round(len(records) / duration, 2) if duration else None}
+        if not records:
+            return summary
+        ok = [r for r in records if r[4] == 200]
+        errors = [r for r in records if r[6] or (r[4] and r[4] >= 500)]
+        limited = [r for r in records if r[4] == 429]
+        queries = [r for r in ok if r[1] == "/query"]
+        summary.update({
+            "ok": len(ok),
+            "error_rate": round(len(errors) / len(records), 4),
+            "rate_limited_rate": round(len(limited) / len(records), 4),
+            "cache_hit_ratio": round(sum(r[5] for r in queries) / len(queries), 4) if queries else None,
+            "error_types": sorted({r[6] or str(r[4]) for r in errors}),
+        })
+        for endpoint in ("/query", "/search"):
+            latencies = sorted(r[3] for r in ok if r[1] == endpoint)
+            if latencies:
+                summary[endpoint] = {
+                    "count": len(latencies),
+                    **{f"p{int(q * 100)}_ms": round(percentile(latencies, q) * 1000, 1) for q in (0.5, 0.9, 0.99)},
+                    "max_ms": round(latencies[-1] * 1000, 1),
+                }
+        return summary
+
+    def report(self):
+        steps = []
+        print("\n📊 Results")
+        for step, rps in enumerate(self.args.rps):
+            records = [r for r in self.records if r[0] == step]
+            if not records:
+                continue
+            start = step * self.args.step_seconds
+            end = start + self.args.step_seconds
+            rss = [mb for t, mb in self.samples if start <= t < end]
+            summary = dict(target_rps=rps, **self.summarize(records, self.args.step_seconds))
+            if rss:
+                summary["rss_mb"] = {"start": round(rss[0]), "max": round(max(rss)), "end": round(rss[-1])}
+            steps.append(summary)
+            query = summary.get("/query", {})
+            print(f"  {rps:>6} req/s target -> {summary['throughput_rps']:>6} req/s, "
+                  f"/query p50 {query.get('p50_ms', '-')} ms p99 {query.get('p99_ms', '-')} ms, "
+                  f"errors {summary.get('error_rate', 0):.1%}, 429 {summary.get('rate_limited_rate', 0):.1%}, "
+                  f"cache hits {summary.get('cache_hit_ratio') or 0:.1%}"
+                  + (f", RSS max {summary['rss_mb']['max']} MB" if rss else ""))
+
+        timeline = {}
+        for step, endpoint, offset, latency, status, cached, error in self.records:
+            second = timeline.setdefault(int(offset), {"sent": 0, "ok": 0, "errors": 0, "rate_limited": 0})
+            second["sent"] += 1
+            second["ok"] += status == 200
+            second["errors"] += bool(error or (status and status >= 500))
+            second["rate_limited"] += status == 429
+        for offset, mb in self.samples:
+            timeline.setdefault(int(offset), {})["rss_mb"] = round(mb, 1)
+        return {"steps": steps, "timeline": [dict(t=t, **timeline[t]) for t in sorted(timeline)]}
+
+
+def fmt_ms(seconds):
+    return "-" if seconds is None else f"{seconds * 1000:.0f} ms"
+
+
+def wait_for_health(url, timeout):
+    client = LoadClient(url, 5)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            status, _ = client.request("GET", "/health")
+            if status == 200:
+                return True
+        except Exception:
+            pass
+        time.sleep(1)
+    return False
+
+
+def start_servers(args):
+    """Mock OpenAI server + the API under gunicorn; returns the processes"""
+    mock = subprocess.Popen(
+        [sys.executable, "mock_openai_server.py", "--port", str(args.mock_port), "--profile", args.profile,
+         "--answer-tokens", str(args.answer_tokens)] + shlex.split(args.mock_args)
+    )
+    env = dict(
+        os.environ,
+        OPENAI_API_KEY="mock",
+        OPENAI_BASE_URL=f"http://127.0.0.1:{args.mock_port}/v1",
+        LLM_ROUTING="hosted",
+        PORT=str(args.port),
+        WEB_CONCURRENCY=str(args.workers),
+        GUNICORN_THREADS=str(args.threads),
+        GUNICORN_PRELOAD="true" if args.preload else "false",
+        RATELIMIT_ENABLED="true" if args.rate_limits else "false",
+    )
+    server = subprocess.Popen(shlex.split(args.server_cmd), env=env)
+    return [server, mock]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load / soak test for the Mia API with a mock OpenAI server")
+    parser.add_argument("--url", help="test an already running server instead of starting one")
+    parser.add_argument("--server-pid", type=int, help="PID whose RSS (with children) is sampled, with --url")
+    parser.add_argument("--server-cmd", default="gunicorn -c gunicorn.conf.py api_server_production:app")
+    parser.add_argument("--port", type=int, default=5055)
+    parser.add_argument("--workers", type=int, default=1, help="gunicorn workers (WEB_CONCURRENCY)")
+    parser.add_argument("--threads", type=int, default=2, help="gunicorn threads per worker (GUNICORN_THREADS)")
+    parser.add_argument("--preload", action="store_true", help="GUNICORN_PRELOAD=true")
+    parser.add_argument("--rate-limits", action="store_true", help="keep the API's rate limits on")
+    parser.add_argument("--mock-port", type=int, default=8055)
+    parser.add_argument("--profile", default="typical", help="mock_openai_server.py profile")
+    parser.add_argument("--answer-tokens", type=int, default=300, help="answer length of the mock server")
+    parser.add_argument("--mock-args", default="", help='extra mock server flags, e.g. "--error-rate 0.05"')
+    parser.add_argument("--rps", type=lambda v: [float(x) for x in v.split(",")], default=[2.0],
+                        help="target request rates, one step each, e.g. 1,2,5,10")
+    parser.add_argument("--step-seconds", type=float, default=60)
+    parser.add_argument("--questions", help=".jsonl (question / title field) or text file; default: generated")
+    parser.add_argument("--unique-questions", type=int, default=200,
+                        help="size of the generated question pool (smaller = more cache hits)")
+    parser.add_argument("--search-ratio", type=float, default=0.2, help="fraction of requests sent to /search")
+    parser.add_argument("--no-cache", action="store_true", help="send use_cache=false")
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--max-in-flight", type=int, default=256)
+    parser.add_argument("--timeout", type=float, default=130)
+    parser.add_argument("--startup-timeout", type=float, default=300, help="seconds to wait for /health")
+    parser.add_argument("--report-every", type=float, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default="load_test_results.json")
+    args = parser.parse_args()
+
+    questions = load_questions(args.questions) if args.questions else generated_questions(args.unique_questions, args.seed)
+    processes = []
+    try:
+        if not args.url:
+            processes = start_servers(args)
+            args.url = f"http://127.0.0.1:{args.port}"
+            args.server_pid = processes[0].pid
+        print(f"⏳ Waiting for {args.url}/health ...")
+        if not wait_for_health(args.url, args.startup_timeout):
+            print("❌ Server did not become healthy")
+            sys.exit(1)
+
+        report = LoadTest(args, questions).run()
+        report["settings"] = {k: v for k, v in vars(args).items()}
+        report["questions"] = len(questions)
+        with open(args.out, "w", encoding="utf-8") as fh:
+            json.dump(report, fh, indent=2, ensure_ascii=False)
+        print(f"💾 Report written to {args.out}")
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+if __name__ == "__main__":
+    main()
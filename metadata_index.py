@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+"""
+Metadata filters (source, page, subject, language) and subject / language shards
+
+Built by dataset.py from the memory-mapped export (vector_index.py) and stored
+next to it in vector_db/metadata_index:
+
+    <field>.npy    row numbers grouped by value (source, subject, language)
+    pages.npy      page of every row (-1 = none)
+    meta.json      count, field -> {value: [start, rows]}, shard layout
+
+/query, /query/stream, /query/batch and /search take an optional "filters" object:
+
+    {"source": "Katzung.pdf", "page": [100, 180], "subject": ["pharmacology"], "language": "fa"}
+
+Values of one field are OR-ed, fields are AND-ed. The mmap and quantized
+indexes only score the matching rows; Chroma gets the same filters as a where
+clause (chroma_where), which needs the file / subject / language metadata
+dataset.py writes on every chunk (older collections: run dataset.py once).
+
+Subjects come from INDEX_SUBJECTS_FILE, {"pharmacology": ["Katzung*.pdf"]};
+files that match no pattern are "general". The language of every chunk is
+detected from its script. dataset.py records a hash of the subjects map in its
+manifest and re-tags the Chroma chunks when it changes; a Chroma index built
+without the filter metadata refuses filters instead of matching nothing.
+
+With INDEX_SHARD_BY=subject (or language) the export keeps the rows of one
+subject together and trains its IVF lists per subject, so a filtered query
+only probes the lists of its own shard.
+
+    python metadata_index.py build
+    python metadata_index.py show
+"""
+
+import argparse
+import fnmatch
+import hashlib
+import json
+import os
+import re
+import shutil
+from functools import lru_cache
+
+import numpy as np
+
+from vector_index import INDEX_DIR_NAME, ChunkStore, replace_dir
+
+METADATA_DIR_NAME = "metadata_index"
+FILTER_FIELDS = ("source", "subject", "language")
+SHARD_FIELDS = ("subject", "language")
+# "" = no shards, or one of SHARD_FIELDS (applied by the next dataset.py / vector_index.py export)
+INDEX_SHARD_BY = os.getenv("INDEX_SHARD_BY", "")
+INDEX_SUBJECTS_FILE = os.getenv("INDEX_SUBJECTS_FILE", "subjects.json")
+DEFAULT_SUBJECT = "general"
+
+_ARABIC_SCRIPT_RE = re.compile(r"[\u0600-\u06FF\uFB50-\uFDFF\uFE70-\uFEFF]")
+# letters Arabic doesn't use (ک and ی are Persian forms of ك and ي)
+_PERSIAN_RE = re.compile(r"[پچژگکی]")
+_LATIN_RE = re.compile(r"[A-Za-z]")
+
+
+def detect_language(text):
+    """fa / ar / en from the dominant script, unknown without letters"""
+    arabic, latin = len(_ARABIC_SCRIPT_RE.findall(text)), len(_LATIN_RE.findall(text))
+    if not arabic and not latin:
+        return "unknown"
+    if arabic > latin:
+        return "fa" if _PERSIAN_RE.search(text) else "ar"
+    return "en"
+
+
+def load_subjects(path=INDEX_SUBJECTS_FILE):
+    """{subject: [file name patterns]}, empty without a subjects file"""
+    try:
+        with open(path, encoding="utf-8") as fh:
+            return json.load(fh)
+    except FileNotFoundError:
+        return {}
+
+
+def subjects_hash(subjects):
+    """Fingerprint of a subjects map, stored in the build manifest"""
+    return hashlib.sha1(json.dumps(subjects, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()[:16]
+
+
+def subject_for(name, subjects):
+    for subject, patterns in subjects.items():
+        if any(fnmatch.fnmatch(name, pattern) for pattern in patterns):
+            return subject
+    return DEFAULT_SUBJECT
+
+
+def row_metadata(text, metadata, subjects):
+    """(source, subject, language, page) of one chunk. The subject always comes from the current
+    subjects map (a stored one may predate an edit); the language is detected if it wasn't stored"""
+    source = os.path.basename(metadata.get("source") or "") or "Unknown"
+    subject = subject_for(source, subjects)
+    language = metadata.get("language") or detect_language(text)
+    page = metadata.get("page")
+    return source, subject, language, page if isinstance(page, int) else -1
+
+
+def shard_key(field, subjects=None):
+    """Shard value of a chunk (text, metadata) for vector_index.export_index"""
+    if field not in SHARD_FIELDS:
+        raise ValueError(f"Unknown INDEX_SHARD_BY: {field} (use one of {', '.join(SHARD_FIELDS)})")
+    subjects = load_subjects() if subjects is None else subjects
+    position = 1 if field == "subject" else 2
+    return lambda text, metadata: row_metadata(text, metadata, subjects)[position]
+
+
+def build_metadata_index(db_path, subjects=None):
+    """Build db_path/metadata_index from the rows of db_path/mmap_index. Returns {field: distinct values}"""
+    index_dir = os.path.join(db_path, INDEX_DIR_NAME)
+    out_dir = os.path.join(db_path, METADATA_DIR_NAME)
+    with open(os.path.join(index_dir, "meta.json"), encoding="utf-8") as fh:
+        index_meta = json.load(fh)
+    count = index_meta["count"]
+    chunks = ChunkStore(index_dir, count)
+    subjects = load_subjects() if subjects is None else subjects
+
+    rows_by_value = {field: {} for field in FILTER_FIELDS}
+    pages = np.full(count, -1, dtype=np.int32)
+    for row in range(count):
+        chunk = chunks.chunk(row)
+        *values, pages[row] = row_metadata(chunk["text"], chunk["metadata"], subjects)
+        for field, value in zip(FILTER_FIELDS, values):
+            rows_by_value[field].setdefault(value, []).append(row)
+
+    tmp_dir = out_dir + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    fields = {}
+    for field, values in rows_by_value.items():
+        postings = np.empty(count, dtype=np.int32)
+        fields[field] = {}
+        start = 0
+        for value in sorted(values):
+            rows = values[value]
+            postings[start:start + len(rows)] = rows
+            fields[field][value] = [start, len(rows)]
+            start += len(rows)
+        np.save(os.path.join(tmp_dir, f"{field}.npy"), postings)
+    np.save(os.path.join(tmp_dir, "pages.npy"), pages)
+    with open(os.path.join(tmp_dir, "meta.json"), "w", encoding="utf-8") as fh:
+        json.dump({"count": count, "fields": fields, "shards": index_meta.get("shards")},
+                  fh, ensure_ascii=False, indent=2)
+
+    replace_dir(tmp_dir, out_dir)
+    return {field: len(values) for field, values in fields.items()}
+
+
+def parse_filters(filters):
+    """Request filters in a canonical form (sorted value lists, page as [first, last]),
+    None for no filter. Raises ValueError for anything malformed"""
+    if not filters:
+        return None
+    if not isinstance(filters, dict):
+        raise ValueError("filters must be an object")
+    unknown = set(filters) - set(FILTER_FIELDS) - {"page"}
+    if unknown:
+        raise ValueError(f"Unknown filter(s): {', '.join(sorted(unknown))}")
+
+    parsed = {}
+    for field in FILTER_FIELDS:
+        if field not in filters:
+            continue
+        values = filters[field] if isinstance(filters[field], list) else [filters[field]]
+        if not values or not all(isinstance(value, str) and value for value in values):
+            raise ValueError(f"filters.{field} must be a string or a list of strings")
+        parsed[field] = sorted({os.path.basename(v) if field == "source" else v for v in values})
+    if "page" in filters:
+        page = filters["page"]
+        page = [page, page] if isinstance(page, int) else page
+        if not (isinstance(page, list) and len(page) == 2
+                and all(isinstance(p, int) and not isinstance(p, bool) for p in page) and page[0] <= page[1]):
+            raise ValueError("filters.page must be a page number or [first, last]")
+        parsed["page"] = page
+    return parsed or None
+
+
+def filters_key(filters):
+    """Stable string for cache keys and grouping; empty without filters"""
+    return json.dumps(filters, sort_keys=True, ensure_ascii=False) if filters else ""
+
+
+def chroma_where(filters):
+    """The same filters as a Chroma where clause"""
+    clauses = [
+        # source در Chroma مسیر کامله، نام فایل جدا ذخیره میشه
+        {"file" if field == "source" else field: {"$in": filters[field]}}
+        for field in FILTER_FIELDS if field in filters
+    ]
+    if "page" in filters:
+        clauses += [{"page": {"$gte": filters["page"][0]}}, {"page": {"$lte": filters["page"][1]}}]
+    return clauses[0] if len(clauses) == 1 else {"$and": clauses}
+
+
+class MetadataIndex:
+    """Row numbers matching a set of filters; postings are memory-mapped"""
+
+    def __init__(self, path):
+        with open(os.path.join(path, "meta.json"), encoding="utf-8") as fh:
+            meta = json.load(fh)
+        self.count = meta["count"]
+        self.fields = meta["fields"]
+        self.shards = meta.get("shards")
+        self.postings = {field: np.load(os.path.join(path, f"{field}.npy"), mmap_mode="r") for field in FILTER_FIELDS}
+        self.pages = np.load(os.path.join(path, "pages.npy"), mmap_mode="r")
+
+    def values(self):
+        """{field: {value: chunks}}"""
+        return {field: {value: n for value, (_, n) in values.items()} for field, values in self.fields.items()}
+
+    def rows(self, filters):
+        """Sorted rows matching parsed filters, None for no filter"""
+        if not filters:
+            return None
+        rows = None
+        for field in FILTER_FIELDS:
+            if field not in filters:
+                continue
+            known = self.fields[field]
+            matched = np.sort(np.concatenate([np.zeros(0, dtype=np.int32)] + [
+                self.postings[field][known[value][0]:known[value][0] + known[value][1]]
+                for value in filters[field] if value in known
+            ]))
+            rows = matched if rows is None else np.intersect1d(rows, matched, assume_unique=True)
+        if "page" in filters:
+            first, last = filters["page"]
+            if rows is None:
+                rows = np.flatnonzero((self.pages >= first) & (self.pages <= last))
+            else:
+                pages = self.pages[rows]
+                rows = rows[(pages >= first) & (pages <= last)]
+        return rows.astype(np.int64)
+
+
+@lru_cache(maxsize=8)
+def open_metadata_index(db_path):
+    """MetadataIndex of an index directory (or snapshot), None if it has none"""
+    path = os.path.join(db_path, METADATA_DIR_NAME)
+    return MetadataIndex(path) if os.path.exists(os.path.join(path, "meta.json")) else None
+
+
+def filter_rows(metadata, filters):
+    """Rows allowed by parsed filters, None for no filter"""
+    if not filters:
+        return None
+    if metadata is None:
+        raise ValueError("Metadata filters need vector_db/metadata_index (python metadata_index.py build)")
+    return metadata.rows(filters)
+
+
+if __name__ == "__main__":
+    from mia_rag import DB_PATH
+
+    parser = argparse.ArgumentParser(description="Build / inspect the metadata filter index")
+    parser.add_argument("command", choices=["build", "show"])
+    parser.add_argument("--db", default=DB_PATH, help="vector_db directory (with mmap_index)")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        counts = build_metadata_index(args.db)
+        print(f"✅ Metadata index saved to {os.path.join(args.db, METADATA_DIR_NAME)}: "
+              + ", ".join(f"{n} {field} values" for field, n in counts.items()))
+    else:
+        index = MetadataIndex(os.path.join(args.db, METADATA_DIR_NAME))
+        for field, values in index.values().items():
+            print(f"{field}:")
+            for value, n in sorted(values.items(), key=lambda item: -item[1]):
+                print(f"  {n:7d}  {value}")
+        if index.shards:
+            print(f"shards by {index.shards['field']}: {len(index.shards['rows'])}")
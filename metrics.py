@@ -0,0 +1,214 @@
+"""
+Request timing and Prometheus metrics for the API servers
+
+Every request gets a RequestTimer; the pipeline stages record spans into it:
+
+    cache            response-cache lookup (includes "embed" on a semantic lookup)
+    embed            question embedding
+    retrieve         vector / hybrid search
+    prompt           context assembly + messages
+    llm              LLM call (whole stream for /query/stream)
+    llm_first_token  time to the first streamed token
+
+Spans and per-request totals are aggregated into histograms, next to
+counters for cache hits / misses, LLM tokens in / out, upstream LLM errors
+and rate-limit rejections. GET /metrics renders them in the Prometheus text
+format. With METRICS_TIMING_HEADER=true the spans are also returned in a
+Server-Timing header (and in the final "done" event of /query/stream, whose
+headers are sent before any stage has run).
+
+Metrics are per process: with several gunicorn workers each scrape sees the
+worker that answered it.
+"""
+
+import contextvars
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+METRICS_TIMING_HEADER = os.getenv("METRICS_TIMING_HEADER", "false").lower() == "true"
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+REGISTRY = []
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+def _format_value(value):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self.values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        return tuple((name, labels.get(name, "")) for name in self.labels)
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, key, value) for key, value in sorted(self.values.items())]
+
+
+class Histogram(Counter):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            # [cumulative bucket counts..., count], sum
+            counts, total = self.values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-1] += 1
+            self.values[key] = (counts, total + value)
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total) in sorted(self.values.items()):
+                for bound, count in zip(self.buckets, counts):
+                    samples.append((f"{self.name}_bucket", key + (("le", _format_value(bound)),), count))
+                count = counts[-1]
+                samples.append((f"{self.name}_bucket", key + (("le", "+Inf"),), count))
+                samples.append((f"{self.name}_sum", key, total))
+                samples.append((f"{self.name}_count", key, count))
+        return samples
+
+
+REQUEST_SECONDS = Histogram("mia_request_duration_seconds", "Request latency", ("endpoint", "status"))
+STAGE_SECONDS = Histogram("mia_stage_duration_seconds", "Latency of one pipeline stage", ("stage",))
+CACHE_LOOKUPS = Counter("mia_cache_lookups_total", "Response-cache lookups by result", ("result",))
+LLM_TOKENS = Counter("mia_llm_tokens_total", "LLM prompt (in) and completion (out) tokens", ("direction",))
+LLM_ERRORS = Counter("mia_llm_errors_total", "Failed LLM calls (after retries) by error type", ("error",))
+RATE_LIMITED = Counter("mia_rate_limited_total", "Requests rejected by the rate limiter", ("endpoint",))
+
+
+def render():
+    """All metrics in the Prometheus text exposition format"""
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f"# HELP {metric.name} {metric.help_text}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, labels, value in metric.samples():
+            lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+class RequestTimer:
+    def __init__(self, endpoint):
+        self.endpoint = endpoint or "unknown"
+        self.started = time.perf_counter()
+        self.spans = {}
+        self.streaming = False
+        self.finished = False
+
+    def record(self, stage, seconds):
+        self.spans[stage] = self.spans.get(stage, 0.0) + seconds
+        STAGE_SECONDS.observe(seconds, stage=stage)
+
+    @contextmanager
+    def span(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - started)
+
+    def activate(self):
+        """Make this the current timer, e.g. inside a streaming generator"""
+        _current.set(self)
+        return self
+
+    def finish(self, status):
+        if self.finished:
+            return
+        self.finished = True
+        REQUEST_SECONDS.observe(time.perf_counter() - self.started, endpoint=self.endpoint, status=status)
+
+    def timings_ms(self):
+        timings = {stage: round(seconds * 1000, 1) for stage, seconds in self.spans.items()}
+        timings["total"] = round((time.perf_counter() - self.started) * 1000, 1)
+        return timings
+
+    def server_timing(self):
+        return ", ".join(f"{stage};dur={ms}" for stage, ms in self.timings_ms().items())
+
+
+_current = contextvars.ContextVar("mia_request_timer", default=None)
+
+
+def start_request(endpoint):
+    return RequestTimer(endpoint).activate()
+
+
+def current():
+    return _current.get()
+
+
+@contextmanager
+def span(stage):
+    """Span of the current request, or only the stage histogram outside of one"""
+    timer = _current.get()
+    if timer is not None:
+        with timer.span(stage):
+            yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - started, stage=stage)
+
+
+@contextmanager
+def llm_errors():
+    try:
+        yield
+    except Exception as e:
+        LLM_ERRORS.inc(error=type(e).__name__)
+        raise
+
+
+def record_cache(hit):
+    CACHE_LOOKUPS.inc(result=hit or "miss")
+
+
+def record_llm_usage(messages, usage=None, answer=None):
+    """Token counters from the response's usage, or estimated (streaming without usage)"""
+    if usage is not None:
+        prompt, completion = usage.prompt_tokens, usage.completion_tokens
+    else:
+        from context_builder import count_tokens
+
+        prompt = sum(count_tokens(message.get("content") or "") for message in messages)
+        completion = count_tokens(answer or "")
+    LLM_TOKENS.inc(prompt, direction="in")
+    LLM_TOKENS.inc(completion, direction="out")
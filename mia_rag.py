@@ -0,0 +1,338 @@
+"""
+Shared RAG pieces of the production API servers
+(api_server_production.py and api_server_async.py)
+"""
+
+import json
+import logging
+import os
+from functools import lru_cache
+
+import metrics
+
+# Configuration
+DB_PATH = os.getenv("DB_PATH", "vector_db")
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+MODEL = os.getenv("MODEL", "gpt-4o-mini")
+EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+# chroma = query Chroma directly, mmap = vector_index.py export under DB_PATH/mmap_index,
+# quantized = int8 + compressed text under DB_PATH/quantized_index (quantized_index.py)
+RETRIEVAL_BACKEND = os.getenv("RETRIEVAL_BACKEND", "chroma")
+# dense = embeddings only, hybrid = BM25 + embeddings fused with RRF (hybrid_search.py)
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "dense")
+# POST /admin/reload is disabled without it
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+logger = logging.getLogger(__name__)
+
+# Mia's Identity
+MIA_IDENTITY = """Mia (Medical Intelligence Assistant) — Version 6.3 b
+
+Description:
+Mia is a multilingual, empathetic, and safety-focused AI agent developed for pharmaceutical, pharmacological, and medical education and clinical support.
+
+Safety & Ethics:
+- Never diagnose or prescribe.
+- Always add: "Final decisions must be made by a doctor or pharmacist."
+"""
+
+# Map language codes to full names
+LANGUAGE_MAP = {
+    "fa": "Persian/Farsi",
+    "en": "English",
+    "ar": "Arabic",
+    "es": "Spanish",
+    "fr": "French",
+    "de": "German",
+    "tr": "Turkish",
+    "ur": "Urdu",
+    "ru": "Russian",
+    "zh": "Chinese",
+    "ja": "Japanese",
+    "ko": "Korean",
+    "auto": "the same language as the question",
+}
+
+
+def load_embeddings():
+    """MiniLM on CPU (EMBEDDING_BACKEND): disk cache -> micro-batcher -> model"""
+    from embedding_backend import embedding_cache_name, load_embedding_model
+    from embedding_cache import with_cache
+    from micro_batch import with_micro_batching
+
+    return with_cache(
+        with_micro_batching(load_embedding_model(EMBEDDING_MODEL)),
+        embedding_cache_name(EMBEDDING_MODEL)
+    )
+
+
+def embedding_stats(embeddings):
+    """Statistics of the cache / micro-batching wrappers around the model"""
+    stats = {}
+    if hasattr(embeddings, "cache"):
+        stats["embedding_cache"] = dict(embeddings.cache.stats(), hits=embeddings.hits, misses=embeddings.misses)
+        embeddings = embeddings.base
+    if hasattr(embeddings, "batches"):
+        stats["embedding_batching"] = embeddings.stats()
+    return stats
+
+
+def index_location(version=None):
+    """(directory, snapshot version) to serve: `version`, else CURRENT, else DB_PATH itself"""
+    from index_snapshots import current_version, snapshot_path
+
+    version = version or current_version(DB_PATH)
+    return snapshot_path(DB_PATH, version), version
+
+
+def has_filter_metadata(path):
+    """Whether the Chroma chunks in `path` carry file / subject / language metadata:
+    builds that tag every chunk store the subjects hash in their manifest"""
+    for name in ("snapshot.json", "manifest.json"):
+        try:
+            with open(os.path.join(path, name), encoding="utf-8") as fh:
+                return bool(json.load(fh).get("subjects"))
+        except FileNotFoundError:
+            continue
+    return False
+
+
+def load_vector_db(embeddings, path=None):
+    """Chroma, the memory-mapped or the quantized index (RETRIEVAL_BACKEND), optionally with BM25 (RETRIEVAL_MODE)"""
+    from metadata_index import open_metadata_index
+
+    path = path or index_location()[0]
+    if RETRIEVAL_BACKEND == "mmap":
+        from vector_index import INDEX_DIR_NAME, MmapVectorIndex
+
+        db = MmapVectorIndex(os.path.join(path, INDEX_DIR_NAME), embeddings, metadata=open_metadata_index(path))
+    elif RETRIEVAL_BACKEND == "quantized":
+        from quantized_index import QUANTIZED_DIR_NAME, QuantizedVectorIndex
+        from vector_index import INDEX_DIR_NAME
+
+        # mmap_index (if shipped) is only read for the float re-score of the top candidates
+        db = QuantizedVectorIndex(os.path.join(path, QUANTIZED_DIR_NAME), embeddings,
+                                  float_path=os.path.join(path, INDEX_DIR_NAME), metadata=open_metadata_index(path))
+        if db.rescore and db.float_vectors is None:
+            logger.info(f"ℹ️ No matching {INDEX_DIR_NAME} in {path}: serving int8 scores without the float re-score")
+    elif RETRIEVAL_BACKEND == "chroma":
+        if not os.path.exists(os.path.join(path, "chroma.sqlite3")):
+            # Chroma یک collection خالی می‌ساخت و همه سوال‌ها بی‌جواب می‌موندن
+            raise FileNotFoundError(f"No Chroma database in {path} (image built with the quantized serving "
+                                    "profile? set RETRIEVAL_BACKEND=quantized)")
+        from langchain_community.vectorstores.chroma import Chroma
+
+        db = Chroma(persist_directory=path, embedding_function=embeddings)
+        db.filter_metadata = has_filter_metadata(path)
+    else:
+        raise ValueError(f"Unknown RETRIEVAL_BACKEND: {RETRIEVAL_BACKEND}")
+
+    if RETRIEVAL_MODE == "hybrid":
+        from hybrid_search import HybridRetriever, LexicalIndex
+
+        db = HybridRetriever(db, LexicalIndex(path))
+    elif RETRIEVAL_MODE != "dense":
+        raise ValueError(f"Unknown RETRIEVAL_MODE: {RETRIEVAL_MODE}")
+    return db
+
+
+def forget_chroma_clients():
+    """Drop chromadb's per-path client cache, so the next Chroma() opens its own connections
+    (a client opened before fork() must not be used in the child)"""
+    try:
+        from chromadb.api.shared_system_client import SharedSystemClient
+    except ImportError:  # chromadb < 0.6
+        from chromadb.api.client import SharedSystemClient
+
+    SharedSystemClient.clear_system_cache()
+
+
+def warm_up(embeddings, db):
+    """One forward pass and one search, so the first real query doesn't pay for lazy init"""
+    model = embeddings
+    while hasattr(model, "base"):
+        # از cache و micro-batcher رد میشیم تا واقعاً مدل اجرا بشه
+        model = model.base
+    vector = model.embed_documents(["warm-up"])[0]
+    db.similarity_search_by_vector(vector, k=1)
+
+
+def open_index(embeddings, version=None):
+    """Load and warm up a snapshot (default: CURRENT) with the already loaded model: (db, version)"""
+    from index_snapshots import read_snapshot_manifest
+
+    path, version = index_location(version)
+    manifest = read_snapshot_manifest(path)
+    if manifest and manifest.get("model") not in (None, EMBEDDING_MODEL):
+        raise ValueError(f"Snapshot {version} was built with {manifest['model']}, not {EMBEDDING_MODEL}")
+    db = load_vector_db(embeddings, path)
+    warm_up(embeddings, db)
+    return db, version
+
+
+def filter_kwargs(db, filters):
+    """Vector-store kwargs for parsed request filters (metadata_index.py):
+    a where clause for Chroma, the filters themselves for the mmap / quantized index"""
+    if not filters:
+        return {}
+    if hasattr(db, "_collection"):
+        from metadata_index import chroma_where
+
+        if not getattr(db, "filter_metadata", True):
+            # بدون این metadata فیلتر Chroma بی‌صدا هیچ نتیجه‌ای برنمی‌گردونه
+            raise ValueError("This Chroma index was built without filter metadata, "
+                             "run python dataset.py once to tag its chunks")
+        return {"filter": chroma_where(filters)}
+    return {"filter": filters}
+
+
+def retrieve_documents(db, query, vector, k, filters=None):
+    """Top-k documents for one question whose embedding is already known"""
+    if hasattr(db, "fused_search"):
+        return db.fused_search(query, vector, k, filters)
+    return db.similarity_search_by_vector(vector, k=k, **filter_kwargs(db, filters))
+
+
+def search_by_vectors(db, vectors, k, queries=None, filters=None):
+    """Top-k documents for several query vectors in one vector-store call"""
+    if queries is not None and hasattr(db, "fused_search_many"):
+        return db.fused_search_many(queries, vectors, k, filters)
+    if hasattr(db, "similarity_search_by_vectors"):
+        return db.similarity_search_by_vectors(vectors, k=k, **filter_kwargs(db, filters))
+
+    collection = getattr(db, "_collection", None)
+    if collection is None:
+        return [db.similarity_search_by_vector(vector, k=k, **filter_kwargs(db, filters)) for vector in vectors]
+
+    # Chroma can answer many queries in a single collection.query() call
+    from langchain_core.documents import Document
+
+    results = collection.query(
+        query_embeddings=[list(map(float, vector)) for vector in vectors],
+        n_results=k,
+        include=["documents", "metadatas"],
+        **({"where": filter_kwargs(db, filters)["filter"]} if filters else {})
+    )
+    return [
+        [Document(page_content=text, metadata=metadata or {}) for text, metadata in zip(texts, metadatas)]
+        for texts, metadatas in zip(results["documents"], results["metadatas"])
+    ]
+
+
+def embed_query(embeddings, question):
+    with metrics.span("embed"):
+        return embeddings.embed_query(question)
+
+
+def lookup_cache(response_cache, embeddings, index_version, question, language, top_k, use_cache, filters=None):
+    """Returns (cache_key, cache_scope, cached result or None, hit type, question vector)"""
+    from metadata_index import filters_key
+    from response_cache import make_cache_key
+
+    cache_key = make_cache_key(question, language, top_k, index_version, filters_key(filters))
+    cache_scope = (language, top_k, index_version, filters_key(filters))
+    if not use_cache:
+        return cache_key, cache_scope, None, None, None
+    with metrics.span("cache"):
+        cached, hit, question_vector = response_cache.lookup(
+            cache_key, cache_scope, lambda: embed_query(embeddings, question)
+        )
+    metrics.record_cache(hit)
+    if cached:
+        logger.info(f"✅ Cache hit ({hit}) for question: {question[:50]}...")
+        cached = dict(cached, question=question, cached=True, cache_hit=hit)
+    return cache_key, cache_scope, cached, hit, question_vector
+
+
+def retrieve(db, embeddings, question, top_k, question_vector=None, filters=None):
+    """(documents, question vector); embeds the question unless the cache lookup already did"""
+    if question_vector is None:
+        question_vector = embed_query(embeddings, question)
+    with metrics.span("retrieve"):
+        return retrieve_documents(db, question, question_vector, top_k, filters), question_vector
+
+
+@lru_cache(maxsize=32)
+def system_prompt(language):
+    """Built once per language: the same bytes every request, so upstream prompt caching can hit"""
+    # Get language instruction - auto-detect if not specified
+    language_instruction = LANGUAGE_MAP.get(language, "the same language as the question")
+
+    return f"""{MIA_IDENTITY}
+
+You are answering questions based on pharmaceutical and medical educational materials.
+
+Instructions:
+- Use the provided context to answer questions accurately
+- If the answer is not in the context, say so clearly
+- Always maintain Mia's empathetic and safety-focused tone
+- Include the disclaimer about final decisions being made by doctors/pharmacists
+- Respond in {language_instruction}
+"""
+
+
+def build_messages(question, docs, language):
+    """(messages, docs in the prompt): system prompt + user message with the retrieved context.
+    Overlapping, near-duplicate and over-budget chunks are left out (context_builder.py),
+    so sources should come from the returned docs, not from the retrieved ones"""
+    from context_builder import assemble_context, join_context
+
+    docs = assemble_context(docs)
+    context = join_context(docs)
+
+    messages = [
+        {"role": "system", "content": system_prompt(language)},
+        {"role": "user", "content": f"""Context from documents:
+{context}
+
+---
+
+Question: {question}
+
+Please answer based on the context provided above."""}
+    ]
+    return messages, docs
+
+
+def format_sources(docs):
+    return [
+        {
+            "file": os.path.basename(doc.metadata.get('source', 'Unknown')),
+            "page": doc.metadata.get('page', None)
+        }
+        for doc in docs
+    ]
+
+
+def format_search_results(docs):
+    return [
+        {
+            "content": doc.page_content[:500] + "...",
+            "source": os.path.basename(doc.metadata.get('source', 'Unknown')),
+            "page": doc.metadata.get('page', None)
+        }
+        for doc in docs
+    ]
+
+
+def query_result(question, language, answer, sources):
+    return {
+        "success": True,
+        "answer": answer,
+        "sources": sources,
+        "question": question,
+        "language": language,
+        "cached": False
+    }
+
+
+def sse_event(event, data):
+    """One Server-Sent Events frame"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def with_timings(result, timer):
+    """Stage timings for the final SSE event: the Server-Timing header is sent before they exist"""
+    if not metrics.METRICS_TIMING_HEADER:
+        return result
+    return dict(result, timings=timer.timings_ms())
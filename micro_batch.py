@@ -0,0 +1,93 @@
+"""
+Micro-batching query embedder
+
+Every /query and /search embeds one short question. Instead of one MiniLM
+forward pass per request, questions that arrive within EMBED_BATCH_MAX_WAIT_MS
+of each other (up to EMBED_BATCH_MAX_SIZE) are embedded together in a single
+embed_documents() call, and each vector is handed back to its request.
+"""
+
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from langchain_core.embeddings import Embeddings
+
+EMBED_BATCH_MAX_SIZE = int(os.getenv("EMBED_BATCH_MAX_SIZE", 32))
+# 0 = micro-batching disabled
+EMBED_BATCH_MAX_WAIT_MS = float(os.getenv("EMBED_BATCH_MAX_WAIT_MS", 5))
+
+
+class MicroBatchEmbedder(Embeddings):
+    """Wraps an embeddings model; concurrent embed_query() calls share one batch"""
+
+    def __init__(self, base, max_batch_size=EMBED_BATCH_MAX_SIZE, max_wait_ms=EMBED_BATCH_MAX_WAIT_MS):
+        self.base = base
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self.batches = 0
+        self.items = 0
+
+    def embed_documents(self, texts):
+        # ingestion already sends whole batches
+        return self.base.embed_documents(texts)
+
+    def embed_query(self, text):
+        self._ensure_worker()
+        future = Future()
+        self._queue.put((text, future))
+        return future.result()
+
+    def _ensure_worker(self):
+        # thread ها بعد از fork (gunicorn --preload) از بین میرن، پس lazy شروعش می‌کنیم
+        if self._thread is None or not self._thread.is_alive():
+            with self._start_lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self._run, name="embed-batcher", daemon=True)
+                    self._thread.start()
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                vectors = self.base.embed_documents([text for text, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), vector in zip(batch, vectors):
+                future.set_result(vector)
+            self.batches += 1
+            self.items += len(batch)
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "queries": self.items,
+            "avg_batch_size": round(self.items / self.batches, 2) if self.batches else 0.0,
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000,
+        }
+
+
+def with_micro_batching(base):
+    """Wrap `base` unless EMBED_BATCH_MAX_WAIT_MS=0"""
+    if EMBED_BATCH_MAX_WAIT_MS <= 0:
+        return base
+    return MicroBatchEmbedder(base)
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""
+Mock OpenAI-compatible server for local testing of llm_gateway.py and the API servers
+
+Answers POST /v1/chat/completions (streaming and non-streaming) with a canned
+answer after a configurable latency, and can inject 429 / 500 errors:
+
+    python mock_openai_server.py --port 8001 --latency-ms 300 --jitter-ms 200 --error-rate 0.05
+    python mock_openai_server.py --profile typical --answer-tokens 300
+    OPENAI_BASE_URL=http://localhost:8001/v1 OPENAI_API_KEY=mock python api_server_production.py
+
+Standard library only, so it runs anywhere the repo does.
+"""
+
+import argparse
+import json
+import random
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ANSWER = ("This is a mock answer from the local test server. "
+          "Final decisions must be made by a doctor or pharmacist.")
+FILLER = "The mock answer continues with more text about dosage and safety."
+
+# latency / generation-speed presets, individual flags override them
+PROFILES = {
+    "fast": {"latency_ms": 50, "jitter_ms": 10, "tokens_per_second": 0},
+    "typical": {"latency_ms": 600, "jitter_ms": 300, "tokens_per_second": 60},
+    "slow": {"latency_ms": 2000, "jitter_ms": 1000, "tokens_per_second": 25},
+    "flaky": {"latency_ms": 600, "jitter_ms": 300, "tokens_per_second": 60, "error_rate": 0.03,
+              "rate_limit_rate": 0.05},
+}
+
+
+def answer_words(answer_tokens):
+    """The canned answer, padded with filler to about `answer_tokens` words"""
+    words = ANSWER.split(" ")
+    filler = FILLER.split(" ")
+    while len(words) < answer_tokens:
+        words.extend(filler)
+    return words[:max(answer_tokens, len(ANSWER.split(" ")))]
+
+
+class MockOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like the real API
+    options = None  # argparse namespace, set in main
+
+    def handle(self):
+        try:
+            super().handle()
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # client went away, e.g. a cancelled hedged request
+
+    def log_message(self, format, *args):
+        if self.options.verbose:
+            super().log_message(format, *args)
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/models"):
+            self._send_json(200, {"object": "list", "data": [{"id": "mock", "object": "model"}]})
+        else:
+            self._send_json(404, {"error": {"message": "not found"}})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": "not found"}})
+            return
+
+        options = self.options
+        time.sleep(max(0.0, options.latency_ms + random.uniform(-1, 1) * options.jitter_ms) / 1000)
+
+        roll = random.random()
+        if roll < options.rate_limit_rate:
+            self._send_json(429, {"error": {"message": "Rate limit reached", "type": "rate_limit"}},
+                            {"Retry-After": "0.1"})
+            return
+        if roll < options.rate_limit_rate + options.error_rate:
+            self._send_json(500, {"error": {"message": "Mock upstream error", "type": "server_error"}})
+            return
+
+        model = request.get("model", "mock")
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+        prompt_tokens = sum(len(str(m.get("content", "")).split()) for m in request.get("messages", []))
+        words = answer_words(options.answer_tokens)
+        if request.get("stream"):
+            self._stream(completion_id, model, words)
+            return
+
+        if options.tokens_per_second:
+            # the whole answer is generated before a non-streaming response is sent
+            time.sleep(len(words) / options.tokens_per_second)
+        self._send_json(200, {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": " ".join(words)},
+                         "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(words),
+                      "total_tokens": prompt_tokens + len(words)},
+        })
+
+    def _stream(self, completion_id, model, words):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def send(data):
+            frame = f"data: {data}\n\n".encode("utf-8")
+            self.wfile.write(f"{len(frame):x}\r\n".encode() + frame + b"\r\n")
+            self.wfile.flush()
+
+        for i, word in enumerate(words):
+            if self.options.tokens_per_second:
+                time.sleep(1 / self.options.tokens_per_second)
+            send(json.dumps({
+                "id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "delta": {"content": word if i == 0 else " " + word},
+                             "finish_reason": None}],
+            }))
+        send(json.dumps({
+            "id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()),
+            "model": model, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+        }))
+        send("[DONE]")
+        self.wfile.write(b"0\r\n\r\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock OpenAI-compatible chat completions server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--profile", choices=sorted(PROFILES), help="latency / token-rate preset")
+    parser.add_argument("--latency-ms", type=float, default=200, help="time before the response starts")
+    parser.add_argument("--jitter-ms", type=float, default=0, help="uniform +/- jitter on the latency")
+    parser.add_argument("--tokens-per-second", type=float, default=50, help="generation speed (0 = no delay)")
+    parser.add_argument("--answer-tokens", type=int, default=0, help="answer length in words (0 = short canned answer)")
+    parser.add_argument("--error-rate", type=float, default=0, help="fraction of 500 responses")
+    parser.add_argument("--rate-limit-rate", type=float, default=0, help="fraction of 429 responses")
+    parser.add_argument("--verbose", action="store_true")
+    profile = parser.parse_known_args()[0].profile
+    if profile:
+        # the preset replaces the defaults, flags given on the command line still win
+        parser.set_defaults(**PROFILES[profile])
+    MockOpenAIHandler.options = parser.parse_args()
+
+    server = ThreadingHTTPServer((MockOpenAIHandler.options.host, MockOpenAIHandler.options.port), MockOpenAIHandler)
+    server.daemon_threads = True
+    print(f"🧪 Mock OpenAI server on http://{MockOpenAIHandler.options.host}:{MockOpenAIHandler.options.port}/v1")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+"""
+Compact serving artifact: int8 vectors + compressed chunk text
+
+Built by dataset.py from the float32 export (vector_index.py) into
+vector_db/quantized_index:
+
+    vectors.i8     N x dim int8, one scale per dimension (same row order as mmap_index)
+    scales.f32     dim float32 scales: vector ≈ int8 * scale
+    chunks.z       chunks as JSON lines, zlib-compressed in blocks of CHUNK_BLOCK_SIZE rows
+    blocks.i64     byte offset of every block in chunks.z (+ end of file)
+    ivf.npz        copied from mmap_index when it has one
+    meta.json      count, dim, model, ivf, block size
+
+`QuantizedVectorIndex` (RETRIEVAL_BACKEND=quantized) scores the int8 matrix and,
+when mmap_index/vectors.f32 is next to it, re-scores the best k * QUANTIZED_RESCORE
+candidates with the float vectors. Only those few rows of the float file are
+read, so it stays out of memory; an image that ships only quantized_index and
+lexical_index serves without re-scoring. Chunk text is decompressed one block
+at a time, only for the rows that are returned.
+
+    python quantized_index.py export           # vector_db/mmap_index -> vector_db/quantized_index
+    python quantized_index.py check --k 5      # recall@k against the full-precision index + sizes
+"""
+
+import argparse
+import json
+import mmap
+import os
+import shutil
+import zlib
+from functools import lru_cache
+
+import numpy as np
+from langchain_core.documents import Document
+
+from vector_index import INDEX_DIR_NAME, IVF_NPROBE, ChunkStore, MmapVectorIndex, _normalize, replace_dir
+
+QUANTIZED_DIR_NAME = "quantized_index"
+# candidates re-scored with float32 = k * QUANTIZED_RESCORE (0 = int8 scores only)
+QUANTIZED_RESCORE = int(os.getenv("QUANTIZED_RESCORE", 4))
+CHUNK_BLOCK_SIZE = 32
+# decompressed blocks kept per process
+CHUNK_BLOCK_CACHE = int(os.getenv("QUANTIZED_BLOCK_CACHE", 64))
+# rows converted to float32 at a time during an exact scan (bounds the temporary copy)
+SCAN_ROWS = 16384
+
+
+def export_quantized(index_dir, out_dir, page_size=5000):
+    """Write the int8 + compressed copy of the float32 export in `index_dir`. Returns the row count"""
+    with open(os.path.join(index_dir, "meta.json"), encoding="utf-8") as fh:
+        meta = json.load(fh)
+    count, dim = meta["count"], meta["dim"]
+    vectors = np.memmap(os.path.join(index_dir, "vectors.f32"), dtype=np.float32, mode="r", shape=(count, dim))
+    chunks = ChunkStore(index_dir, count)
+
+    tmp_dir = out_dir + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    peak = np.zeros(dim, dtype=np.float32)
+    for start in range(0, count, page_size):
+        peak = np.maximum(peak, np.abs(vectors[start:start + page_size]).max(axis=0))
+    scales = np.maximum(peak, 1e-12) / 127
+    scales.astype(np.float32).tofile(os.path.join(tmp_dir, "scales.f32"))
+
+    quantized = np.memmap(os.path.join(tmp_dir, "vectors.i8"), dtype=np.int8, mode="w+", shape=(count, dim))
+    for start in range(0, count, page_size):
+        page = np.rint(vectors[start:start + page_size] / scales)
+        quantized[start:start + page_size] = np.clip(page, -127, 127).astype(np.int8)
+    quantized.flush()
+    del quantized
+
+    blocks = [0]
+    with open(os.path.join(tmp_dir, "chunks.z"), "wb") as out:
+        for start in range(0, count, CHUNK_BLOCK_SIZE):
+            lines = b"".join(
+                json.dumps(chunks.chunk(row), ensure_ascii=False).encode("utf-8") + b"\n"
+                for row in range(start, min(start + CHUNK_BLOCK_SIZE, count))
+            )
+            out.write(zlib.compress(lines, 6))
+            blocks.append(out.tell())
+    np.asarray(blocks, dtype=np.int64).tofile(os.path.join(tmp_dir, "blocks.i64"))
+
+    if meta.get("ivf"):
+        shutil.copy2(os.path.join(index_dir, "ivf.npz"), os.path.join(tmp_dir, "ivf.npz"))
+    with open(os.path.join(tmp_dir, "meta.json"), "w", encoding="utf-8") as fh:
+        json.dump({**meta, "quantization": "int8", "chunk_block_size": CHUNK_BLOCK_SIZE}, fh, indent=2)
+
+    replace_dir(tmp_dir, out_dir)
+    return count
+
+
+class CompressedChunkStore:
+    """Random access to chunks.z by row number; ChunkStore's interface"""
+
+    def __init__(self, path):
+        with open(os.path.join(path, "meta.json"), encoding="utf-8") as fh:
+            meta = json.load(fh)
+        self.count = meta["count"]
+        self.block_size = meta["chunk_block_size"]
+        self.blocks = np.fromfile(os.path.join(path, "blocks.i64"), dtype=np.int64)
+        with open(os.path.join(path, "chunks.z"), "rb") as fh:
+            self._chunks = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        self._block = lru_cache(maxsize=CHUNK_BLOCK_CACHE)(self._read_block)
+
+    def __len__(self):
+        return self.count
+
+    def _read_block(self, block):
+        start, end = int(self.blocks[block]), int(self.blocks[block + 1])
+        return zlib.decompress(self._chunks[start:end]).split(b"\n")
+
+    def chunk(self, row):
+        block, line = divmod(int(row), self.block_size)
+        return json.loads(self._block(block)[line])
+
+    def document(self, row):
+        chunk = self.chunk(row)
+        return Document(page_content=chunk["text"], metadata=chunk["metadata"], id=chunk["id"])
+
+
+def _top_k(scores, k):
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.array([], dtype=np.int64)
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top])]
+
+
+class QuantizedVectorIndex(MmapVectorIndex):
+    """MmapVectorIndex over int8 vectors, optionally re-scored with the float32 export"""
+
+    def __init__(self, path, embeddings, nprobe=IVF_NPROBE, rescore=QUANTIZED_RESCORE, float_path=None,
+                 metadata=None):
+        self.path = path
+        self.embeddings = embeddings
+        self.nprobe = nprobe
+        self.metadata = metadata
+        with open(os.path.join(path, "meta.json"), encoding="utf-8") as fh:
+            self.meta = json.load(fh)
+        count, dim = self.meta["count"], self.meta["dim"]
+        self.vectors = np.memmap(os.path.join(path, "vectors.i8"), dtype=np.int8, mode="r", shape=(count, dim))
+        self.scales = np.fromfile(os.path.join(path, "scales.f32"), dtype=np.float32)
+        self.chunks = CompressedChunkStore(path)
+        self.centroids = self.list_offsets = None
+        if self.meta.get("ivf"):
+            ivf = np.load(os.path.join(path, "ivf.npz"))
+            self.centroids, self.list_offsets = ivf["centroids"], ivf["list_offsets"]
+
+        self.rescore = rescore
+        self.float_vectors = None
+        if rescore and float_path and os.path.exists(os.path.join(float_path, "vectors.f32")):
+            with open(os.path.join(float_path, "meta.json"), encoding="utf-8") as fh:
+                float_meta = json.load(fh)
+            # باید از همون export ساخته شده باشه، وگرنه ترتیب ردیف‌ها فرق داره
+            if (float_meta["count"], float_meta["dim"]) == (count, dim):
+                self.float_vectors = np.memmap(os.path.join(float_path, "vectors.f32"), dtype=np.float32,
+                                               mode="r", shape=(count, dim))
+
+    def _scan(self, queries):
+        """Approximate scores of every row for a (q, dim) batch of normalized queries -> (q, N)"""
+        scaled = (queries * self.scales).T
+        return np.concatenate([
+            self.vectors[start:start + SCAN_ROWS].astype(np.float32) @ scaled
+            for start in range(0, len(self.vectors), SCAN_ROWS)
+        ]).T
+
+    def _finish(self, query, rows, scores, k):
+        """Top-k of the approximate scores, re-scored with float32 when available"""
+        if self.float_vectors is None:
+            top = _top_k(scores, k)
+            return rows[top], scores[top]
+        # sorted rows: the float file is read front to back
+        candidates = np.sort(rows[_top_k(scores, k * self.rescore)])
+        exact = self.float_vectors[candidates] @ query
+        top = _top_k(exact, k)
+        return candidates[top], exact[top]
+
+    def search_rows(self, query, k, allowed=None):
+        query = _normalize(np.asarray(query, dtype=np.float32))
+        rows = self._candidate_rows(query, allowed, k)
+        if rows is None:
+            return self._finish(query, np.arange(len(self.vectors)), self._scan(query[None])[0], k)
+        scores = self.vectors[rows].astype(np.float32) @ (query * self.scales)
+        return self._finish(query, rows, scores, k)
+
+    def similarity_search_by_vectors(self, embeddings, k=4, filter=None):
+        if self.centroids is not None or filter:
+            return [self.similarity_search_by_vector(v, k=k, filter=filter) for v in embeddings]
+        queries = _normalize(np.asarray(embeddings, dtype=np.float32))
+        all_rows = np.arange(len(self.vectors))
+        return [
+            [self.chunks.document(row) for row in self._finish(query, all_rows, scores, k)[0]]
+            for query, scores in zip(queries, self._scan(queries))
+        ]
+
+
+def directory_size(path):
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+
+if __name__ == "__main__":
+    from mia_rag import DB_PATH
+
+    parser = argparse.ArgumentParser(description="Export / check the quantized serving index")
+    parser.add_argument("command", choices=["export", "check"])
+    parser.add_argument("--db", default=DB_PATH, help="vector_db directory (with mmap_index)")
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--queries", type=int, default=200, help="sample size for check")
+    args = parser.parse_args()
+
+    index_dir = os.path.join(args.db, INDEX_DIR_NAME)
+    out_dir = os.path.join(args.db, QUANTIZED_DIR_NAME)
+    if args.command == "export":
+        count = export_quantized(index_dir, out_dir)
+        print(f"✅ Quantized {count} chunks to {out_dir} "
+              f"({directory_size(out_dir) / 1e6:.1f} MB vs {directory_size(index_dir) / 1e6:.1f} MB)")
+    else:
+        # query = بردار خود chunk ها؛ مرجع = جستجوی کامل float32 روی همه ردیف‌ها
+        reference = MmapVectorIndex(index_dir, None)
+        variants = {
+            "float32": reference,
+            "int8": QuantizedVectorIndex(out_dir, None, rescore=0),
+            f"int8 + float re-score x{QUANTIZED_RESCORE or 4}": QuantizedVectorIndex(
+                out_dir, None, rescore=QUANTIZED_RESCORE or 4, float_path=index_dir),
+        }
+        rng = np.random.default_rng(0)
+        rows = rng.choice(len(reference), min(args.queries, len(reference)), replace=False)
+        expected = [set(_top_k(reference.vectors @ reference.vectors[row], args.k)) for row in rows]
+        for name, index in variants.items():
+            hits = sum(len(want & set(index.search_rows(reference.vectors[row], args.k)[0]))
+                       for row, want in zip(rows, expected))
+            print(f"📊 {name}: recall@{args.k} {hits / (len(rows) * args.k):.3f} over {len(rows)} queries")
+        for name, path, vectors, text in (("float32", index_dir, "vectors.f32", "chunks.jsonl"),
+                                          ("quantized", out_dir, "vectors.i8", "chunks.z")):
+            print(f"💾 {name}: vectors {os.path.getsize(os.path.join(path, vectors)) / 1e6:.1f} MB, "
+                  f"chunk text {os.path.getsize(os.path.join(path, text)) / 1e6:.1f} MB, "
+                  f"total {directory_size(path) / 1e6:.1f} MB")
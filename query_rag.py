@@ -5,13 +5,20 @@ Uses OpenAI API to answer questions based on pharmaceutical/medical documents
 """
 
 import os
-from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_community.vectorstores.chroma import Chroma
-from openai import OpenAI
+import argparse
+import contextlib
+import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import sys
+from embedding_cache import with_cache
+from embedding_backend import embedding_cache_name, load_embedding_model
+from context_builder import assemble_context, join_context
+from llm_router import create_llm_client
+from session_memory import HISTORY_SUMMARY, compact_history, llm_summarizer
+from mia_rag import search_by_vectors, load_vector_db as open_vector_db
 
 # Configuration
-DB_PATH = "vector_db"
+EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 MODEL = "gpt-4o-mini"  # یا "gpt-4" اگر دسترسی داری
 
@@ -31,14 +38,24 @@ Safety & Ethics:
 - If confidence is low, ask clarifying questions instead of guessing.
 """
 
+# یک بار ساخته میشه: prefix ثابت و byte-identical تا prompt caching سمت OpenAI hit بشه
+SYSTEM_PROMPT = f"""{MIA_IDENTITY}
+
+You are answering questions based on pharmaceutical and medical educational materials.
+
+Instructions:
+- Use the provided context to answer questions accurately
+- If the answer is not in the context, say so clearly
+- Always maintain Mia's empathetic and safety-focused tone
+- Include the disclaimer about final decisions being made by doctors/pharmacists
+- Respond in the same language as the question (English or Persian/Farsi)
+"""
+
 def load_vector_db():
     """بارگذاری دیتابیس وکتور"""
     print("📂 Loading vector database...")
-    embeddings = HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2")
-    db = Chroma(
-        persist_directory=DB_PATH,
-        embedding_function=embeddings
-    )
+    embeddings = with_cache(load_embedding_model(EMBEDDING_MODEL), embedding_cache_name(EMBEDDING_MODEL))
+    db = open_vector_db(embeddings)
     print("✅ Vector database loaded successfully")
     return db
 
@@ -53,29 +70,24 @@ def retrieve_context(db, query, k=5):
         source = doc.metadata.get('source', 'Unknown')
         print(f"  {i}. {os.path.basename(source)}")
 
-    # ترکیب محتوای اسناد
-    context = "\n\n---\n\n".join([doc.page_content for doc in docs])
-    return context, docs
+    # ترکیب محتوای اسناد؛ منابع فقط همون chunk هایی هستن که وارد prompt شدن
+    docs = assemble_context(docs)
+    return join_context(docs), docs
 
-def query_openai(question, context, conversation_history=None):
-    """ارسال سوال به OpenAI با context از RAG"""
-    if not OPENAI_API_KEY:
-        raise ValueError("❌ OPENAI_API_KEY environment variable not set!")
+_gateway = None
 
-    client = OpenAI(api_key=OPENAI_API_KEY)
+def get_gateway():
+    """یک client مشترک (connection pool) برای همه سوال‌ها، OpenAI و/یا مدل محلی (llm_router.py)"""
+    global _gateway
+    if _gateway is None:
+        _gateway = create_llm_client(OPENAI_API_KEY)
+    return _gateway
 
-    # ساخت system prompt با هویت Mia
-    system_prompt = f"""{MIA_IDENTITY}
-
-You are answering questions based on pharmaceutical and medical educational materials.
-
-Instructions:
-- Use the provided context to answer questions accurately
-- If the answer is not in the context, say so clearly
-- Always maintain Mia's empathetic and safety-focused tone
-- Include the disclaimer about final decisions being made by doctors/pharmacists
-- Respond in the same language as the question (English or Persian/Farsi)
-"""
+def query_openai(question, context, conversation_history=None, client=None, quiet=False, summarize=None):
+    """ارسال سوال به OpenAI با context از RAG"""
+    client = client or get_gateway()
+    if client is None:
+        raise ValueError("❌ OPENAI_API_KEY environment variable not set!")
 
     # ساخت user message با context
     user_message = f"""Context from documents:
@@ -88,15 +100,20 @@ Question: {question}
 Please answer based on the context provided above."""
 
     # آماده‌سازی messages
-    messages = [{"role": "system", "content": system_prompt}]
+    messages = [{"role": "system", "content": SYSTEM_PROMPT}]
 
-    # اضافه کردن تاریخچه مکالمه اگر وجود داشته باشد
+    # تاریخچه مکالمه، turn های قدیمی در بودجه HISTORY_MAX_TOKENS خلاصه میشن
     if conversation_history:
-        messages.extend(conversation_history)
+        history, stats = compact_history(conversation_history, summarize=summarize)
+        messages.extend(history)
+        if not quiet and stats["compacted_turns"]:
+            print(f"💾 History: {stats['compacted_turns']} older turns summarized, "
+                  f"{stats['saved_tokens']} prompt tokens saved")
 
     messages.append({"role": "user", "content": user_message})
 
-    print("🤖 Querying OpenAI...")
+    if not quiet:
+        print("🤖 Querying OpenAI...")
     response = client.chat.completions.create(
         model=MODEL,
         messages=messages,
@@ -118,6 +135,7 @@ def interactive_mode():
 
     db = load_vector_db()
     conversation_history = []
+    summarize = llm_summarizer(get_gateway(), MODEL) if HISTORY_SUMMARY == "llm" else None
 
     while True:
         try:
@@ -139,7 +157,7 @@ def interactive_mode():
             context, docs = retrieve_context(db, question, k=5)
 
             # دریافت پاسخ از OpenAI
-            answer = query_openai(question, context, conversation_history)
+            answer = query_openai(question, context, conversation_history, summarize=summarize)
 
             # ذخیره در تاریخچه
             conversation_history.append({"role": "user", "content": question})
@@ -175,17 +193,80 @@ def single_query_mode(question):
         source = doc.metadata.get('source', 'Unknown')
         print(f"  {i}. {os.path.basename(source)}")
 
+def batch_mode(path, field="question", out=None, concurrency=8, k=5):
+    """
+    حالت batch: سوال‌ها از فایل JSONL خونده میشن و جواب‌ها به صورت NDJSON
+    (به ترتیب تموم شدن) در stdout یا فایل --out نوشته میشن
+    """
+    with open(path, encoding="utf-8") as fh:
+        records = [json.loads(line) for line in fh if line.strip()]
+    jobs = [(i, record) for i, record in enumerate(records) if record.get(field)]
+    print(f"📦 {len(jobs)} questions from {path} (field '{field}')", file=sys.stderr)
+
+    # stdout فقط برای نتیجه‌هاست
+    with contextlib.redirect_stdout(sys.stderr):
+        db = load_vector_db()
+
+    # همه سوال‌ها با هم embed میشن و جستجو یکجا انجام میشه
+    questions = [record[field] for _, record in jobs]
+    vectors = db.embeddings.embed_documents(questions)
+    all_docs = search_by_vectors(db, vectors, k, questions)
+
+    client = get_gateway()
+    output = open(out, "w", encoding="utf-8") if out else sys.stdout
+
+    def answer(question, docs):
+        return query_openai(question, join_context(docs), client=client, quiet=True)
+
+    done = 0
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            futures = {
+                pool.submit(answer, question, docs): (i, records[i], question, docs)
+                for (i, _), question, docs in zip(jobs, questions, map(assemble_context, all_docs))
+            }
+            for future in as_completed(futures):
+                i, record, question, docs = futures[future]
+                result = {"index": i, "question": question}
+                if "id" in record or "request_id" in record:
+                    result["id"] = record.get("id", record.get("request_id"))
+                try:
+                    result.update(success=True, answer=future.result())
+                except Exception as e:
+                    result.update(success=False, error=str(e))
+                result["sources"] = [
+                    {"file": os.path.basename(doc.metadata.get('source', 'Unknown')), "page": doc.metadata.get('page')}
+                    for doc in docs
+                ]
+                output.write(json.dumps(result, ensure_ascii=False) + "\n")
+                output.flush()
+                done += 1
+                print(f"✅ {done}/{len(jobs)}", file=sys.stderr)
+    finally:
+        if out:
+            output.close()
+
 if __name__ == "__main__":
-    # بررسی وجود API key
-    if not OPENAI_API_KEY:
+    parser = argparse.ArgumentParser(description="Mia RAG CLI")
+    parser.add_argument("question", nargs="*", help="ask a single question (interactive mode if omitted)")
+    parser.add_argument("--batch", metavar="FILE.jsonl", help="answer every question in a JSONL file")
+    parser.add_argument("--field", default="question", help="JSONL field holding the question (default: question)")
+    parser.add_argument("--out", help="write batch results (NDJSON) here instead of stdout")
+    parser.add_argument("--concurrency", type=int, default=8, help="parallel OpenAI calls in batch mode")
+    parser.add_argument("--top-k", type=int, default=5, help="documents retrieved per question")
+    args = parser.parse_args()
+
+    # بررسی وجود API key (یا مدل محلی)
+    if get_gateway() is None:
         print("❌ Error: OPENAI_API_KEY not found in environment variables")
         print("Please set it with: export OPENAI_API_KEY='your-api-key-here'")
         sys.exit(1)
 
+    if args.batch:
+        batch_mode(args.batch, args.field, args.out, args.concurrency, args.top_k)
     # اگر آرگومان داده شده، در حالت تک سوال اجرا شود
-    if len(sys.argv) > 1:
-        question = " ".join(sys.argv[1:])
-        single_query_mode(question)
+    elif args.question:
+        single_query_mode(" ".join(args.question))
     else:
         # در غیر این صورت حالت تعاملی
         interactive_mode()
@@ -0,0 +1,150 @@
+"""
+Response cache for the Mia API
+
+Exact tier: LRU with a per-entry TTL and a total size cap in bytes, keyed by
+the normalized question + language + top_k.
+Semantic tier (optional): when a question misses the exact tier, reuse the
+answer of a cached question whose embedding is within SEMANTIC_CACHE_DISTANCE
+(cosine distance) for the same language and top_k.
+Storage is pluggable, see cache_backends.py.
+"""
+
+import hashlib
+import json
+import os
+import re
+import time
+
+import numpy as np
+
+from cache_backends import MemoryBackend
+
+RESPONSE_CACHE_MAX_MB = float(os.getenv("RESPONSE_CACHE_MAX_MB", 16))
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", 24 * 3600))
+# 0 = semantic tier disabled
+SEMANTIC_CACHE_DISTANCE = float(os.getenv("SEMANTIC_CACHE_DISTANCE", 0))
+
+_TRAILING_PUNCTUATION = re.compile(r"[\s?!.؟،,;:]+$")
+
+
+def normalize_question(question):
+    """Case, whitespace and trailing punctuation don't change the answer"""
+    question = " ".join(question.lower().split())
+    return _TRAILING_PUNCTUATION.sub("", question)
+
+
+def make_cache_key(question, language, top_k, index_version=None, filters=None):
+    """Answers of another index snapshot get other keys, so a hot swap never serves them.
+    `filters` is the stable string of the request's metadata filters"""
+    content = f"{normalize_question(question)}\0{language}\0{top_k}"
+    if index_version:
+        content += f"\0{index_version}"
+    if filters:
+        content += f"\0{filters}"
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """LRU + TTL cache with an optional embedding-similarity tier.
+
+    Entries and hit/miss counters live in a pluggable backend (see
+    cache_backends.py), so with a shared backend every gunicorn worker sees
+    the same cache and the same statistics.
+    """
+
+    def __init__(self, max_bytes=int(RESPONSE_CACHE_MAX_MB * 1024 * 1024), ttl=RESPONSE_CACHE_TTL,
+                 semantic_distance=SEMANTIC_CACHE_DISTANCE, backend=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.semantic_distance = semantic_distance
+        self.backend = backend or MemoryBackend()
+
+    @property
+    def semantic_enabled(self):
+        return self.semantic_distance > 0
+
+    def __len__(self):
+        return self.backend.size()[0]
+
+    def lookup(self, key, scope=None, embed=None):
+        """Exact lookup, then (if enabled) a semantic lookup in `scope`.
+
+        `embed` is a zero-argument callable returning the question's embedding;
+        it is only called on an exact miss with the semantic tier enabled.
+        Returns (value, "exact" | "semantic" | None, vector or None).
+        """
+        value = self.backend.get(key, time.time())
+        if value is not None:
+            self.backend.incr("hits")
+            return value, "exact", None
+
+        vector = embed() if embed is not None and self.semantic_enabled else None
+        value = self._get_similar(vector, scope)
+        if value is not None:
+            self.backend.incr("semantic_hits")
+            return value, "semantic", vector
+
+        self.backend.incr("misses")
+        return None, None, vector
+
+    def _get_similar(self, vector, scope):
+        """Closest cached answer in `scope` within the configured distance"""
+        if not self.semantic_enabled or vector is None:
+            return None
+
+        now = time.time()
+        candidates = self.backend.scope_vectors(_scope_id(scope), now)
+        if not candidates:
+            return None
+        keys, matrix = zip(*candidates)
+        distances = 1.0 - np.stack(matrix) @ _unit(vector)
+        best = int(np.argmin(distances))
+        if distances[best] > self.semantic_distance:
+            return None
+        return self.backend.get(keys[best], now)
+
+    def put(self, key, value, scope=None, vector=None):
+        size = len(json.dumps(value, ensure_ascii=False).encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        vector = _unit(vector) if vector is not None and self.semantic_enabled else None
+        evicted = self.backend.put(
+            key, value, size, time.time() + self.ttl, _scope_id(scope), vector, self.max_bytes
+        )
+        if evicted:
+            self.backend.incr("evictions", evicted)
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        count, total_bytes = self.backend.size()
+        counters = self.backend.counters()
+        hits = counters.get("hits", 0)
+        semantic_hits = counters.get("semantic_hits", 0)
+        misses = counters.get("misses", 0)
+        lookups = hits + semantic_hits + misses
+        return {
+            "backend": type(self.backend).__name__,
+            "shared_across_workers": self.backend.shared,
+            "cache_size": count,
+            "cache_bytes": total_bytes,
+            "max_cache_bytes": self.max_bytes,
+            "ttl_seconds": self.ttl,
+            "hits": hits,
+            "semantic_hits": semantic_hits,
+            "misses": misses,
+            "evictions": counters.get("evictions", 0),
+            "hit_rate": round((hits + semantic_hits) / lookups, 4) if lookups else 0.0,
+            "semantic_distance": self.semantic_distance if self.semantic_enabled else None,
+        }
+
+
+def _scope_id(scope):
+    return ":".join(str(part) for part in scope) if scope else ""
+
+
+def _unit(vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
@@ -0,0 +1,121 @@
+"""
+Conversation-history compaction
+
+api_server.py (conversation_history in the request) and query_rag.py's
+interactive mode used to resend every earlier turn. compact_history() keeps
+the most recent turns verbatim within HISTORY_MAX_TOKENS (0 = unlimited)
+and replaces the older ones with a short summary message:
+
+    [system prompt][summary of turns 1..k][recent turns][question + context]
+
+Upstream prompt caching (OpenAI caches identical prompt prefixes) only helps
+while that prefix stays byte-identical, so:
+
+- the system prompt is built once per language, not per request
+- turns are compacted in blocks of HISTORY_COMPACT_BLOCK, so the summary
+  message only changes every few turns instead of on every one
+- the default summary is extractive (question + start of the answer) and
+  therefore deterministic; HISTORY_SUMMARY=llm asks the model instead, once
+  per block
+"""
+
+import hashlib
+import os
+
+from context_builder import count_tokens, truncate_to_tokens
+
+HISTORY_MAX_TOKENS = int(os.getenv("HISTORY_MAX_TOKENS", 1500))
+HISTORY_COMPACT_BLOCK = int(os.getenv("HISTORY_COMPACT_BLOCK", 4))
+# extractive | llm
+HISTORY_SUMMARY = os.getenv("HISTORY_SUMMARY", "extractive")
+SUMMARY_MAX_TOKENS = 400
+SUMMARY_ANSWER_TOKENS = 40
+SUMMARY_PREFIX = "Summary of the earlier part of this conversation:\n"
+
+
+def _turns(history):
+    """Messages grouped into turns, each starting at a user message; anything
+    before the first user message (a greeting, a system note) is a turn of its own"""
+    turns = []
+    for message in history:
+        if message.get("role") == "user" or not turns:
+            turns.append([])
+        turns[-1].append(message)
+    return turns
+
+
+def _pair(turn):
+    """(user, assistant) text of one turn for the summary; several assistant messages are joined"""
+    def text(role):
+        return "\n".join(m.get("content") or "" for m in turn if m.get("role") == role)
+    return text("user"), text("assistant")
+
+
+def _tokens(messages):
+    return sum(count_tokens(message.get("content") or "") for message in messages)
+
+
+def extractive_summary(turns):
+    lines = [
+        (f"- Q: {user.strip()}\n  A: " if user.strip() else "- A: ")
+        + f"{truncate_to_tokens(assistant.strip(), SUMMARY_ANSWER_TOKENS)}..."
+        for user, assistant in turns
+    ]
+    # اگه خلاصه خیلی بلند شد، قدیمی‌ترین سوال‌ها حذف میشن
+    while len(lines) > 1 and count_tokens("\n".join(lines)) > SUMMARY_MAX_TOKENS:
+        lines.pop(0)
+    return "\n".join(lines)
+
+
+def llm_summarizer(client, model):
+    """Summary function that asks `client` once per distinct block of turns"""
+    summaries = {}
+
+    def summarize(turns):
+        key = hashlib.sha256(repr(turns).encode("utf-8")).hexdigest()
+        if key not in summaries:
+            response = client.chat.completions.create(
+                model=model,
+                messages=[
+                    {"role": "system", "content": "Summarize this conversation between a user and Mia, a medical "
+                                                  "education assistant, in a few short bullet points. Keep drug "
+                                                  "names, doses and the user's situation. Use the conversation's "
+                                                  "language."},
+                    {"role": "user", "content": "\n\n".join(f"User: {u}\nMia: {a}" for u, a in turns)},
+                ],
+                temperature=0,
+                max_tokens=SUMMARY_MAX_TOKENS,
+            )
+            summaries[key] = response.choices[0].message.content.strip()
+        return summaries[key]
+
+    return summarize
+
+
+def compact_history(history, max_tokens=HISTORY_MAX_TOKENS, summarize=None):
+    """Returns (messages to send instead of `history`, token stats of this turn).
+    A history within max_tokens is sent unchanged; otherwise the oldest turns are
+    replaced by a summary and the rest are kept verbatim"""
+    history = list(history or [])
+    full_tokens = _tokens(history)
+    stats = {"history_tokens": full_tokens, "sent_tokens": full_tokens, "saved_tokens": 0, "compacted_turns": 0}
+    if max_tokens <= 0 or full_tokens <= max_tokens:
+        return history, stats
+
+    turns = _turns(history)
+
+    def recent(compacted):
+        return [message for turn in turns[compacted:] for message in turn]
+
+    # چند block از قدیمی‌ترین turn ها خلاصه میشن تا بقیه (به اضافه خلاصه) در بودجه جا بشن
+    compacted = 0
+    while compacted < len(turns) and _tokens(recent(compacted)) + SUMMARY_MAX_TOKENS > max_tokens:
+        compacted = min(compacted + HISTORY_COMPACT_BLOCK, len(turns))
+
+    summary = (summarize or extractive_summary)([_pair(turn) for turn in turns[:compacted]])
+    messages = [{"role": "system", "content": SUMMARY_PREFIX + summary}] + recent(compacted)
+
+    sent_tokens = _tokens(messages)
+    return messages, dict(
+        stats, sent_tokens=sent_tokens, saved_tokens=max(full_tokens - sent_tokens, 0), compacted_turns=compacted
+    )
@@ -0,0 +1,91 @@
+"""
+Single-flight request coalescing
+
+When the same question (same cache key) arrives several times while the
+first one is still being answered, only the first request does the work;
+the duplicates wait for its result and share it.
+"""
+
+import asyncio
+import threading
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Thread-based version for the Flask server"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    def do(self, key, fn):
+        """Run fn() once per key at a time. Returns (result, coalesced)"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.leaders += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
+
+    def stats(self):
+        return {
+            "in_flight": len(self._calls),
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+        }
+
+
+class AsyncSingleFlight:
+    """asyncio version for the async server"""
+
+    def __init__(self):
+        self._tasks = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    async def do(self, key, coro_fn):
+        """Await coro_fn() once per key at a time. Returns (result, coalesced)"""
+        task = self._tasks.get(key)
+        coalesced = task is not None
+        if coalesced:
+            self.coalesced += 1
+        else:
+            # task جدا از درخواست اول اجرا میشه، پس اگه اون کلاینت قطع بشه بقیه جواب رو می‌گیرن
+            task = self._tasks[key] = asyncio.ensure_future(coro_fn())
+            task.add_done_callback(lambda t: self._tasks.pop(key) if self._tasks.get(key) is t else None)
+            self.leaders += 1
+        return await asyncio.shield(task), coalesced
+
+    def stats(self):
+        return {
+            "in_flight": len(self._tasks),
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+        }
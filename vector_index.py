@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+"""
+In-process vector index served from memory-mapped files
+
+`export_index()` dumps the Chroma collection into a directory:
+
+    vectors.f32    N x dim float32 matrix, L2-normalized (row order = IVF list order)
+    chunks.jsonl   one {"id", "text", "metadata"} object per line
+    offsets.i64    byte offset in chunks.jsonl of every row
+    ivf.npz        (large corpora only) k-means centroids + list boundaries
+    meta.json      count, dim, model, ivf settings, shard row ranges
+
+`MmapVectorIndex` answers top-k queries from those files with NumPy: an exact
+dot product over all rows for small corpora, or an IVF probe over the nearest
+lists for large ones. Metadata filters (metadata_index.py) restrict both to
+the matching rows. The files are opened read-only with mmap, so every
+gunicorn worker on the host shares the same page-cache pages instead of
+holding its own copy of the collection.
+
+    python vector_index.py export            # vector_db -> vector_db/mmap_index
+    python vector_index.py check --k 5       # recall@k against Chroma
+"""
+
+import argparse
+import json
+import mmap
+import os
+import shutil
+
+import numpy as np
+from langchain_core.documents import Document
+
+INDEX_DIR_NAME = "mmap_index"
+# IVF kicks in at export time for collections at least this large
+IVF_MIN_SIZE = int(os.getenv("VECTOR_INDEX_IVF_MIN", 50000))
+IVF_NPROBE = int(os.getenv("VECTOR_INDEX_NPROBE", 8))
+
+
+def _normalize(matrix):
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-12)
+
+
+def train_ivf(vectors, nlist, iterations=10, seed=0, rows=None):
+    """Spherical k-means on a sample of the rows (default: all) -> (nlist, dim) centroids"""
+    rng = np.random.default_rng(seed)
+    rows = np.arange(len(vectors)) if rows is None else rows
+    sample = vectors[np.sort(rng.choice(rows, min(len(rows), nlist * 64), replace=False))]
+    centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+    for _ in range(iterations):
+        assign = np.argmax(sample @ centroids.T, axis=1)
+        for c in range(nlist):
+            members = sample[assign == c]
+            if len(members):
+                centroids[c] = members.mean(axis=0)
+        centroids = _normalize(centroids)
+    return centroids.astype(np.float32)
+
+
+def export_index(db, out_dir, model_name=None, page_size=5000, shard_by=None):
+    """Write the Chroma collection behind `db` to `out_dir` (replaced atomically).
+    `shard_by` (subject / language) keeps the rows of every shard together, with their own IVF lists"""
+    key = None
+    if shard_by:
+        from metadata_index import shard_key
+
+        key = shard_key(shard_by)
+    collection = db._collection
+    total = collection.count()
+    tmp_dir = out_dir + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    vectors = None
+    offsets = np.zeros(total, dtype=np.int64)
+    shard_values = []
+    with open(os.path.join(tmp_dir, "chunks.jsonl"), "wb") as chunks:
+        for start in range(0, total, page_size):
+            page = collection.get(
+                include=["embeddings", "documents", "metadatas"], limit=page_size, offset=start
+            )
+            page_vectors = np.asarray(page["embeddings"], dtype=np.float32)
+            if vectors is None:
+                vectors = np.memmap(os.path.join(tmp_dir, "vectors.raw"), dtype=np.float32,
+                                    mode="w+", shape=(total, page_vectors.shape[1]))
+            vectors[start:start + len(page_vectors)] = _normalize(page_vectors)
+            for i, (chunk_id, text, metadata) in enumerate(zip(page["ids"], page["documents"], page["metadatas"])):
+                offsets[start + i] = chunks.tell()
+                if key:
+                    shard_values.append(key(text, metadata or {}))
+                line = json.dumps({"id": chunk_id, "text": text, "metadata": metadata or {}}, ensure_ascii=False)
+                chunks.write(line.encode("utf-8") + b"\n")
+
+    if vectors is None:
+        raise ValueError("❌ The collection is empty, nothing to export")
+
+    dim = vectors.shape[1]
+    shard_names = sorted(set(shard_values))
+    codes = {name: i for i, name in enumerate(shard_names)}
+    shard_codes = np.zeros(total, dtype=np.int64)
+    if shard_values:
+        shard_codes[:] = [codes[value] for value in shard_values]
+    order = np.argsort(shard_codes, kind="stable")
+    ivf = None
+    if total >= IVF_MIN_SIZE:
+        # ردیف‌های هر لیست IVF کنار هم ذخیره میشن تا probe فقط چند برش پیوسته رو بخونه؛
+        # با shard ها هر shard لیست‌های خودش رو داره
+        assign = np.empty(total, dtype=np.int64)
+        centroids = []
+        first_list = 0
+        for code in range(len(shard_names) or 1):
+            members = np.flatnonzero(shard_codes == code)
+            nlist = max(1, min(len(members), int(4 * np.sqrt(len(members)))))
+            shard_centroids = train_ivf(vectors, nlist, rows=members)
+            for i in range(0, len(members), page_size):
+                rows = members[i:i + page_size]
+                assign[rows] = first_list + np.argmax(vectors[rows] @ shard_centroids.T, axis=1)
+            centroids.append(shard_centroids)
+            first_list += nlist
+        centroids = np.concatenate(centroids)
+        order = np.argsort(assign, kind="stable")
+        list_offsets = np.searchsorted(assign[order], np.arange(len(centroids) + 1))
+        np.savez(os.path.join(tmp_dir, "ivf.npz"), centroids=centroids, list_offsets=list_offsets)
+        ivf = {"nlist": len(centroids)}
+    shards = None
+    if shard_by:
+        bounds = np.searchsorted(shard_codes[order], np.arange(len(shard_names) + 1))
+        shards = {"field": shard_by,
+                  "rows": {name: [int(bounds[i]), int(bounds[i + 1])] for i, name in enumerate(shard_names)}}
+
+    final = np.memmap(os.path.join(tmp_dir, "vectors.f32"), dtype=np.float32, mode="w+", shape=(total, dim))
+    for i in range(0, total, page_size):
+        final[i:i + page_size] = vectors[order[i:i + page_size]]
+    final.flush()
+    del final, vectors
+    os.remove(os.path.join(tmp_dir, "vectors.raw"))
+    offsets[order].tofile(os.path.join(tmp_dir, "offsets.i64"))
+
+    with open(os.path.join(tmp_dir, "meta.json"), "w", encoding="utf-8") as fh:
+        json.dump({"count": total, "dim": dim, "model": model_name, "ivf": ivf, "shards": shards},
+                  fh, ensure_ascii=False, indent=2)
+
+    replace_dir(tmp_dir, out_dir)
+    return total
+
+
+def replace_dir(tmp_dir, out_dir):
+    """Move a finished export into place; readers see either the old or the new directory"""
+    old_dir = out_dir + ".old"
+    shutil.rmtree(old_dir, ignore_errors=True)
+    if os.path.exists(out_dir):
+        os.rename(out_dir, old_dir)
+    os.rename(tmp_dir, out_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+
+
+class ChunkStore:
+    """Random access to chunks.jsonl by row number"""
+
+    def __init__(self, path, count):
+        self.offsets = np.memmap(os.path.join(path, "offsets.i64"), dtype=np.int64, mode="r", shape=(count,))
+        with open(os.path.join(path, "chunks.jsonl"), "rb") as fh:
+            self._chunks = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def chunk(self, row):
+        start = int(self.offsets[row])
+        return json.loads(self._chunks[start:self._chunks.find(b"\n", start)])
+
+    def document(self, row):
+        chunk = self.chunk(row)
+        return Document(page_content=chunk["text"], metadata=chunk["metadata"], id=chunk["id"])
+
+
+class MmapVectorIndex:
+    """Drop-in replacement for the Chroma similarity_search* methods"""
+
+    def __init__(self, path, embeddings, nprobe=IVF_NPROBE, metadata=None):
+        self.path = path
+        self.embeddings = embeddings
+        self.nprobe = nprobe
+        self.metadata = metadata  # MetadataIndex for filters (metadata_index.py)
+        with open(os.path.join(path, "meta.json"), encoding="utf-8") as fh:
+            self.meta = json.load(fh)
+        count, dim = self.meta["count"], self.meta["dim"]
+        self.vectors = np.memmap(os.path.join(path, "vectors.f32"), dtype=np.float32, mode="r", shape=(count, dim))
+        self.chunks = ChunkStore(path, count)
+        self.centroids = self.list_offsets = None
+        if self.meta.get("ivf"):
+            ivf = np.load(os.path.join(path, "ivf.npz"))
+            self.centroids, self.list_offsets = ivf["centroids"], ivf["list_offsets"]
+
+    def __len__(self):
+        return self.meta["count"]
+
+    def filter_rows(self, filters):
+        from metadata_index import filter_rows
+
+        if filters and self.metadata is not None and self.metadata.count != len(self):
+            raise ValueError("metadata_index was built from another export, run: python metadata_index.py build")
+        return filter_rows(self.metadata, filters)
+
+    def _candidate_rows(self, query, allowed=None, k=0):
+        """Rows to score: everything (None), the rows a filter allows, or the nprobe nearest IVF lists.
+        With a filter only lists holding allowed rows are probed (one shard's lists with INDEX_SHARD_BY)"""
+        if self.centroids is None:
+            return allowed
+        lists = None
+        if allowed is not None:
+            if len(allowed) <= self.nprobe * len(self) / len(self.centroids):
+                return allowed  # no more rows than a probe would score anyway
+            lists = np.unique(np.searchsorted(self.list_offsets, allowed, side="right") - 1)
+        centroids = self.centroids if lists is None else self.centroids[lists]
+        probe = np.argsort(-(centroids @ query))[:self.nprobe]
+        if lists is not None:
+            probe = lists[probe]
+        rows = np.concatenate([
+            np.arange(self.list_offsets[c], self.list_offsets[c + 1]) for c in probe
+        ])
+        if allowed is None:
+            return rows
+        rows = np.intersect1d(rows, allowed, assume_unique=True)
+        # lists shared with other rows: too few allowed ones in the probe, score all of them
+        return rows if len(rows) >= k else allowed
+
+    def search_rows(self, query, k, allowed=None):
+        """(rows, scores) of the top-k rows by cosine similarity, optionally among `allowed` rows only"""
+        query = _normalize(np.asarray(query, dtype=np.float32))
+        rows = self._candidate_rows(query, allowed, k)
+        scores = self.vectors @ query if rows is None else self.vectors[rows] @ query
+        k = min(k, len(scores))
+        if k <= 0:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.float32)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return (top if rows is None else rows[top]), scores[top]
+
+    def similarity_search_by_vector(self, embedding, k=4, filter=None, **kwargs):
+        rows, _ = self.search_rows(embedding, k, self.filter_rows(filter))
+        return [self.chunks.document(row) for row in rows]
+
+    def similarity_search_by_vectors(self, embeddings, k=4, filter=None):
+        if self.centroids is not None or filter:
+            return [self.similarity_search_by_vector(v, k=k, filter=filter) for v in embeddings]
+        # exact search: one matrix product for the whole batch
+        queries = _normalize(np.asarray(embeddings, dtype=np.float32))
+        scores = queries @ self.vectors.T
+        k = min(k, scores.shape[1])
+        results = []
+        for row_scores in scores:
+            top = np.argpartition(-row_scores, k - 1)[:k]
+            top = top[np.argsort(-row_scores[top])]
+            results.append([self.chunks.document(row) for row in top])
+        return results
+
+    def similarity_search(self, query, k=4, filter=None, **kwargs):
+        return self.similarity_search_by_vector(self.embeddings.embed_query(query), k=k, filter=filter)
+
+    def similarity_search_with_score(self, query, k=4, filter=None, **kwargs):
+        rows, scores = self.search_rows(self.embeddings.embed_query(query), k, self.filter_rows(filter))
+        return [(self.chunks.document(row), float(score)) for row, score in zip(rows, scores)]
+
+
+if __name__ == "__main__":
+    from mia_rag import DB_PATH, EMBEDDING_MODEL, load_embeddings
+    from langchain_community.vectorstores.chroma import Chroma
+
+    parser = argparse.ArgumentParser(description="Export / check the memory-mapped vector index")
+    parser.add_argument("command", choices=["export", "check"])
+    parser.add_argument("--db", default=DB_PATH, help="Chroma persist directory")
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--queries", type=int, default=200, help="sample size for check")
+    parser.add_argument("--shard-by", choices=["", "subject", "language"], default=os.getenv("INDEX_SHARD_BY", ""),
+                        help="export: group rows (and IVF lists) by subject or language")
+    args = parser.parse_args()
+
+    out_dir = os.path.join(args.db, INDEX_DIR_NAME)
+    embeddings = load_embeddings()
+    chroma = Chroma(persist_directory=args.db, embedding_function=embeddings)
+
+    if args.command == "export":
+        count = export_index(chroma, out_dir, EMBEDDING_MODEL, shard_by=args.shard_by or None)
+        print(f"✅ Exported {count} chunks to {out_dir}")
+    else:
+        # بردار خود chunk ها رو به عنوان query استفاده می‌کنیم
+        index = MmapVectorIndex(out_dir, embeddings)
+        rng = np.random.default_rng(0)
+        rows = rng.choice(len(index), min(args.queries, len(index)), replace=False)
+        hits = 0
+        for row in rows:
+            vector = np.array(index.vectors[row])
+            expected = {doc.id for doc in chroma.similarity_search_by_vector(vector.tolist(), k=args.k)}
+            got = {doc.id for doc in index.similarity_search_by_vector(vector, k=args.k)}
+            hits += len(expected & got)
+        print(f"📊 recall@{args.k} vs Chroma: {hits / (len(rows) * args.k):.3f} over {len(rows)} queries")
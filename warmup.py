@@ -0,0 +1,74 @@
+"""
+Background warm-up of the embedding model and vector index
+
+Importing torch / sentence-transformers and loading MiniLM takes long enough
+that the server used to bind its port only after the model was ready. With
+MODEL_LOADING=background (default) the app binds right away, the loading runs
+in a thread and /health answers 503 "warming" until it is done.
+
+MODEL_LOADING=eager loads synchronously at import. gunicorn.conf.py selects it
+together with --preload, so the model is loaded once in the master and shared
+copy-on-write by the forked workers.
+"""
+
+import os
+import threading
+import time
+
+# background | eager
+MODEL_LOADING = os.getenv("MODEL_LOADING", "background")
+
+
+class Warmup:
+    def __init__(self, loader):
+        self.loader = loader
+        self.state = "pending"
+        self.error = None
+        self.seconds = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Run the loader in a background thread; cheap no-op once started in this process"""
+        if self.state in ("ready", "failed") or self._pid == os.getpid():
+            return
+        with self._lock:
+            # worker ای که وسط warm-up از master فورک شده thread رو نداره و باید دوباره شروع کنه
+            if self.state in ("ready", "failed") or self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self.state = "warming"
+            threading.Thread(target=self._run, name="warmup", daemon=True).start()
+
+    def run(self):
+        """Load in the calling thread"""
+        self._pid = os.getpid()
+        self.state = "warming"
+        self._run()
+
+    def _run(self):
+        started = time.monotonic()
+        try:
+            self.loader()
+            self.state = "ready"
+        except Exception as e:
+            self.error = str(e)
+            self.state = "failed"
+        self.seconds = round(time.monotonic() - started, 2)
+
+    @property
+    def ready(self):
+        return self.state == "ready"
+
+    def status(self):
+        return {"state": self.state, "seconds": self.seconds, "error": self.error}
+
+
+def start_warmup(loader):
+    """Warmup for `loader`, already running (background) or finished (eager)"""
+    warmup = Warmup(loader)
+    if MODEL_LOADING == "eager":
+        warmup.run()
+    else:
+        warmup.start()
+    return warmup